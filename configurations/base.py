@@ -8,7 +8,7 @@ import matplotlib.pyplot as plt
 plt.ioff()
 import numpy as np
 from sklearn.metrics import confusion_matrix
-from utils.har_utils import one_hot, rolling_window
+from utils.har_utils import compress_labels, rolling_window, rolling_window_lastaxis, WindowDataset
 
 
 class ModelConfiguration(object):
@@ -27,59 +27,155 @@ class ModelConfiguration(object):
         self.log = ''
         self.stats = 0
         self.f_validate = None
+        self.store = None
+        self.keep = None
 
     def load_datasets(self, datasets, label_limit=100):
-        # Load all datasets and concatenate
-        X, y, name, users, stats = datasets[0]()
-        users = ['%s%02d' % (name, user) for user in users]
-        self.log += '\nLoading %s with %d samples' % (name, X.shape[0])
-
-        for dataset in datasets[1:]:
+        """
+        Load all datasets into one preallocated array, only keeping windows with labels below label_limit. Users
+        are held as integer codes into the sorted name table self.user_names, e.g. 'UCI HAPT01'.
+        """
+        # Load all datasets
+        results = []
+        for dataset in datasets:
             X_tmp, y_tmp, name_tmp, users_tmp, stats_tmp = dataset()
-            X = np.concatenate((X, X_tmp))
-            y = np.concatenate((y, y_tmp))
-            stats = np.concatenate((stats, stats_tmp))
             self.log += '\nLoading %s with %d samples' % (name_tmp, X_tmp.shape[0])
-            for user in users_tmp:
-                users.append('%s%02d' % (name_tmp, user))
-            name += '_' + name_tmp
-        if len(stats) > 0:
-            X = np.concatenate((X, stats), axis=1)
-            self.stats = stats.shape[1]
+            results.append((X_tmp, np.asarray(y_tmp), name_tmp, np.asarray(users_tmp), stats_tmp))
+        name = '_'.join(res[2] for res in results)
+        X_first, stats_first = results[0][0], results[0][4]
+        self.stats = np.shape(stats_first)[1] if len(stats_first) > 0 else 0
+        n_windows = sum(res[0].shape[0] for res in results)
+        shape = (n_windows, X_first.shape[1] + self.stats, X_first.shape[2])
+        if self.stats > 0:
             self.log += '\nStats: %d' % self.stats
-        self.log += '\nLoaded %s with %d samples' % (name, X.shape[0])
-        self.log += '\nData shape: %s' % str(X.shape)
+        self.log += '\nLoaded %s with %d samples' % (name, n_windows)
+        self.log += '\nData shape: %s' % str(shape)
 
         # Limit labels to a subset
         self.log += '\nLimiting labels to < %d' % label_limit
-        limited_labels = y < label_limit
-        y = y[limited_labels]
-        X = X[limited_labels]
-        users = np.char.asarray(users)[limited_labels]
-        self.log += '\nRemaining: %d samples' % np.sum(limited_labels)
+        keep = [res[1] < label_limit for res in results]
+        n_keep = int(sum(np.sum(k) for k in keep))
+        self.log += '\nRemaining: %d samples' % n_keep
+
+        # Fill the remaining windows with the stats appended along the time axis
+        y = np.empty(n_keep, dtype='int')
+        users = np.empty(n_keep, dtype=np.int32)
+        table = []
+        if isinstance(X_first, WindowDataset):
+            X = WindowDataset.concatenate([res[0] for res in results])[np.concatenate(keep)]
+        else:
+            X = np.empty((n_keep,) + shape[1:], dtype='float32')
+        offset = 0
+        for (X_tmp, y_tmp, name_tmp, users_tmp, stats_tmp), k in zip(results, keep):
+            n = int(np.sum(k))
+            if not isinstance(X, WindowDataset):
+                X[offset:offset+n, :X_tmp.shape[1]] = X_tmp[k]
+                if self.stats > 0:
+                    X[offset:offset+n, X_tmp.shape[1]:] = np.asarray(stats_tmp)[k]
+            y[offset:offset+n] = y_tmp[k]
 
-        # Compress labels
-        for idx, label in enumerate(np.unique(y)):
-            if not np.equal(idx, label):
-                y[y == label] = idx
+            # Code the users of each dataset by their position in the table of user names
+            user_ids, inverse = np.unique(users_tmp[k], return_inverse=True)
+            users[offset:offset+n] = len(table) + inverse.ravel()
+            table += ['%s%02d' % (name_tmp, user) for user in user_ids]
+            offset += n
 
-        # One hot encoding of labels
-        y = one_hot(y)
+        # Merge users with equal names and number them in sorted name order
+        self.user_names, codes = np.unique(np.asarray(table, dtype=str), return_inverse=True)
+        users = codes.ravel()[users].astype(np.int32)
+
+        # Compress labels, they are kept as integers and only expanded to one-hot targets by the model graph
+        y = compress_labels(y).astype(np.int32)
 
         # Specify class variables
-        self.n_classes = y.shape[-1]
-        self.X, self.y, self.name, self.users = X.astype('float32'), y, name, users
-        self.user_names = np.unique(self.users)
+        self.n_classes = int(y.max()) + 1 if len(y) > 0 else 0
+        self.X, self.y, self.name, self.users = X, y, name, users
         self.n_features = X.shape[-1]
+        self.log += '\n' + self.memory_report()
+
+        self.d = str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d%H%M%S'))
+
+    def memory_report(self):
+        """
+        Footprint of the loaded arrays, with the labels compared to the float32 one-hot matrix they replace
+        :return: report string
+        """
+        mb = 1024. ** 2
+        lines = ['Memory footprint:']
+        for name, array in (('X', self.X), ('y', self.y), ('users', self.users)):
+            nbytes = array.signal.nbytes + array.index.nbytes if isinstance(array, WindowDataset) else array.nbytes
+            lines.append('%s: %s %s %.2f MB' % (name, str(array.shape), str(array.dtype), nbytes / mb))
+        lines.append('y as float32 one-hot: %.2f MB' % (len(self.y) * self.n_classes * 4 / mb))
+        return '\n'.join(lines)
+
+    def user_fold(self, user):
+        """
+        :param user: user name, e.g. 'UCI HAPT10'
+        :return: boolean train and test masks leaving the user out, or with a store the (start, stop) row ranges
+        of the other users and of the user, as in self.cv
+        """
+        if self.store is not None:
+            codes = [code for code, name in self.store.user_names.items() if name == user]
+            return self.store.ranges(codes, exclude=True), self.store.ranges(codes)
+        code = np.flatnonzero(self.user_names == user)
+        test_idx = self.users == (code[0] if len(code) > 0 else -1)
+        return ~test_idx, test_idx
+
+    def load_store(self, store, label_limit=100):
+        """
+        Use a HARStore instead of in-memory datasets. Windows are read per fold in run, which then takes lists
+        of (start, stop) row ranges as train and test indices, one pair per user in self.cv and from user_fold, or
+        boolean masks and row indices over the store, e.g. from folds over self.users. Users are coded as in
+        load_datasets, with one code per row of the store.
+        :param store: data_loaders.har.HARStore built by data_preparation.build_har_data
+        :param label_limit: only keep windows with labels below this limit
+        """
+        self.store = store
+        self.name = store.name
+        self.log += '\nLoaded %s with %d samples' % (self.name, store.n_windows)
+        self.stats = store.n_stats
+
+        # Limit labels to a subset
+        self.log += '\nLimiting labels to < %d' % label_limit
+        self.keep = store.y < label_limit
+        self.log += '\nRemaining: %d samples' % np.sum(self.keep)
+
+        # Compress labels over the remaining windows, dropped windows are never read
+        labels = np.unique(store.y[self.keep])
+        self.y = np.searchsorted(labels, store.y).clip(0, len(labels) - 1).astype(np.int32)
+        self.n_classes = len(labels)
+        self.n_features = store.n_features
+
+        # Code the users as in load_datasets, by their position in the sorted table of the names of users with
+        # remaining windows, and with -1 for users without any
+        store_codes = np.unique(store.users[self.keep])
+        self.user_names = np.asarray(sorted(store.user_names[code] for code in store_codes), dtype=str)
+        lookup = np.full(store.users.max() + 1 if len(store.users) > 0 else 0, -1, dtype=np.int32)
+        lookup[store_codes] = np.searchsorted(self.user_names, [store.user_names[code] for code in store_codes])
+        self.users = lookup[store.users]
+
+        # One leave-one-user-out fold per user in the order of the name table
+        codes = dict((store.user_names[code], code) for code in store_codes)
+        self.cv = [(store.ranges([codes[name]], exclude=True), store.ranges([codes[name]]))
+                   for name in self.user_names]
 
         self.d = str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d%H%M%S'))
 
     def run(self, train_index, test_index, lr, n_epochs, model, train, load_data, factor=1, batch_size=None,
-            anneal=None):
-        x_train, x_test = self.X[train_index], self.X[test_index]
-        y_train, y_test = self.y[train_index], self.y[test_index]
+            anneal=None, early_stopping=None):
+        if self.store is not None:
+            x_train, x_test = self.store.read(train_index, self.keep), self.store.read(test_index, self.keep)
+            y_train = self.y[self.store.rows(train_index, self.keep)]
+            y_test = self.y[self.store.rows(test_index, self.keep)]
+        else:
+            x_train, x_test = self.X[train_index], self.X[test_index]
+            y_train, y_test = self.y[train_index], self.y[test_index]
         n_windows, sequence_length, n_features = x_train.shape
-        print('Xtrain mean: %f\tstd: %f' % (x_train.mean(), x_train.std()))
+        if isinstance(x_train, WindowDataset):
+            # Only the test user is materialised, training windows are gathered per batch by the model
+            x_test = np.asarray(x_test)
+        else:
+            print('Xtrain mean: %f\tstd: %f' % (x_train.mean(), x_train.std()))
         print('Xtest mean: %f\tstd: %f' % (x_test.mean(), x_test.std()))
 
         def concat_sequence(x, window, step):
@@ -88,10 +184,13 @@ class ModelConfiguration(object):
 
         # Reshape datasets to longer sequences
         if factor > 1:
-            x_train = concat_sequence(x_train, factor*sequence_length, sequence_length)
-            y_train = concat_sequence(y_train, factor, 1)
+            if isinstance(x_train, WindowDataset):
+                x_train = x_train.sequences(factor)
+            else:
+                x_train = concat_sequence(x_train, factor*sequence_length, sequence_length)
+            y_train = rolling_window_lastaxis(y_train, factor, 1)
             x_test = concat_sequence(x_test, factor*sequence_length, sequence_length)
-            y_test = concat_sequence(y_test, factor, 1)
+            y_test = rolling_window_lastaxis(y_test, factor, 1)
 
         train_set = (x_train, y_train)
         test_set = (x_test, y_test)
@@ -116,7 +215,7 @@ class ModelConfiguration(object):
 
         def f_custom(model, path):
             mean_evals = model.get_output(test_set[0]).eval()
-            t_class = np.argmax(np.reshape(test_set[1], (n_test*factor, -1)), axis=1)
+            t_class = np.reshape(test_set[1], n_test*factor)
             y_class = np.argmax(np.reshape(mean_evals, (n_test*factor, -1)), axis=1)
 
             plt.clf()
@@ -147,6 +246,10 @@ class ModelConfiguration(object):
         validate_args['inputs']['batchsize'] = batch_size
 
         train.add_initial_training_notes("Standardizing data after adding features")
+        # Keep the fitted preprocessing with the model when all windows share it
+        if load_data.normalize is None or (load_data.normalize == 'channels' and self.name in load_data.normalisers):
+            model.preprocessing = load_data.preprocessing(self.name)
+
         train.write_to_logger(self.log)
         train.write_to_logger("Dataset: %s" % self.name)
         train.write_to_logger("Normalizing: %s" % load_data.normalize)
@@ -175,7 +278,8 @@ class ModelConfiguration(object):
                           n_train_batches=n_train_batches,
                           n_test_batches=n_test_batches,
                           n_epochs=n_epochs,
-                          anneal=anneal)
+                          anneal=anneal,
+                          early_stopping=early_stopping)
 
         # Reset logging
         handlers = train.logger.handlers[:]
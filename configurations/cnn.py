@@ -20,8 +20,7 @@ def main():
     user = None
     # Create a time-string for our cv run
     if user is not None:
-        train_idx = conf.users != user
-        test_idx = conf.users == user
+        train_idx, test_idx = conf.user_fold(user)
         conf.cv = ((train_idx, test_idx), )
     else:
         conf.cv = LeaveOneLabelOut(conf.users)
@@ -20,8 +20,7 @@ def main():
     user_idx = -1
     user = None  # 'UCI HAPT10'
     if user is not None:
-        train_idx = conf.users != user
-        test_idx = conf.users == user
+        train_idx, test_idx = conf.user_fold(user)
         conf.cv = ((train_idx, test_idx), )
         print('Testing user: %s' % user)
     else:
@@ -32,7 +31,7 @@ def main():
         # conf.cv = StratifiedKFold(np.argmax(conf.y, axis=1), n_folds=10)
 
         # And shuffle
-        conf.cv = StratifiedShuffleSplit(np.argmax(conf.y, axis=1), n_iter=10, test_size=0.1, random_state=None)
+        conf.cv = StratifiedShuffleSplit(conf.y, n_iter=10, test_size=0.1, random_state=None)
 
         # Pure shuffle
         # conf.cv = ShuffleSplit(conf.y.shape[0], n_iter=2, test_size=0.1)
@@ -22,12 +22,11 @@ def main():
     user = None
     # Create a time-string for our cv run
     if user is not None:
-        train_idx = conf.users != user
-        test_idx = conf.users == user
+        train_idx, test_idx = conf.user_fold(user)
         conf.cv = ((train_idx, test_idx), )
     else:
         # conf.cv = LeaveOneLabelOut(conf.users)
-        conf.cv = StratifiedShuffleSplit(np.argmax(conf.y, axis=1), n_iter=10, test_size=0.1, random_state=None)
+        conf.cv = StratifiedShuffleSplit(conf.y, n_iter=10, test_size=0.1, random_state=None)
 
     for train_index, test_index in conf.cv:
         conf.user = user
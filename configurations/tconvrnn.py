@@ -21,8 +21,7 @@ def main():
     user_idx = -1
     user = None  # 'UCI HAPT10'
     if user is not None:
-        train_idx = conf.users != user
-        test_idx = conf.users == user
+        train_idx, test_idx = conf.user_fold(user)
         conf.cv = ((train_idx, test_idx), )
         print('Testing user: %s' % user)
     else:
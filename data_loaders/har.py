@@ -1,9 +1,225 @@
 from utils import env_paths
+from utils.har_utils import ChannelNormaliser
+import numpy as np
+import json
 import tables
 import os
 
 
-def load():
+def _read_rows(array, rows):
+    """
+    Read sorted rows of an on-disk array with one slice per contiguous run, so only the chunks holding those rows
+    are decompressed.
+    :param array: HDF5 array with windows along the first axis.
+    :param rows: sorted row indices.
+    :return: the rows as a numpy array.
+    """
+    out = np.empty((len(rows),) + tuple(array.shape[1:]), dtype=array.dtype)
+    if len(rows) == 0:
+        return out
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    for start, stop in zip(np.r_[0, breaks], np.r_[breaks, len(rows)]):
+        out[start:stop] = array[rows[start]:rows[stop-1]+1]
+    return out
+
+
+def _select_rows(hdf5_file, users=None, labels=None):
+    """
+    Find the rows of the selected users and labels from the user index table and the labels.
+    :param users: user codes or user names, e.g. 'UCI HAPT01'.
+    :param labels: labels to keep.
+    :return: sorted row indices.
+    """
+    n_rows = hdf5_file.root.X.nrows
+    if users is None:
+        mask = np.ones(n_rows, dtype=bool)
+    else:
+        mask = np.zeros(n_rows, dtype=bool)
+        selected = set(u.encode('utf-8') if isinstance(u, str) else u for u in users)
+        for row in hdf5_file.root.user_index.iterrows():
+            if row['user'] in selected or row['name'] in selected:
+                mask[row['start']:row['stop']] = True
+
+    if labels is not None:
+        mask &= np.isin(hdf5_file.root.y[:], labels)
+    return np.flatnonzero(mask)
+
+
+def _normaliser_runs(hdf5_file):
+    """
+    Channel normalisation of the store. Stores built with channel normalisation hold unnormalised windows and the
+    merged moments of each dataset, so subjects can be appended without rewriting the stored windows.
+    :return: list of (start, stop, ChannelNormaliser), one per user index row of a dataset with moments.
+    """
+    if 'moments' not in hdf5_file.root._v_attrs:
+        return []
+    moments = json.loads(hdf5_file.root._v_attrs.moments)
+    normalisers = dict((name, ChannelNormaliser.from_state(state)) for name, state in moments.items())
+    return [(int(row['start']), int(row['stop']), normalisers[row['dataset'].decode('utf-8')])
+            for row in hdf5_file.root.user_index.iterrows() if row['dataset'].decode('utf-8') in normalisers]
+
+
+def _normalise_rows(X, rows, runs):
+    """
+    Normalise windows read from the store in place.
+    :param X: windows of the rows.
+    :param runs: list of (start, stop, ChannelNormaliser), cf. _normaliser_runs.
+    """
+    if np.all(np.diff(rows) >= 0):
+        for start, stop, normaliser in runs:
+            first, last = np.searchsorted(rows, [start, stop])
+            if last > first:
+                normaliser.transform(X[first:last])
+        return X
+    for start, stop, normaliser in runs:
+        idx = np.flatnonzero((rows >= start) & (rows < stop))
+        if len(idx) > 0:
+            X[idx] = normaliser.transform(X[idx])
+    return X
+
+
+def _merge_ranges(ranges):
+    """
+    Sort (start, stop) ranges and merge adjacent ones.
+    """
+    merged = []
+    for start, stop in sorted(ranges):
+        if len(merged) > 0 and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], stop)
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+class HARStore(object):
+    """
+    Lazy handle on the HAR store. Labels, user codes and the user index are held in memory, while windows are only
+    read for the row ranges of a partition, so a leave-one-user-out run never holds more than one copy of X.
+    """
+
+    def __init__(self, path=None):
+        """
+        Open the store and precompute the row ranges of every user from the user index table.
+        :param path: store file, defaults to the file read by load().
+        """
+        if path is None:
+            path = os.path.join(env_paths.get_data_path("har"), 'har_data.h5')
+        if not os.path.isfile(path):
+            raise ValueError('No file: %s' % path)
+
+        print("Opening HAR store %s" % path)
+        self.hdf5_file = tables.open_file(path, mode='r')
+        root = self.hdf5_file.root
+        self.y = root.y[:].astype('int')
+        self.users = root.users[:].astype('int')
+        self.n_windows, self.n_samples, self.n_features = root.X.shape
+        self.n_stats = root.stats.shape[1] if 'stats' in root else 0
+        self.name = '_'.join(json.loads(root._v_attrs.datasets))
+        self.normaliser_runs = _normaliser_runs(self.hdf5_file)
+
+        index = root.user_index.read()
+        self.user_names = {}
+        self.user_ranges = {}
+        for row in index:
+            self.user_names[int(row['user'])] = row['name'].decode('utf-8')
+            self.user_ranges.setdefault(int(row['user']), []).append((int(row['start']), int(row['stop'])))
+
+    def ranges(self, users, exclude=False):
+        """
+        Row ranges of the given user codes, or of all other users if exclude is set.
+        :return: sorted list of merged (start, stop) ranges.
+        """
+        users = set(users)
+        return _merge_ranges([r for user, user_ranges in self.user_ranges.items()
+                              for r in user_ranges if (user in users) != exclude])
+
+    def leave_one_user_out(self):
+        """
+        :return: list of (user code, train ranges, test ranges), one per user.
+        """
+        return [(user, self.ranges([user], exclude=True), self.ranges([user])) for user in sorted(self.user_ranges)]
+
+    def as_ranges(self, index):
+        """
+        Row ranges of a fold index.
+        :param index: list of (start, stop) row ranges, a boolean mask over all rows or integer row indices.
+        :return: list of (start, stop) ranges covering the rows in the order of the index.
+        """
+        index = np.asarray(index)
+        if index.size == 0:
+            return []
+        if index.ndim == 2 and index.shape[1] == 2 and np.issubdtype(index.dtype, np.integer):
+            return [(int(start), int(stop)) for start, stop in index]
+        if index.ndim != 1:
+            raise ValueError('Fold indices must be (start, stop) row ranges, a boolean mask or row indices, not an '
+                             'array of shape %s' % str(index.shape))
+        if index.dtype == bool:
+            if len(index) != self.n_windows:
+                raise ValueError('A boolean fold mask must cover the %d rows of the store, not %d'
+                                 % (self.n_windows, len(index)))
+            index = np.flatnonzero(index)
+        elif not np.issubdtype(index.dtype, np.integer):
+            raise ValueError('Fold indices must be (start, stop) row ranges, a boolean mask or row indices, not %s'
+                             % index.dtype)
+        elif index.min() < 0 or index.max() >= self.n_windows:
+            raise ValueError('Row indices must lie in [0, %d)' % self.n_windows)
+
+        # One range per run of consecutive rows
+        breaks = np.flatnonzero(np.diff(index) != 1) + 1
+        return [(int(index[first]), int(index[last-1]) + 1)
+                for first, last in zip(np.r_[0, breaks], np.r_[breaks, len(index)])]
+
+    def rows(self, index, keep=None):
+        """
+        Row indices of a fold index, optionally restricted to the rows where keep is True.
+        :param index: row ranges, a boolean mask or row indices, cf. as_ranges.
+        """
+        ranges = self.as_ranges(index)
+        if len(ranges) == 0:
+            return np.empty(0, dtype=np.int64)
+        rows = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+        if keep is not None:
+            rows = rows[keep[rows]]
+        return rows
+
+    def read(self, index, keep=None):
+        """
+        Read the windows of a fold index into one preallocated array, with the stats appended along the time axis
+        as in ModelConfiguration.load_datasets. Windows are normalised with the moments of their dataset.
+        :param index: list of (start, stop) row ranges, a boolean mask over all rows or integer row indices, cf.
+        as_ranges.
+        :param keep: optional boolean mask over all rows.
+        :return: float32 array of dim n_rows x (n_samples + n_stats) x n_features.
+        """
+        ranges = self.as_ranges(index)
+        rows = self.rows(ranges, keep)
+        n_rows = len(rows)
+        out = np.empty((n_rows, self.n_samples + self.n_stats, self.n_features), dtype='float32')
+        root = self.hdf5_file.root
+        offset = 0
+        for start, stop in ranges:
+            sel = slice(None) if keep is None else keep[start:stop]
+            n = stop - start if keep is None else int(np.sum(sel))
+            if n == 0:
+                continue
+            out[offset:offset+n, :self.n_samples] = root.X[start:stop][sel]
+            if self.n_stats > 0:
+                out[offset:offset+n, self.n_samples:] = root.stats[start:stop][sel]
+            offset += n
+        _normalise_rows(out[:, :self.n_samples], rows, self.normaliser_runs)
+        return out
+
+    def close(self):
+        self.hdf5_file.close()
+
+
+def load(users=None, labels=None):
+    """
+    Load the HAR store written by data_preparation.build_har_data.
+    :param users: user codes or user names to load, all users if None.
+    :param labels: labels to load, all labels if None.
+    :return: X, y, users and stats of the selected windows.
+    """
     data_file = 'har_data.h5'
     new_path = os.path.join(
         env_paths.get_data_path("har"),
@@ -11,14 +227,19 @@ def load():
     )
 
     if not os.path.isfile(new_path):
-        ValueError('No file: %s' % new_path)
+        raise ValueError('No file: %s' % new_path)
 
     print("Loading data from %s" % new_path)
     hdf5_file = tables.open_file(new_path, mode='r', title='HAR data')
-    X = hdf5_file.root.X[:].astype('float32')
-    y = hdf5_file.root.y[:].astype('int')
-    users = hdf5_file.root.users[:].astype('int')
-    stats = hdf5_file.root.stats[:].astype('float32')
+    rows = _select_rows(hdf5_file, users, labels)
+    X = _read_rows(hdf5_file.root.X, rows).astype('float32')
+    _normalise_rows(X, rows, _normaliser_runs(hdf5_file))
+    y = _read_rows(hdf5_file.root.y, rows).astype('int')
+    users = _read_rows(hdf5_file.root.users, rows).astype('int')
+    if 'stats' in hdf5_file.root:
+        stats = _read_rows(hdf5_file.root.stats, rows).astype('float32')
+    else:
+        stats = np.empty(0, dtype='float32')
     hdf5_file.close()
 
-    return X, y, users, stats
\ No newline at end of file
+    return X, y, users, stats
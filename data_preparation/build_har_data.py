@@ -0,0 +1,212 @@
+"""
+Build the binary HAR store read by data_loaders.har from any combination of LoadHAR loaders, e.g.
+
+    python -m data_preparation.build_har_data --datasets uci_hapt uci_mhealth idash --n_samples 100 --step 50
+
+The store holds the windows X, the labels y, integer user codes, the per-window stats and a user_index table with
+one row per contiguous run of windows of a user, so readers can select users without touching other chunks.
+
+With channel normalisation the windows are stored unnormalised together with the mergeable moments of each dataset,
+and readers normalise on read. New subjects can then be appended without rewriting existing chunks, e.g.
+
+    python -m data_preparation.build_har_data --datasets uci_hapt --append --users 31 32
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import tables
+from utils import env_paths
+from data_preparation.load_data import LoadHAR, CACHE_EXCLUDE
+from utils.har_utils import ChannelNormaliser
+
+DATA_FILE = 'har_data.h5'
+# Number of whole windows per HDF5 chunk
+CHUNK_WINDOWS = 256
+
+
+class UserIndex(tables.IsDescription):
+    user = tables.Int32Col(pos=0)
+    name = tables.StringCol(32, pos=1)
+    dataset = tables.StringCol(32, pos=2)
+    start = tables.Int64Col(pos=3)
+    stop = tables.Int64Col(pos=4)
+
+
+def get_store_path():
+    return os.path.join(env_paths.get_data_path("har"), DATA_FILE)
+
+
+def create_store(path, n_samples, n_features, n_stats, preprocessing, chunk_windows=CHUNK_WINDOWS, complevel=5):
+    """
+    Create an empty store with extendable arrays chunked along whole windows.
+    :param n_stats: number of statistics rows per window, 0 if the loaders return no stats.
+    :param preprocessing: dict of LoadHAR options stored as metadata.
+    :return: the open HDF5 file.
+    """
+    h5 = tables.open_file(path, mode='w', title='HAR data')
+    filters = tables.Filters(complevel=complevel, complib='blosc', shuffle=True)
+    h5.create_earray(h5.root, 'X', tables.Float32Atom(), shape=(0, n_samples, n_features), filters=filters,
+                     chunkshape=(chunk_windows, n_samples, n_features))
+    h5.create_earray(h5.root, 'y', tables.Int32Atom(), shape=(0,), filters=filters)
+    h5.create_earray(h5.root, 'users', tables.Int32Atom(), shape=(0,), filters=filters)
+    if n_stats > 0:
+        h5.create_earray(h5.root, 'stats', tables.Float32Atom(), shape=(0, n_stats, n_features), filters=filters,
+                         chunkshape=(chunk_windows, n_stats, n_features))
+    h5.create_table(h5.root, 'user_index', UserIndex, 'Contiguous runs of windows per user')
+    h5.root._v_attrs.preprocessing = json.dumps(preprocessing, sort_keys=True)
+    h5.root._v_attrs.datasets = json.dumps([])
+    h5.root._v_attrs.moments = json.dumps({})
+    return h5
+
+
+def open_store(path, preprocessing):
+    """
+    Open an existing store for appending.
+    :param preprocessing: dict of LoadHAR options, which must match the options the store was built with.
+    :return: the open HDF5 file.
+    """
+    h5 = tables.open_file(path, mode='a')
+    stored = json.loads(h5.root._v_attrs.preprocessing)
+    if stored != json.loads(json.dumps(preprocessing, sort_keys=True)):
+        h5.close()
+        raise ValueError('The store was built with other preprocessing options: %s' % stored)
+    return h5
+
+
+def append_dataset(h5, X, y, name, users, stats, normaliser=None):
+    """
+    Append the output of one LoadHAR loader to an open store. Existing rows are never rewritten, so their indices
+    stay valid. Users are given codes following the highest code in the store, and one user_index row is added
+    per contiguous run of windows of a user.
+    :param normaliser: ChannelNormaliser fitted to the unnormalised windows X, merged into the moments of the
+    dataset in the store.
+    """
+    n_windows = X.shape[0]
+    offset = h5.root.X.nrows
+    index = h5.root.user_index
+    codes = dict((row['name'].decode('utf-8'), row['user']) for row in index.iterrows())
+    next_code = max(codes.values()) + 1 if len(codes) > 0 else 0
+
+    for user in np.unique(users):
+        if '%s%02d' % (name, user) in codes:
+            raise ValueError('User %s%02d is already in the store' % (name, user))
+
+    # Find the contiguous runs of windows per user
+    users = np.asarray(users).astype(np.int64)
+    breaks = np.flatnonzero(users[1:] != users[:-1]) + 1
+    starts = np.r_[0, breaks].astype(np.int64)
+    stops = np.r_[breaks, n_windows].astype(np.int64)
+
+    user_codes = np.empty(n_windows, dtype=np.int32)
+    run_names = []
+    for start, stop in zip(starts, stops):
+        user_name = '%s%02d' % (name, users[start])
+        if user_name not in codes:
+            codes[user_name] = next_code
+            next_code += 1
+        user_codes[start:stop] = codes[user_name]
+        run_names.append(user_name)
+
+    # Write the windows before the index, so an interrupted append never indexes rows past the stored data
+    h5.root.X.append(np.asarray(X, dtype=np.float32))
+    h5.root.y.append(np.asarray(y, dtype=np.int32))
+    h5.root.users.append(user_codes)
+    if 'stats' in h5.root:
+        h5.root.stats.append(np.asarray(stats, dtype=np.float32))
+    h5.flush()
+
+    row = index.row
+    for start, stop, user_name in zip(starts, stops, run_names):
+        row['user'] = codes[user_name]
+        row['name'] = user_name
+        row['dataset'] = name
+        row['start'] = offset + start
+        row['stop'] = offset + stop
+        row.append()
+    index.flush()
+
+    datasets = json.loads(h5.root._v_attrs.datasets)
+    if name not in datasets:
+        h5.root._v_attrs.datasets = json.dumps(datasets + [name])
+    if normaliser is not None:
+        moments = json.loads(h5.root._v_attrs.moments)
+        if name in moments:
+            normaliser = ChannelNormaliser.from_state(moments[name]).merge(normaliser)
+        moments[name] = normaliser.state()
+        h5.root._v_attrs.moments = json.dumps(moments)
+
+
+def build(loaders, path=None, chunk_windows=CHUNK_WINDOWS, complevel=5, append=False):
+    """
+    Run LoadHAR loaders and write their output to one chunked, compressed HDF5 store. With channel normalisation
+    the loaders run without it and the moments of each dataset are stored instead.
+    :param loaders: list of bound LoadHAR loaders sharing one LoadHAR instance, e.g. [load_data.uci_hapt].
+    :param path: output file, defaults to the file read by data_loaders.har.
+    :param append: append to an existing store instead of replacing it, e.g. with LoadHAR(users=...) selecting
+    the new subjects.
+    :return: the path of the store.
+    """
+    if path is None:
+        path = get_store_path()
+
+    h5 = None
+    try:
+        for loader in loaders:
+            load_data = loader.__self__
+            options = dict((k, v) for k, v in vars(load_data).items() if k not in CACHE_EXCLUDE + ('users',))
+            normalise = load_data.normalize
+            if normalise == 'channels':
+                load_data.normalize = None
+            try:
+                X, y, name, users, stats = loader()
+            finally:
+                load_data.normalize = normalise
+            X = np.asarray(X, dtype=np.float32)
+            normaliser = ChannelNormaliser().fit(X) if normalise == 'channels' else None
+
+            print("Writing %s with %d windows to %s" % (name, X.shape[0], path))
+            if h5 is None:
+                if append and os.path.isfile(path):
+                    h5 = open_store(path, options)
+                else:
+                    n_stats = np.asarray(stats).shape[1] if len(stats) > 0 else 0
+                    h5 = create_store(path, X.shape[1], X.shape[2], n_stats, options, chunk_windows, complevel)
+            append_dataset(h5, X, y, name, users, stats, normaliser)
+    finally:
+        if h5 is not None:
+            h5.close()
+    return path
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--datasets', nargs='+', default=['uci_hapt'])
+parser.add_argument('--output', type=str, default=None)
+parser.add_argument('--n_samples', type=int, default=100)
+parser.add_argument('--step', type=int, default=50)
+parser.add_argument('--normalize', type=str, default='channels')
+parser.add_argument('--add_pitch', action='store_true')
+parser.add_argument('--add_roll', action='store_true')
+parser.add_argument('--add_filter', action='store_true')
+parser.add_argument('--comp_magnitude', action='store_true')
+parser.add_argument('--simple_labels', action='store_true')
+parser.add_argument('--lowpass', type=float, default=None)
+parser.add_argument('--diff', action='store_true')
+parser.add_argument('--chunk_windows', type=int, default=CHUNK_WINDOWS)
+parser.add_argument('--append', action='store_true')
+parser.add_argument('--users', type=int, nargs='+', default=None)
+
+
+def main(argv):
+    args = parser.parse_args(argv)
+    load_data = LoadHAR(add_pitch=args.add_pitch, add_roll=args.add_roll, add_filter=args.add_filter,
+                        n_samples=args.n_samples, step=args.step, normalize=args.normalize,
+                        comp_magnitude=args.comp_magnitude, simple_labels=args.simple_labels,
+                        lowpass=args.lowpass, diff=args.diff, users=args.users)
+    build([getattr(load_data, dataset) for dataset in args.datasets], args.output, args.chunk_windows,
+          append=args.append)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -7,22 +7,35 @@ with the shape of n_batch x samples x features
 import theano
 theano.config.floatX = 'float32'
 import os
+import json
+import shutil
+import hashlib
+import functools
+from multiprocessing import Pool
 import pandas as pd
 import glob as glob
 import numpy as np
 from scipy.io import loadmat
-from scipy.signal import resample
-import itertools
-from utils.har_utils import roll, pitch, expand_target, split_signal, magnitude, rolling_window, lowpass_filter
+from utils.har_utils import expand_target, rolling_window_lastaxis, n_windows, resample_windows, resample_signal, \
+    window_labels, WindowDataset, ChannelNormaliser, har_features
+from utils.preprocessing import Preprocessing
+from utils.csv_cache import cached_read_csv, CACHE_FOLDER
 
 ACTIVITY_MAP = {0: 'WALKING', 1: 'CYCLING', 2: 'RUNNING', 3: 'STAIRS', 4: 'JOGGING', 5: 'LAYING',
                 6: 'WALKING_UPSTAIRS',7: 'WALKING_DOWNSTAIRS', 8: 'BEND_FORWARD',
                 9: 'ARM_ELEVATION', 10: 'KNEE_BEND', 11: 'SITTING', 12: 'STANDING', 13: 'JUMP', 14: 'STEP', 15: 'NULL',
                 16: 'UPRIGHT_INACTIVE', 17: 'INACTIVE',
                 18: 'STAND_TO_SIT', 19: 'SIT_TO_STAND', 20: 'SIT_TO_LIE', 21: 'LIE_TO_SIT', 22: 'STAND_TO_LIE',
-                23: 'LIE_TO_STAND', 24: 'TRANSITION'}
+                23: 'LIE_TO_STAND', 24: 'TRANSITION', 25: 'WRITE_ON_NOTEPAD', 26: 'OPEN_HOOD', 27: 'CLOSE_HOOD',
+                28: 'CHECK_GAPS_FRONT_DOOR', 29: 'OPEN_LEFT_FRONT_DOOR', 30: 'CLOSE_LEFT_FRONT_DOOR',
+                31: 'CLOSE_BOTH_LEFT_DOORS', 32: 'CHECK_TRUNK_GAPS', 33: 'OPEN_CLOSE_TRUNK', 34: 'CHECK_STEERING_WHEEL'}
 MAP_ACTIVITY = dict((v, k) for k, v in list(ACTIVITY_MAP.items()))
 SR = 50
+# Loaders return float32 windows and int32 labels and user ids
+LABEL_DTYPE = np.int32
+USER_DTYPE = np.int32
+# Number of rows parsed at a time by the streaming readers
+CHUNK_SIZE = 100000
 
 # Path to HAR data
 if os.environ.get('DEV_ENVIRONMENT') == 'local' :
@@ -30,14 +43,188 @@ if os.environ.get('DEV_ENVIRONMENT') == 'local' :
 else:
     ROOT_FOLDER = '/nobackup/titans/sdka/data/activity/'
 
+# Attributes of LoadHAR that do not change the output of a loader and are left out of the cache key
+CACHE_EXCLUDE = ('name', 'cache', 'cache_dir', 'n_jobs', 'normalisers')
+CACHE_FIELDS = ('data_array', 'y', 'users', 'stats')
+WINDOW_FIELDS = ('signal', 'offsets', 'index')
+
+
+def source_files(folder):
+    """
+    List the files below a dataset folder with their size and modification time
+    :param folder: dataset folder
+    :return: sorted list of (relative path, size, mtime)
+    """
+    files = []
+    for dir_path, dir_names, file_names in os.walk(folder):
+        # Binary copies written by cached_read_csv are derived from the other files
+        dir_names[:] = sorted(d for d in dir_names if d != CACHE_FOLDER)
+        for file_name in sorted(file_names):
+            path = os.path.join(dir_path, file_name)
+            stat = os.stat(path)
+            files.append((os.path.relpath(path, folder), stat.st_size, stat.st_mtime))
+    return files
+
+
+@functools.lru_cache(maxsize=None)
+def activity_lut(activity_items):
+    """
+    Compile a dataset activity map and MAP_ACTIVITY into one integer lookup table
+    :param activity_items: sorted (dataset label, common activity name) pairs of an activity map
+    :return: read-only array mapping each dataset label to its common label, -1 for labels without one
+    """
+    lut = np.full(max([label for label, _ in activity_items] + [0]) + 1, -1, dtype=np.int64)
+    for label, activity in activity_items:
+        lut[label] = MAP_ACTIVITY.get(activity, -1)
+    lut.setflags(write=False)
+    return lut
+
+
+def cached(sub_folder):
+    """
+    Decorator storing the output of a LoadHAR loader on disk. The key is built from the loader name, every
+    LoadHAR option and the size and mtime of the files in sub_folder, so changing either triggers a reload.
+    Cached arrays are memory-mapped when reopened.
+    :param sub_folder: dataset folder relative to the root folder
+    """
+    def decorator(loader):
+        @functools.wraps(loader)
+        def wrapper(self):
+            if not self.cache:
+                return loader(self)
+
+            key = self.cache_key(loader.__name__, sub_folder)
+            path = os.path.join(self.cache_dir, '%s_%s' % (loader.__name__, key))
+            if os.path.isfile(os.path.join(path, 'meta.json')):
+                print("Loading cached %s from %s" % (loader.__name__, path))
+                return self.load_cache(path)
+
+            result = loader(self)
+            self.dump_cache(path, result)
+            return result
+        return wrapper
+    return decorator
+
+
+def segment(recordings, window, step, dtype=np.float32):
+    """
+    Segment continuous recordings into windows with overlap. The windows of each recording are counted first,
+    so the output is allocated once and every recording is copied into it exactly once.
+    :param recordings: list of arrays of shape (n_samples, n_channels)
+    :param window: window length in samples
+    :param step: step between windows in samples
+    :return: array of shape (n_windows, window, n_channels) and the number of windows per recording
+    """
+    window, step = int(window), int(step)
+    counts = np.asarray([n_windows(rec.shape[0], window, step) for rec in recordings], dtype=np.int64)
+    n_channels = recordings[0].shape[1] if len(recordings) > 0 else 0
+    windows = np.empty((counts.sum(), window, n_channels), dtype=dtype)
+
+    offset = 0
+    for rec, count in zip(recordings, counts):
+        if count > 0:
+            # rolling_window_lastaxis gives (n_channels, count, window) over the transposed recording
+            windows[offset:offset+count] = rolling_window_lastaxis(rec.T, window, step).transpose(1, 2, 0)
+        offset += count
+    return windows, counts
+
+
+def segment_labels(activities, window, step, policy='majority'):
+    """
+    Label the windows segment() extracts from the same recordings, working on strided views of the label columns
+    :param activities: list of per-sample integer label arrays
+    :param policy: 'majority' or 'centre' (cf. window_labels)
+    :return: label and label purity of every window
+    """
+    window, step = int(window), int(step)
+    counts = [n_windows(act.shape[0], window, step) for act in activities]
+    y = np.empty(sum(counts), dtype=np.int32)
+    purity = np.empty(sum(counts), dtype=np.float32)
+
+    offset = 0
+    for act, count in zip(activities, counts):
+        if count > 0:
+            view = rolling_window_lastaxis(np.asarray(act, dtype=np.int32), window, step)
+            y[offset:offset+count], purity[offset:offset+count] = window_labels(view, policy)
+        offset += count
+    return y, purity
+
+
+def gather(results):
+    """
+    Concatenate per-recording results into outputs allocated once. Each result is released as soon as it is copied,
+    so the results are not held twice, e.g. when gathering the windows of a streamed dataset.
+    :param results: list of tuples of per-window arrays, one tuple per recording, emptied by gather
+    :return: list of the concatenated arrays followed by the number of windows per recording
+    """
+    counts = np.asarray([len(res[0]) for res in results], dtype=np.int64)
+    n_fields = len(results[0])
+    datasets = [[] for _ in range(n_fields)]
+    out = []
+    for i in range(n_fields):
+        if isinstance(results[0][i], WindowDataset):
+            out.append(None)
+        else:
+            dtype = functools.reduce(np.promote_types, [res[i].dtype for res in results])
+            out.append(np.empty((counts.sum(),) + results[0][i].shape[1:], dtype=dtype))
+
+    offset = 0
+    results.reverse()
+    for count in counts:
+        res = results.pop()
+        for i, field in enumerate(res):
+            if isinstance(field, WindowDataset):
+                datasets[i].append(field)
+            else:
+                out[i][offset:offset+count] = field
+        offset += count
+    for i in range(n_fields):
+        if len(datasets[i]) > 0:
+            out[i] = WindowDataset.concatenate(datasets[i])
+    return out + [counts]
+
+
+def read_columns(path, columns, chunk_size=CHUNK_SIZE):
+    """
+    Read selected columns of a whitespace separated text file in chunks of chunk_size rows, so the other columns
+    are never held in memory
+    :param path: text file without header
+    :param columns: column indices to read
+    :return: float32 array of dim n_rows x len(columns), in the order of columns
+    """
+    chunks = [chunk[columns].values.astype(np.float32)
+              for chunk in pd.read_csv(path, sep=r'\s+', header=None, usecols=columns, chunksize=chunk_size)]
+    if len(chunks) == 0:
+        return np.empty((0, len(columns)), dtype=np.float32)
+    return np.concatenate(chunks)
+
+
+def fill_missing(signal):
+    """
+    Linearly interpolate missing samples (NaN) of each channel, holding the first and last valid sample at the ends
+    :param signal: array of dim n_samples x channels, modified in place
+    :return: signal
+    """
+    idx = np.arange(signal.shape[0])
+    for channel in range(signal.shape[1]):
+        missing = np.isnan(signal[:, channel])
+        if missing.any() and not missing.all():
+            signal[missing, channel] = np.interp(idx[missing], idx[~missing], signal[~missing, channel])
+    return signal
+
+
 class LoadHAR(object):
     def __init__(self, root_folder=ROOT_FOLDER, add_pitch=False, add_roll=False, expand=False,
                  add_filter=False, n_samples=200, step=200, normalize='channels', comp_magnitude=False,
-                 simple_labels=False, common_labels=True, lowpass=None, diff=False):
+                 simple_labels=False, common_labels=True, lowpass=None, diff=False, resample_mode='fft',
+                 resample_first=False, label_policy=None, min_purity=None, filter_first=False, lazy=False,
+                 users=None, n_jobs=1, cache=False, cache_dir=None):
         self.root_folder = root_folder
         if root_folder is None:
             raise RuntimeError('Invalid folder')
         self.name = ""
+        self.cache = cache
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(root_folder, 'cache')
 
         self.add_pitch = add_pitch
         self.add_roll = add_roll
@@ -51,7 +238,19 @@ class LoadHAR(object):
         self.common_labels = common_labels
         self.lowpass = lowpass
         self.differentiate = diff
-
+        self.resample_mode = resample_mode
+        self.resample_first = resample_first
+        self.label_policy = label_policy
+        self.min_purity = min_purity
+        self.filter_first = filter_first
+        self.lazy = lazy
+        # Only load the recordings of these user ids, e.g. newly collected subjects, or all users if None
+        self.users = None if users is None else sorted(users)
+        self.n_jobs = n_jobs
+        # Fitted ChannelNormaliser of each loaded dataset by name
+        self.normalisers = {}
+
+    @cached('UCI/HAPT Data Set/RawData/')
     def uci_hapt(self):
         """
         Sampling rate = 50
@@ -88,77 +287,22 @@ class LoadHAR(object):
 
         # Extract signals from the files and split them into segments. UCI HAR V1 uses 128 window length with
         # a step size of 64
-        data_array = np.empty((0, self.n_samples, 3))
-        y = np.empty((0))
-        users = np.empty((0))
-
-        # for exp, user in labels[['exp', 'user']].drop_duplicates().values:
-        #     print("Loading %s" % self.root_folder + subfolder + 'acc_exp%02d_user%02d.txt' % (exp, user))
-        #     values = pd.read_csv(self.root_folder + subfolder + 'acc_exp%02d_user%02d.txt' % (exp, user), sep=' ').values
-        #     idx = ((labels['exp']==exp) & (labels['user']==user))
-        #
-        #     for activity, start, end in labels[['activity', 'start', 'end']][idx].values:
-        #         segment = values[start:end]
-        #
-        #         # Pad a segment to a multiple of n_samples
-        #         if segment.shape[0] <= self.n_samples:
-        #             pad_width = int(np.ceil(segment.shape[0]/float(self.n_samples))*self.n_samples - segment.shape[0])
-        #             segment = np.pad(segment, ((0, pad_width), (0, 0)), 'edge').reshape(1, self.n_samples, 3)
-        #
-        #         # Segment with a rolling window allowing overlap
-        #         else:
-        #             try:
-        #                 segment = rolling_window(segment, (self.n_samples, 0), self.step).swapaxes(1, 2)
-        #             except ValueError, e:
-        #                 print(e)
-        #                 print(segment.shape)
-        #
-        #         # Collect data
-        #         data_array = np.concatenate((data_array, segment))
-        #         y = np.concatenate((y, [activity]*segment.shape[0]))
-        #         users = np.concatenate((users, [(user)]*segment.shape[0]))
+        recordings = []
         for exp, user in labels[['exp', 'user']].drop_duplicates().values:
-            print("Loading %s" % self.root_folder + subfolder + 'acc_exp%02d_user%02d.txt' % (exp, user))
-            df = pd.read_csv(self.root_folder + subfolder + 'acc_exp%02d_user%02d.txt' % (exp, user), sep=' ')
+            if not self.selected(user):
+                continue
             idx = ((labels['exp']==exp) & (labels['user']==user))
+            recordings.append((exp, user, labels[['activity', 'start', 'end']][idx].values))
 
-            values = df.values
-            activities = np.zeros((values.shape[0], 1))
-            for activity, start, end in labels[['activity', 'start', 'end']][idx].values:
-                activities[start:end] = activity
-
-            values = np.concatenate((values, activities), axis=1)
-
-            # Segment into windows with overlap
-            segmented = rolling_window(values, (self.n_samples, 0), self.step).swapaxes(1, 2)
-
-            # Find y label
-            # t = []
-            # for idx in range(segmented.shape[0]):
-                # t.append(segmented[idx, -1, -1].astype('int'))
-            t_idx = int(self.n_samples/2)
-            t = np.asarray(segmented[:, t_idx, -1]).astype('int')
-
-            # Remove samples without label
-            # idx = t != 0
-            # segmented = segmented[idx]
-            # t = t[idx]
-
-            # Collect data
-            y = np.concatenate((y, t))
-            data_array = np.concatenate((data_array, segmented[:, :, :-1]))
-            users = np.concatenate((users, [(user)]*len(t)))
+        data_array, y, purity, counts = self.ingest(self.read_hapt_recording, recordings)
+        users = np.repeat([user for _, user, _ in recordings], counts)
+        data_array, y, users = self.filter_purity(purity, data_array, y, users)
 
         if self.expand:
             y = expand_target(y, data_array.shape[1])
 
         # Add features to data
-        data_array, stats = self.add_features(data_array,
-                                              normalise=self.normalize,
-                                              add_roll=self.add_roll,
-                                              add_pitch=self.add_pitch,
-                                              add_filter=self.add_filter,
-                                              comp_magnitude=self.comp_magnitude)
+        data_array, stats = self.window_features(data_array)
 
         # Convert to common labels
         if self.common_labels:
@@ -167,8 +311,9 @@ class LoadHAR(object):
             # y = y - 1
             pass
 
-        return data_array, y.astype('int'), self.name, users, stats
+        return data_array, y.astype(LABEL_DTYPE), self.name, users.astype(USER_DTYPE), stats
 
+    @cached('UCI/UCI HAR Dataset v1/')
     def uci_har_v1(self):
         """
         Data from Ortiz
@@ -196,20 +341,23 @@ class LoadHAR(object):
         for mfile in train_files:
             print(mfile)
 
-        data = dict()
-        data['x_test'] = pd.read_csv(test_files[0], sep=r'\s+').values
-        for i in range(1, len(test_files)):
-            data['x_test'] = np.dstack((data['x_test'], pd.read_csv(test_files[i], sep=r'\s+').values))
-
-        data['x_train'] = pd.read_csv(train_files[0], sep=r'\s+').values
-        for i in range(1, len(train_files)):
-            data['x_train'] = np.dstack((data['x_train'], pd.read_csv(train_files[i], sep=r'\s+').values))
-
-        data['y_train'] = (pd.read_csv(train_folder + 'y_train.txt', squeeze=True).values - 1)
-        data['y_test'] = (pd.read_csv(test_folder + 'y_test.txt', squeeze=True).values - 1)
-
-        users = pd.read_csv(train_folder + 'subject_train.txt', squeeze=True).values
-        users = np.concatenate((users, pd.read_csv(test_folder + 'subject_test.txt', squeeze=True).values))
+        # Fill the windows of all axes and both splits into one array, training windows first
+        signals = [[cached_read_csv(mfile, sep=r'\s+') for mfile in files] for files in (train_files, test_files)]
+        n_windows = sum(split[0].shape[0] for split in signals)
+        data = np.empty((n_windows, signals[0][0].shape[1], len(train_files)), dtype=np.float32)
+        offset = 0
+        for split in signals:
+            for axis, values in enumerate(split):
+                data[offset:offset+values.shape[0], :, axis] = values
+            offset += split[0].shape[0]
+
+        y = np.concatenate((cached_read_csv(train_folder + 'y_train.txt')[:, 0],
+                            cached_read_csv(test_folder + 'y_test.txt')[:, 0])) - 1
+        users = np.concatenate((cached_read_csv(train_folder + 'subject_train.txt')[:, 0],
+                                cached_read_csv(test_folder + 'subject_test.txt')[:, 0]))
+        if self.users is not None:
+            idx = np.isin(users, self.users)
+            data, y, users = data[idx], y[idx], users[idx]
 
         # Load precomputed features
         # features = pd.read_csv(self.root_folder + sub_folder + "/features.txt", header=None, sep=";", names=['features'], squeeze=True).str.strip()
@@ -217,9 +365,6 @@ class LoadHAR(object):
         # data['x_test_features'] = pd.read_csv(test_folder + 'X_test.txt', sep=r'\s+', names=features)[features_filt].values
         # data['x_train_features'] = pd.read_csv(train_folder + 'X_train.txt', sep=r'\s+', names=features)[features_filt].values
 
-        data = np.concatenate((data['x_train'], data['x_test']), axis=0)
-        y = np.concatenate((data['y_train'], data['y_test']), axis=0)
-
         data_array, stats = self.add_features(data,
                                                normalise=self.normalize,
                                                add_roll=self.add_roll,
@@ -230,8 +375,9 @@ class LoadHAR(object):
         y = self.map_to_common_activities(y, activity_map)
 
         # np.savez('data/uci_har_v1_theia.npz', x_train=data['x_train'], y_train=data['y_train'], x_test=data['x_test'], y_test=data['y_test'])
-        return data_array, y.astype('int'), self.name, users, stats
+        return data_array, y.astype(LABEL_DTYPE), self.name, users.astype(USER_DTYPE), stats
 
+    @cached('WISDM/Lab/')
     def wisdm1(self):
         """
         Sampling rate: 20hz
@@ -240,43 +386,9 @@ class LoadHAR(object):
         :return: shared tuple of data
         """
         self.name = "WISDM1"
-        sub_folder = 'WISDM/Lab/'
-        filename = 'WISDM_ar_v1.1_raw.txt'
-        columns = ['user','labels','timestamp','x','y','z']
-        dtypes = {'user': np.int32,'labels': np.str,'timestamp': np.float64,'x': np.float32,'y': np.float32,'z': np.float32}
-        df = pd.read_csv(self.root_folder + sub_folder + filename, names=columns, lineterminator=';', dtype=dtypes)
-        df = df.dropna()
-        activity_map = {'Walking': 'WALKING', 'Upstairs': 'STAIRS', 'Stairs': 'STAIRS', 'Downstairs': 'STAIRS',
-                        'Sitting': 'INACTIVE', 'Standing': 'INACTIVE', 'LyingDown': 'INACTIVE', 'Jogging': 'JOGGING'}
-        df['labels'] = df['labels'].apply(activity_map.get)
-        df['labels'] = df['labels'].apply(MAP_ACTIVITY.get)
-        sr = 20.
-
-        tmp = np.empty((0, 5))
-        for user in df['user'].unique():
-            tmp = np.concatenate((tmp, df[['x', 'y', 'z','labels','user']][df['user'] == user].values), axis=0)
-
-        # window samples into the equivalent of n_samples at 50 Hz.
-        tmp = rolling_window(tmp, window=(self.n_samples * sr/SR, 0), step=self.step * sr/SR).swapaxes(1, 2)
-        n_windows, sequence_length, _ = tmp.shape
-        y = np.zeros(n_windows)
-        users = np.zeros(n_windows)
-        data_array = np.empty((n_windows, self.n_samples, 3))
-        for idx in range(n_windows):
-            y[idx] = np.argmax(np.bincount(tmp[idx, :, -2].astype('int')))
-            users[idx] = np.argmax(np.bincount(tmp[idx, :, -1].astype('int')))
-            for f in range(3):
-                data_array[idx, :, f] = resample(tmp[idx, :, f], self.n_samples)
-
-        data_array, stats = self.add_features(data_array,
-                                       normalise=self.normalize,
-                                       ratio=0,
-                                       add_roll=self.add_roll,
-                                       add_pitch=self.add_pitch,
-                                       add_filter=self.add_filter,
-                                       comp_magnitude=self.comp_magnitude)
-        return data_array, y.astype('int'), self.name, users, stats
+        return self.wisdm('WISDM/Lab/', 'WISDM_ar_v1.1_raw.txt')
 
+    @cached('WISDM/Real/')
     def wisdm2(self):
         """
         Sampling rate: 20hz
@@ -284,43 +396,35 @@ class LoadHAR(object):
         :return: tuple of data
         """
         self.name = "WISDM2"
-        sub_folder = 'WISDM/Real/'
-        filename = 'WISDM_at_v2.0_raw.txt'
-        columns = ['user','labels','timestamp','x','y','z']
-        dtypes = {'user': np.int32,'labels': np.str,'timestamp': np.float64,'x': np.float32,'y': np.float32,'z': np.float32}
-        df = pd.read_csv(self.root_folder + sub_folder + filename, names=columns, lineterminator=';', dtype=dtypes)
-        df = df.dropna()
+        return self.wisdm('WISDM/Real/', 'WISDM_at_v2.0_raw.txt')
+
+    def wisdm(self, sub_folder, filename):
+        """
+        Shared loader for the WISDM datasets. Windows are extracted per user, so no window spans two users.
+        :param sub_folder: dataset folder relative to the root folder
+        :param filename: raw accelerometer file
+        :return: tuple of data
+        """
         activity_map = {'Walking': 'WALKING', 'Upstairs': 'STAIRS', 'Stairs': 'STAIRS', 'Downstairs': 'STAIRS',
                         'Sitting': 'INACTIVE', 'Standing': 'INACTIVE', 'LyingDown': 'INACTIVE', 'Jogging': 'JOGGING'}
-        df['labels'] = df['labels'].apply(activity_map.get)
-        df['labels'] = df['labels'].apply(MAP_ACTIVITY.get)
         sr = 20.
 
-        tmp = np.empty((0, 5))
-        for user in df['user'].unique():
-            tmp = np.concatenate((tmp, df[['x', 'y', 'z','labels','user']][df['user'] == user].values), axis=0)
-
-        # window samples into the equivalent of n_samples at 50 Hz.
-        tmp = rolling_window(tmp, window=(self.n_samples * sr/SR, 0), step=self.step * sr/SR).swapaxes(1, 2)
-        n_windows, sequence_length, n_features = tmp.shape
-        y = np.zeros(n_windows)
-        users = np.zeros(n_windows)
-        data_array = np.empty((n_windows, self.n_samples, 3))
-        for idx in range(n_windows):
-            y[idx] = np.argmax(np.bincount(tmp[idx, :, -2].astype('int')))
-            users[idx] = np.argmax(np.bincount(tmp[idx, :, -1].astype('int')))
-            for f in range(3):
-                data_array[idx, :, f] = resample(tmp[idx, :, f], self.n_samples)
-
-        data_array = self.add_features(data_array,
-                                       normalise=self.normalize,
-                                       ratio=0,
-                                       add_roll=self.add_roll,
-                                       add_pitch=self.add_pitch,
-                                       add_filter=self.add_filter,
-                                       comp_magnitude=self.comp_magnitude)
-        return data_array, y.astype('int'), self.name, users
+        # Window each user as soon as its rows end, so only one user's signal is held at a time. gather releases the
+        # windows of each user as it copies them, so the windows are not held twice either
+        results = []
+        user_ids = []
+        for user, signal, activity in self.stream_wisdm(self.root_folder + sub_folder + filename, activity_map):
+            results.append(self.segment_resampled([signal], [activity], sr)[:3])
+            user_ids.append(user)
+
+        data_array, y, purity, counts = gather(results)
+        users = np.repeat(user_ids, counts)
+        data_array, y, users = self.filter_purity(purity, data_array, y, users)
 
+        data_array, stats = self.window_features(data_array)
+        return data_array, y.astype(LABEL_DTYPE), self.name, users.astype(USER_DTYPE), stats
+
+    @cached('UCI/mHealth/')
     def uci_mhealth(self):
         '''
         #Activities: 12
@@ -347,38 +451,17 @@ class LoadHAR(object):
         activity_map = {0: 'NULL', 1: 'INACTIVE', 2: 'INACTIVE', 3: 'INACTIVE', 4: 'WALKING', 5: 'STAIRS', 6: 'BEND_FORWARD',
                         7: 'ARM_ELEVATION', 8: 'KNEE_BEND', 9: 'CYCLING', 10: 'JOGGING', 11: 'RUNNING', 12: 'JUMP'}
 
-        # Load the first subject and then the rest iteratively
-        data = pd.read_csv(self.root_folder + sub_folder + 'mHealth_subject%d.log' % 1,
-                          sep='\t',
-                          usecols=[0, 1, 2, 23],
-                          names=['x', 'y', 'z', 'labels'])
-
-        data_array = rolling_window(data.values, window=(self.n_samples, 0), step=self.step).swapaxes(1, 2)
-        users = np.ones((data_array.shape[0])) * 1
-        for idx in range(2, 11):
-            tmp = pd.read_csv(self.root_folder + sub_folder + 'mHealth_subject%d.log' % idx,
-                                              sep='\t',
-                                              usecols=[0, 1, 2, 23],
-                                              names=['x', 'y', 'z', 'label']).values
-            tmp = rolling_window(tmp, window=(self.n_samples, 0), step=self.step).swapaxes(1, 2)
-            data_array = np.concatenate((data_array, tmp))
-            users = np.concatenate((users, idx*np.ones(tmp.shape[0])))
-
-        y = np.empty(users.shape)
-        for idx in range(users.shape[0]):
-            y[idx] = np.argmax(np.bincount(data_array[idx, :, -1].astype('int')))
-        data_array = data_array[:, :, :3]
-
-        data_array, stats = self.add_features(data_array,
-                                       normalise=self.normalize,
-                                       ratio=0,
-                                       add_roll=self.add_roll,
-                                       add_pitch=self.add_pitch,
-                                       add_filter=self.add_filter,
-                                       comp_magnitude=self.comp_magnitude)
+        # Load all subjects and segment them in one pass
+        user_ids = [user for user in range(1, 11) if self.selected(user)]
+        data_array, y, purity, counts = self.ingest(self.read_mhealth_subject, user_ids)
+        users = np.repeat(user_ids, counts)
+        data_array, y, users = self.filter_purity(purity, data_array, y, users)
+
+        data_array, stats = self.window_features(data_array)
         y = self.map_to_common_activities(y, activity_map)
-        return data_array, y.astype('int'), self.name, users, stats
+        return data_array, y.astype(LABEL_DTYPE), self.name, users.astype(USER_DTYPE), stats
 
+    @cached('Physical Activity Sensor Data-Public/Public/iDASH_activity_dataset/')
     def idash(self):
         """
         This dataset contains motion sensor data of 16 physical activities
@@ -410,38 +493,21 @@ class LoadHAR(object):
                         14: 'WALKING', 15: 'WALKING'}
 
         # Load data
-        subjects = list(range(1, 17))
-        cols = [0, 1, 2]
-        tmp_seg = np.empty((0, self.n_samples * sr/SR, len(cols)))
-        y = []
-        users = []
+        subjects = [subject for subject in range(1, 17) if self.selected(subject)]
+        recordings = []
         for subject in subjects:
             files = sorted(glob.glob(self.root_folder + sub_folder + '%d/*' % subject))
             for idx, csv_file in enumerate(files):
                 if not "blank" in csv_file:
-                    tmp = pd.read_csv(csv_file, sep=',', usecols=cols).values
-                    tmp = rolling_window(tmp, window=(self.n_samples * sr/SR, 0), step=self.step * sr/SR).swapaxes(1, 2)
-                    tmp_seg = np.vstack((tmp_seg, tmp))
-                    y.append(np.ones((tmp.shape[0],), dtype=np.int)*idx)
-                    users.append(np.ones((tmp.shape[0],), dtype=np.int)*subject)
-
-        users = np.asarray(list(itertools.chain.from_iterable(users)))
-        y = list(itertools.chain.from_iterable(y))
-
-        n_windows, sequence_length, n_features = tmp_seg.shape
-        data_array = np.empty((n_windows, self.n_samples, n_features))
-        for idx in range(n_windows):
-            for f in range(n_features):
-                data_array[idx, :, f] = resample(tmp_seg[idx, :, f], self.n_samples)
-
-        data_array, stats = self.add_features(data_array,
-                                       normalise=self.normalize,
-                                       add_roll=self.add_roll,
-                                       add_pitch=self.add_pitch,
-                                       add_filter=self.add_filter,
-                                       comp_magnitude=self.comp_magnitude)
+                    recordings.append((subject, idx, csv_file))
+
+        data_array, counts = self.ingest(self.read_idash_recording, recordings)
+        users = np.repeat([subject for subject, _, _ in recordings], counts)
+        y = np.repeat([idx for _, idx, _ in recordings], counts)
+
+        data_array, stats = self.window_features(data_array)
         y = self.map_to_common_activities(y, activity_map)
-        return data_array, y.astype('int'), self.name, users, stats
+        return data_array, y.astype(LABEL_DTYPE), self.name, users.astype(USER_DTYPE), stats
 
     def nursing(self):
         sub_folder = 'sosolab/Nursing/'
@@ -456,26 +522,96 @@ class LoadHAR(object):
         for mat_file in sorted(glob.glob(self.root_folder + sub_folder + 'dataset/activity/*.mat')):
             pass
 
+    @cached('ETH/SkodaMiniCP/')
     def skoda(self):
         """
-        dataset_xx[axis][class][instance] is a vector with calibrated acceleration
-        data; length of vector is gesture length dependent and varies with
-        class number and instance number.
-        output: 64x13
+        Skoda mini checkpoint, one subject performing 10 car maintenance gestures, recorded with 10 acceleration
+        sensors on the right arm at 98 Hz. The first sensor is used.
+        #Activities: 10 gestures and null
+        #Subjects: 1
         """
-        RuntimeError('Not implemented')
         sub_folder = 'ETH/SkodaMiniCP/'
-        data = loadmat(self.root_folder + sub_folder + 'right_classall_clean', squeeze_me=True)['right_classall_clean']
-        return data
+        self.name = "Skoda"
+        activity_map = {32: 'NULL', 33: 'WRITE_ON_NOTEPAD', 34: 'OPEN_HOOD', 35: 'CLOSE_HOOD',
+                        36: 'CHECK_GAPS_FRONT_DOOR', 37: 'OPEN_LEFT_FRONT_DOOR', 38: 'CLOSE_LEFT_FRONT_DOOR',
+                        39: 'CLOSE_BOTH_LEFT_DOORS', 40: 'CHECK_TRUNK_GAPS', 41: 'OPEN_CLOSE_TRUNK',
+                        42: 'CHECK_STEERING_WHEEL'}
+        sr = 98.
+
+        # Each row holds the label followed by sensor id, raw x, y, z and calibrated x, y, z of each sensor
+        data = loadmat(self.root_folder + sub_folder + 'right_classall_clean.mat',
+                       variable_names=['right_classall_clean'])['right_classall_clean']
+        signal = fill_missing(data[:, 5:8].astype(np.float32))
+        activity = data[:, 0].astype(np.int32)
+        del data
+
+        data_array, y, purity, counts = self.segment_resampled([signal], [activity], sr)
+        users = np.ones(len(y), dtype=USER_DTYPE)
+        data_array, y, users = self.filter_purity(purity, data_array, y, users)
+        data_array, y, users = self.known_activities(y, activity_map, data_array, y, users)
+
+        data_array, stats = self.window_features(data_array)
+        if self.common_labels:
+            y = self.map_to_common_activities(y, activity_map)
+        return data_array, y.astype(LABEL_DTYPE), self.name, users.astype(USER_DTYPE), stats
 
+    @cached('UCI/Opportunity/dataset/')
     def opportunity(self):
-        RuntimeError('Not implementet')
+        """
+        OPPORTUNITY activity recognition, 4 subjects with 5 daily living runs and one drill run each, recorded at
+        30 Hz. The accelerometer of the back IMU (in milli g) and the locomotion labels are used.
+        #Activities: 4 locomotion modes and null
+        #Subjects: 4
+        """
         sub_folder = 'UCI/Opportunity/dataset/'
-        pass
+        self.name = "OPPORTUNITY"
+        activity_map = {0: 'NULL', 1: 'INACTIVE', 2: 'WALKING', 4: 'INACTIVE', 5: 'INACTIVE'}
 
+        recordings = []
+        for path in sorted(glob.glob(self.root_folder + sub_folder + 'S*-*.dat')):
+            subject = int(os.path.basename(path)[1:].split('-')[0])
+            if self.selected(subject):
+                recordings.append((subject, path))
+
+        data_array, y, purity, counts = self.ingest(self.read_opportunity_recording, recordings)
+        users = np.repeat([subject for subject, _ in recordings], counts)
+        data_array, y, users = self.filter_purity(purity, data_array, y, users)
+        data_array, y, users = self.known_activities(y, activity_map, data_array, y, users)
+
+        data_array, stats = self.window_features(data_array)
+        if self.common_labels:
+            y = self.map_to_common_activities(y, activity_map)
+        return data_array, y.astype(LABEL_DTYPE), self.name, users.astype(USER_DTYPE), stats
+
+    @cached('UCI/PAMAP2_Dataset/Protocol/')
     def pamap2(self):
-        RuntimeError('Not implementet')
-        pass
+        """
+        PAMAP2 physical activity monitoring, 9 subjects following a protocol of 12 activities, recorded at 100 Hz.
+        The 16 g accelerometer of the chest IMU (in m/s^2) is used. Transient periods and activities without a
+        common activity are dropped.
+        #Activities: 12
+        #Subjects: 9
+        """
+        sub_folder = 'UCI/PAMAP2_Dataset/Protocol/'
+        self.name = "PAMAP2"
+        activity_map = {1: 'INACTIVE', 2: 'INACTIVE', 3: 'INACTIVE', 4: 'WALKING', 5: 'RUNNING', 6: 'CYCLING',
+                        7: 'WALKING', 12: 'STAIRS', 13: 'STAIRS', 24: 'JUMP'}
+
+        recordings = []
+        for path in sorted(glob.glob(self.root_folder + sub_folder + 'subject1*.dat')):
+            subject = int(os.path.basename(path)[len('subject'):-len('.dat')]) - 100
+            if self.selected(subject):
+                recordings.append((subject, path))
+
+        data_array, y, purity, counts = self.ingest(self.read_pamap2_recording, recordings)
+        users = np.repeat([subject for subject, _ in recordings], counts)
+        data_array, y, users = self.filter_purity(purity, data_array, y, users)
+        data_array, y, users = self.known_activities(y, activity_map, data_array, y, users)
+
+        data_array, stats = self.window_features(data_array)
+        if self.common_labels:
+            y = self.map_to_common_activities(y, activity_map)
+        return data_array, y.astype(LABEL_DTYPE), self.name, users.astype(USER_DTYPE), stats
 
     def mhealth_maninni(self):
         """
@@ -489,87 +625,388 @@ class LoadHAR(object):
         activities = data['FeatureNames']
         X = data['Data_m']
 
-    def map_to_common_activities(self, y, activity_map):
-        return np.asarray([MAP_ACTIVITY.get(activity_map.get(l)) for l in y]).astype('int')
+    def cache_key(self, loader_name, sub_folder):
+        """
+        Hash the loader name, the LoadHAR options and the source files of a dataset
+        :return: hex digest used as cache folder suffix
+        """
+        options = dict((k, v) for k, v in vars(self).items() if k not in CACHE_EXCLUDE)
+        key = repr((loader_name, sorted(options.items()), source_files(self.root_folder + sub_folder)))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
 
-    def add_features(self, data, normalise='channels', ratio=0, add_roll=False, add_pitch=False, add_filter=False, comp_magnitude=False):
-        n_win, n_samp, n_dim = data.shape
-        stats = []
+    def dump_cache(self, path, result):
+        """
+        Write the output of a loader to the cache. A cache folder that cannot be written, e.g. on a read-only data
+        root, only disables caching.
+        """
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        try:
+            self._dump_cache(tmp_path, result)
+        except (IOError, OSError) as e:
+            print("Not caching to %s: %s" % (path, e))
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        # Rename in one step so an interrupted or concurrent run never leaves a partial cache behind
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _dump_cache(self, tmp_path, result):
+        data_array, y, name, users, stats = result
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+        meta = {'name': name}
+        if name in self.normalisers:
+            meta['normaliser'] = self.normalisers[name].state()
+        if isinstance(data_array, WindowDataset):
+            # Store the continuous signal and window offsets instead of materialised windows
+            for field in WINDOW_FIELDS:
+                np.save(os.path.join(tmp_path, field + '.npy'), getattr(data_array, field))
+            meta['window'] = data_array.window
+            data_array = np.empty(0)
+        for field, values in zip(CACHE_FIELDS, (data_array, y, users, stats)):
+            np.save(os.path.join(tmp_path, field + '.npy'), np.asarray(values))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def load_cache(self, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.name = meta['name']
+        if 'normaliser' in meta:
+            self.normalisers[self.name] = ChannelNormaliser.from_state(meta['normaliser'])
+        data_array, y, users, stats = [np.load(os.path.join(path, field + '.npy'), mmap_mode='r')
+                                       for field in CACHE_FIELDS]
+        if 'window' in meta:
+            data_array = WindowDataset(*[np.load(os.path.join(path, field + '.npy'), mmap_mode='r')
+                                         for field in WINDOW_FIELDS], window=meta['window'])
+        return data_array, y, self.name, users, stats
+
+    def selected(self, user):
+        return self.users is None or user in self.users
+
+    def ingest(self, read_recording, recordings):
+        """
+        Read, label and window every recording, in a pool of n_jobs processes if n_jobs > 1. The results are
+        gathered in the order of recordings, so the output does not depend on n_jobs.
+        :param read_recording: method taking one item of recordings and returning a tuple of per-window arrays
+        :param recordings: list of items identifying the recordings
+        :return: the concatenated per-window arrays and the number of windows per recording
+        """
+        if self.n_jobs > 1:
+            pool = Pool(self.n_jobs)
+            try:
+                results = pool.map(read_recording, recordings)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [read_recording(rec) for rec in recordings]
 
-        if self.lowpass:
-            data = lowpass_filter(data, fs=50, cutoff=self.lowpass)
+        return gather(results)
 
-        if ratio > 1:
-            pass
+    def read_hapt_recording(self, recording):
+        """
+        Read and window one UCI HAPT experiment
+        :param recording: tuple of experiment, user and the (activity, start, end) rows of its labels
+        :return: windows, labels and label purity
+        """
+        exp, user, activity_labels = recording
+        subfolder = 'UCI/HAPT Data Set/RawData/'
+        print("Loading %s" % self.root_folder + subfolder + 'acc_exp%02d_user%02d.txt' % (exp, user))
+        values = pd.read_csv(self.root_folder + subfolder + 'acc_exp%02d_user%02d.txt' % (exp, user), sep=' ').values
+        activity = np.zeros(values.shape[0], dtype=np.int32)
+        for act, start, end in activity_labels:
+            activity[start:end] = act
 
-        if add_pitch:
-            pitches = []
-            for i in range(n_win):
-                pitches.append(pitch(data[i]))
+        # Segment into windows with overlap
+        data_array = self.windows(self.continuous_features([values]))
 
-        if add_roll:
-            rolls = []
-            for i in range(n_win):
-                rolls.append(roll(data[i,:,:n_dim]))
+        # Find y label, by default the label of the centre sample
+        y, purity = segment_labels([activity], self.n_samples, self.step, policy=self.label_policy or 'centre')
+        return data_array, y, purity
 
-        if comp_magnitude:
-            data = magnitude(data).reshape((n_win, n_samp, 1))
+    def read_mhealth_subject(self, subject):
+        """
+        Read and window the log of one UCI mHealth subject
+        :return: windows, labels and label purity
+        """
+        sub_folder = 'UCI/mHealth/'
+        values = pd.read_csv(self.root_folder + sub_folder + 'mHealth_subject%d.log' % subject,
+                             sep='\t',
+                             usecols=[0, 1, 2, 23],
+                             names=['x', 'y', 'z', 'labels']).values
+        data_array = self.windows(self.continuous_features([values[:, :3]]))
+        y, purity = segment_labels([values[:, 3].astype(np.int32)], self.n_samples, self.step,
+                                   policy=self.label_policy or 'majority')
+        return data_array, y, purity
+
+    def read_idash_recording(self, recording):
+        """
+        Read, window and resample one iDASH activity file
+        :param recording: tuple of subject, activity index and file path
+        :return: windows at SR
+        """
+        subject, idx, csv_file = recording
+        sr = 30.
+        cols = [0, 1, 2]
+        values = pd.read_csv(csv_file, sep=',', usecols=cols).values
+        return (self.segment_resampled([values], None, sr)[0], )
 
-        if add_filter:
-            enrich_fs = 50
-            tmp_lp = split_signal(data, enrich_fs)
-            # tmp_hp = data - tmp_lp
+    def read_opportunity_recording(self, recording):
+        """
+        Read and window one OPPORTUNITY run, only parsing the back IMU accelerometer and the locomotion label
+        :param recording: tuple of subject and file path
+        :return: windows at SR, labels and label purity
+        """
+        subject, path = recording
+        sr = 30.
+        values = read_columns(path, [37, 38, 39, 243])
+        signal = fill_missing(values[:, :3]) / 1000.
+        return self.segment_resampled([signal], [values[:, 3].astype(np.int32)], sr)[:3]
 
-        # Concat everything
-        if add_roll: data = np.concatenate((data, rolls), axis=2)
-        if add_pitch: data = np.concatenate((data, pitches), axis=2)
-        if add_filter: data = np.concatenate((data, tmp_lp), axis=2)
+    def read_pamap2_recording(self, recording):
+        """
+        Read and window one PAMAP2 subject, only parsing the activity and the chest accelerometer
+        :param recording: tuple of subject and file path
+        :return: windows at SR, labels and label purity
+        """
+        subject, path = recording
+        sr = 100.
+        values = read_columns(path, [21, 22, 23, 1])
+        signal = fill_missing(values[:, :3])
+        return self.segment_resampled([signal], [values[:, 3].astype(np.int32)], sr)[:3]
 
-        if self.differentiate:
-            n_win, n_samp, n_dim = data.shape
-            data_diff = np.concatenate((np.zeros((1, n_dim)), np.diff(data.reshape(-1, n_dim), axis=0)), axis=0)
-            data = data_diff.reshape(n_win, n_samp, n_dim)
+    def stream_wisdm(self, path, activity_map):
+        """
+        Parse a WISDM raw file in chunks of CHUNK_SIZE rows and emit the rows of a user as soon as they end. The
+        files are grouped by user, so only one user is buffered at a time. Rows with missing values or unknown
+        activities are dropped.
+        :param path: raw accelerometer file
+        :param activity_map: map from WISDM activity names to common activity names
+        :return: generator of (user, float32 signal of shape (n_samples, 3), int32 labels) per run of consecutive
+        rows of a user, in file order
+        """
+        columns = ['user','labels','timestamp','x','y','z']
+        # Users are parsed as strings, as the newline after every ';' starts the next user field and the file ends
+        # with a row holding only that newline
+        dtypes = {'user': str,'labels': str,'timestamp': np.float64,'x': np.float32,'y': np.float32,'z': np.float32}
+        label_map = dict((k, MAP_ACTIVITY[v]) for k, v in activity_map.items())
+
+        user, signals, activities = None, [], []
+        for chunk in pd.read_csv(path, names=columns, lineterminator=';', dtype=dtypes, chunksize=CHUNK_SIZE):
+            chunk = chunk.dropna()
+            chunk_labels = chunk['labels'].map(label_map)
+            chunk_users = chunk['user'].astype(np.int32).values
+            known = chunk_labels.notnull().values
+            if self.users is not None:
+                known = known & np.isin(chunk_users, self.users)
+            chunk_users = chunk_users[known]
+            if len(chunk_users) == 0:
+                continue
+            chunk_signal = chunk[['x', 'y', 'z']].values[known].astype(np.float32)
+            chunk_labels = chunk_labels.values[known].astype(np.int32)
+
+            # Split the chunk where the user changes
+            starts = np.flatnonzero(np.diff(chunk_users)) + 1
+            for run_users, run_signal, run_labels in zip(np.split(chunk_users, starts), np.split(chunk_signal, starts),
+                                                         np.split(chunk_labels, starts)):
+                if run_users[0] != user:
+                    if user is not None:
+                        yield user, np.concatenate(signals), np.concatenate(activities)
+                    user, signals, activities = run_users[0], [], []
+                signals.append(run_signal)
+                activities.append(run_labels)
+
+        if user is not None:
+            yield user, np.concatenate(signals), np.concatenate(activities)
+
+    def segment_resampled(self, recordings, activities, sr):
+        """
+        Segment recordings sampled at sr into windows of n_samples at SR. Either each continuous recording is
+        resampled once before windowing (resample_first, implied by filter_first, lazy and the polyphase mode), or
+        all windows are Fourier resampled in one batched call.
+        :param recordings: list of arrays of shape (n_samples, n_channels) sampled at sr
+        :param activities: list of per-sample label arrays or None
+        :return: windows at SR, window labels and label purity (None if no activities are given) and windows per
+        recording
+        """
+        if self.resample_first or self.filter_first or self.lazy or self.resample_mode != 'fft':
+            resampled = [resample_signal(rec, sr, SR, self.resample_mode) for rec in recordings]
+            if activities is not None:
+                # Labels are resampled by taking the nearest preceding sample
+                activities = [act[np.minimum((np.arange(rec.shape[0]) * sr/SR).astype(int), act.shape[0]-1)]
+                              for act, rec in zip(activities, resampled)]
+            data_array = self.windows(self.continuous_features(resampled))
+            counts = [n_windows(rec.shape[0], self.n_samples, self.step) for rec in resampled]
+            window, step = self.n_samples, self.step
+        else:
+            # window samples into the equivalent of n_samples at 50 Hz.
+            window, step = int(self.n_samples * sr/SR), int(self.step * sr/SR)
+            data_array, counts = segment(recordings, window, step)
+            data_array = resample_windows(data_array, self.n_samples)
+
+        y, purity = None, None
+        if activities is not None:
+            y, purity = segment_labels(activities, window, step, policy=self.label_policy or 'majority')
+        return data_array, y, purity, counts
+
+    def windows(self, recordings):
+        """
+        Segment continuous recordings sampled at SR into windows of n_samples, either materialised or, with lazy,
+        as a WindowDataset indexing one copy of the recordings
+        """
+        if self.lazy:
+            return WindowDataset.from_recordings(recordings, self.n_samples, self.step)
+        return segment(recordings, self.n_samples, self.step)[0]
+
+    def filter_purity(self, purity, *arrays):
+        """
+        Drop windows whose label purity is below min_purity
+        :param purity: fraction of samples in each window carrying the window label
+        :param arrays: per-window arrays to filter
+        :return: list of filtered arrays
+        """
+        if self.min_purity is None:
+            return list(arrays)
+        idx = purity >= self.min_purity
+        return [a[idx] for a in arrays]
+
+    def known_activities(self, y, activity_map, *arrays):
+        """
+        Drop windows whose label has no common activity in activity_map
+        :param y: dataset labels of the windows
+        :param arrays: per-window arrays to filter
+        :return: list of filtered arrays
+        """
+        lut = activity_lut(tuple(sorted(activity_map.items())))
+        labels = np.asarray(y).astype(np.int64)
+        idx = (labels >= 0) & (labels < len(lut))
+        idx[idx] = lut[labels[idx]] >= 0
+        return [a[idx] for a in arrays]
+
+    def map_to_common_activities(self, y, activity_map):
+        """
+        Translate dataset labels to the common labels of ACTIVITY_MAP with a single lookup table index
+        :param y: integer dataset labels
+        :param activity_map: map from dataset labels to common activity names
+        :return: common labels, raising a TypeError for labels without a common activity
+        """
+        lut = activity_lut(tuple(sorted(activity_map.items())))
+        y = np.asarray(y)
+        labels = y.astype(np.int64)
+        known = (labels == y) & (labels >= 0) & (labels < len(lut))
+        common = lut[np.where(known, labels, 0)]
+        known &= common >= 0
+        if not known.all():
+            raise TypeError('Labels without a common activity: %s' % np.unique(y[~known]))
+        return common.astype('int')
+
+    def add_features(self, data, normalise='channels', ratio=0, add_roll=False, add_pitch=False, add_filter=False, comp_magnitude=False):
+        """
+        Compute the features of the windows with har_features and normalise them.
+        :param data: windows of dim n_windows x n_samples x 3
+        :param normalise: 'channels' to standardise each channel over all windows, 'segments' to standardise
+        each window separately
+        :return: float32 features of dim n_windows x n_samples x channels and the per-window mean and std for
+        'segments'
+        """
+        # Scaling each window by its own std amplifies the float32 rounding of the slow low-pass channel, so
+        # segments are normalised in float64 and cast afterwards
+        dtype = np.float64 if normalise == 'segments' else np.float32
+        out = har_features(data, lowpass=self.lowpass, add_roll=add_roll, add_pitch=add_pitch,
+                           add_filter=add_filter, comp_magnitude=comp_magnitude, diff=self.differentiate, dtype=dtype)
+        out, stats = self.normalise_features(out, normalise)
+        return out.astype(np.float32, copy=False), stats
+
+    def preprocessing(self, name=None):
+        """
+        The fitted preprocessing of a loaded dataset, to apply the same features and normalisation to new windows.
+        With filter_first or lazy the features were computed on continuous recordings, which should then be
+        transformed before windowing.
+        :param name: dataset name, defaults to the last loaded dataset
+        :return: utils.preprocessing.Preprocessing
+        """
+        if self.normalize == 'segments':
+            raise ValueError('Segment normalisation is computed per window and has no fitted state')
+        features = dict(lowpass=self.lowpass, add_roll=self.add_roll, add_pitch=self.add_pitch,
+                        add_filter=self.add_filter, comp_magnitude=self.comp_magnitude, diff=self.differentiate)
+        normaliser = self.normalisers[name or self.name] if self.normalize == 'channels' else None
+        return Preprocessing(features=features, normaliser=normaliser)
+
+    def normalise_features(self, data, normalise='channels', weights=None):
+        """
+        Normalise features in place. For 'channels' the fitted ChannelNormaliser is kept in
+        self.normalisers under the dataset name, so the same transform can be applied to new data.
+        :param data: float32 or float64 features of dim n_windows x n_samples x channels
+        :param normalise: 'channels', 'segments' or None
+        :param weights: number of times each sample counts towards the 'channels' moments, cf.
+        ChannelNormaliser.fit
+        :return: normalised features and the per-window mean and std for 'segments'
+        """
+        stats = []
 
         if normalise == 'channels':
-            n_win, n_samp, n_dim = data.shape
-            data_mean = data.reshape((-1, n_dim)).mean(axis=0)
-            data_std = data.reshape((-1, n_dim)).std(axis=0)
-            data = (data.reshape((-1, n_dim)) - data_mean).reshape((n_win, n_samp, n_dim))
-            data = (data.reshape((-1, n_dim)) / data_std).reshape((n_win, n_samp, n_dim))
+            normaliser = ChannelNormaliser().fit(data, weights=weights)
+            normaliser.transform(data)
+            self.normalisers[self.name] = normaliser
 
         elif normalise == 'segments':
-            n_win, n_samp, n_dim = data.shape
-
             # Standard scaler
-            for idx in range(n_win):
-                data_mean = data[idx].mean(axis=0)
-                data_std = data[idx].std(axis=0)
-                data[idx] = data[idx] - data_mean
-
-                # Only normalise std for segments with actual signal
-                if data_std.mean() > 0.1:
-                    data[idx] = data[idx] / data_std
-
-                stats.append([data_mean, data_std])
-
-            # # Min-max scaler
-            # for idx in range(n_win):
-            #     data_min = data[idx].min(axis=0)
-            #     data_max = data[idx].max(axis=0)
-            #     data_range = data_max - data_min
-            #
-            #     data[idx] = data[idx] - data_min
-            #
-            #     # Only normalise segments with actual signal
-            #     if data_range.mean() > 0.1:
-            #         data[idx] = data[idx] / data_range
-            #
-            #     stats.append([data_min, data_max, data_range])
-
-            stats = np.array(stats)
+            data_mean = data.mean(axis=1, dtype=np.float64)
+            data_std = data.std(axis=1, dtype=np.float64)
+            data -= data_mean[:, np.newaxis].astype(data.dtype)
+
+            # Only normalise std for segments with actual signal
+            scale = np.where(data_std.mean(axis=1, keepdims=True) > 0.1, data_std, 1.)
+            data /= scale[:, np.newaxis].astype(data.dtype)
+
+            stats = np.stack((data_mean, data_std), axis=1).astype(np.float32)
 
         return data, stats
 
+    def continuous_features(self, recordings):
+        """
+        With filter_first or lazy, compute the features of each continuous recording before it is windowed.
+        Filters and differencing then run once per sample and never across the boundary between two windows or
+        recordings.
+        :param recordings: list of arrays of shape (n_samples, 3) sampled at SR
+        :return: list of feature arrays of shape (n_samples, channels), or the recordings if filter_first is off
+        """
+        if not (self.filter_first or self.lazy):
+            return recordings
+        return [self.add_features(rec[np.newaxis],
+                                  normalise=None,
+                                  add_roll=self.add_roll,
+                                  add_pitch=self.add_pitch,
+                                  add_filter=self.add_filter,
+                                  comp_magnitude=self.comp_magnitude)[0][0] for rec in recordings]
+
+    def window_features(self, data):
+        """
+        Add features to segmented windows, or only normalise them if the features were computed on the
+        continuous recordings (filter_first). A WindowDataset is normalised through its continuous signal, which
+        only supports 'channels' normalisation. Each sample of the signal is weighted by the number of windows
+        holding it, so overlapping windows are normalised as if they were materialised.
+        :param data: windows of dim n_windows x n_samples x channels or a WindowDataset
+        :return: features and statistics (cf. add_features)
+        """
+        if isinstance(data, WindowDataset):
+            if self.normalize not in ('channels', None):
+                raise ValueError('Lazy windows only support channel normalisation')
+            self.normalise_features(data.signal, self.normalize, weights=data.coverage())
+            return data, []
+        if self.filter_first:
+            return self.normalise_features(data, self.normalize)
+        return self.add_features(data,
+                                 normalise=self.normalize,
+                                 add_roll=self.add_roll,
+                                 add_pitch=self.add_pitch,
+                                 add_filter=self.add_filter,
+                                 comp_magnitude=self.comp_magnitude)
+
 
 def shared_dataset(data_xy, borrow=False):
     x, y = data_xy
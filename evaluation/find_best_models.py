@@ -1,6 +1,6 @@
 import os
-import pickle as pkl
 import numpy as np
+from utils.metrics import load_evaluations
 
 
 best_model = None
@@ -11,9 +11,10 @@ best_model_dirs = np.empty(10, dtype=object)
 model_directory = 'output'
 sub_dirs = sorted(os.listdir(model_directory))
 for sub_dir in sub_dirs:
-    validation_file = model_directory + '/' + sub_dir + '/training evaluations/evaluationvalidation_dict.pkl'
-    if os.path.isfile(validation_file):
-        validations = np.asarray(list(pkl.load(open(validation_file, "rb")).values()))
+    evaluations = load_evaluations(model_directory + '/' + sub_dir)
+    if evaluations is not None and len(evaluations[3]) > 0:
+        validation_file, validation_evals = evaluations[0], evaluations[3]
+        validations = np.asarray(list(validation_evals.values()))
         best_accuracy = np.max(validations[:, 1])
         if best_accuracy > np.min(best_validation_accuracies):
             best_validation_accuracies[0] = best_accuracy
@@ -1,6 +1,6 @@
 import os
-import pickle as pkl
 import numpy as np
+from utils.metrics import load_evaluations
 from datetime import datetime
 
 best_model = None
@@ -12,10 +12,11 @@ model_directory = 'output'
 time_midnight = datetime.strptime(datetime.now().strftime('%Y-%m-%d'), '%Y-%m-%d')
 sub_dirs = sorted(os.listdir(model_directory))
 for sub_dir in sub_dirs:
-    validation_file = model_directory + '/' + sub_dir + '/training evaluations/evaluationvalidation_dict.pkl'
-    if os.path.isfile(validation_file):
+    evaluations = load_evaluations(model_directory + '/' + sub_dir)
+    if evaluations is not None and len(evaluations[3]) > 0:
+        validation_file, validation_evals = evaluations[0], evaluations[3]
         if datetime.fromtimestamp(os.path.getctime(validation_file)) > time_midnight:
-            validations = np.asarray(list(pkl.load(open(validation_file, "rb")).values()))
+            validations = np.asarray(list(validation_evals.values()))
             best_accuracy = np.max(validations[:, 1])
             if best_accuracy > np.min(best_validation_accuracies):
                 best_validation_accuracies[0] = best_accuracy
@@ -1,12 +1,12 @@
 import os
 import sys
-import pickle as pkl
 import numpy as np
 from datetime import datetime
 import re
 import pandas as pd
 import socket
 import argparse
+from utils.metrics import load_evaluations
 
 model_directory = 'output'
 time_midnight = datetime.strptime(datetime.now().strftime('%Y-%m-%d'), '%Y-%m-%d')
@@ -40,14 +40,13 @@ def main(argv):
 def cv_lookup(today_only=False, dataset='', print_out=True, model=''):
     d = {label: [] for label in labels}
     for sub_dir in sub_dirs:
-        validation_file = model_directory + '/' + sub_dir + '/training evaluations/evaluationvalidation_dict.pkl'
-        test_file = model_directory + '/' + sub_dir + '/training evaluations/evaluationtest_dict.pkl'
-        train_file = model_directory + '/' + sub_dir + '/training evaluations/evaluationtrain_dict.pkl'
-        if os.path.exists(validation_file) and all(x in sub_dir for x in ['cv', dataset, model]):
-            validations = np.asarray(list(pkl.load(open(validation_file, "rb")).values()))
+        evaluations = load_evaluations(model_directory + '/' + sub_dir)
+        if evaluations is not None and len(evaluations[3]) > 0 and all(x in sub_dir for x in ['cv', dataset, model]):
+            validation_file, train_evals, test_evals, validation_evals = evaluations
+            validations = np.asarray(list(validation_evals.values()))
             if validations.shape[1] < 2:
-                validations = np.asarray(list(pkl.load(open(test_file, "rb")).values()))
-            training_accuracy = np.asarray(list(pkl.load(open(train_file, "rb")).values()))
+                validations = np.asarray(list(test_evals.values()))
+            training_accuracy = np.asarray(list(train_evals.values()))
 
             if today_only and not datetime.fromtimestamp(os.path.getctime(validation_file)) > time_midnight:
                 pass
@@ -109,17 +108,17 @@ def cv_lookup(today_only=False, dataset='', print_out=True, model=''):
 def single_lookup(today_only=False, dataset='', print_out=True):
     d = {label: [] for label in labels[:-3]}
     for sub_dir in sub_dirs:
-        validation_file = model_directory + '/' + sub_dir + '/training evaluations/evaluationvalidation_dict.pkl'
-        test_file = model_directory + '/' + sub_dir + '/training evaluations/evaluationtest_dict.pkl'
-        if os.path.isfile(validation_file) and 'cv' not in sub_dir and dataset in sub_dir:
+        evaluations = load_evaluations(model_directory + '/' + sub_dir)
+        if evaluations is not None and len(evaluations[3]) > 0 and 'cv' not in sub_dir and dataset in sub_dir:
+            validation_file, train_evals, test_evals, validation_evals = evaluations
             if today_only and not datetime.fromtimestamp(os.path.getctime(validation_file)) > time_midnight:
                 pass
             else:
                 model_id, model_name, net_size, n_in, classes = \
                     re.search('_([0-9]*)_(\w*\W*)_(.*)_(.*)_([0-9]*)', sub_dir).groups()
-                validations = np.asarray(list(pkl.load(open(validation_file, "rb")).values()))
+                validations = np.asarray(list(validation_evals.values()))
                 if validations.shape[1] < 2:
-                    validations = np.asarray(list(pkl.load(open(test_file, "rb")).values()))
+                    validations = np.asarray(list(test_evals.values()))
                 d['accuracy'].append(np.max(validations[:, -1]))
                 d['index'].append(np.argmax(validations[:, -1]))
                 d['test error'].append(validations[d['index'][-1], 0])
@@ -2,13 +2,93 @@ try:
     import pickle as pkl
 except:
     import pickle as pkl
+import os
 import lasagne
 import numpy as np
 import theano
 import theano.tensor as T
 from utils import env_paths as paths
+from utils.har_utils import WindowDataset
+from utils.preprocessing import Preprocessing
 from collections import OrderedDict
 
+# Orders of the training windows selectable with Model.sample_batches
+BATCH_SAMPLING = ('sequential', 'shuffle', 'stratified', 'balanced')
+
+
+def batch_order(n, strategy='sequential', labels=None, rng=np.random):
+    """
+    Order in which the training windows are visited in one epoch.
+    :param n: number of training windows.
+    :param strategy: 'sequential' to keep the stored order, 'shuffle' for a random permutation, 'stratified' for a
+    permutation spreading every class evenly over the epoch, so each batch has about the class proportions of the
+    training set, or 'balanced' to draw classes uniformly and windows of a class with replacement.
+    :param labels: integer class of every window, required by 'stratified' and 'balanced'.
+    :return: int32 array of n window indices.
+    """
+    if strategy == 'sequential':
+        return np.arange(n, dtype='int32')
+    if strategy == 'shuffle':
+        return rng.permutation(n).astype('int32')
+    if strategy not in BATCH_SAMPLING:
+        raise ValueError('Unknown batch sampling %s, expected one of %s' % (strategy, BATCH_SAMPLING))
+    if labels is None:
+        raise ValueError('%s batch sampling requires integer class labels' % strategy)
+
+    classes, labels = np.unique(labels, return_inverse=True)
+    if strategy == 'stratified':
+        # Place the i-th of the n_c shuffled windows of a class at the position (i + u) / n_c of the epoch
+        order = rng.permutation(n)
+        counts = np.bincount(labels)
+        rank = np.empty(n)
+        for c in range(len(classes)):
+            members = order[labels[order] == c]
+            rank[members] = (np.arange(counts[c]) + rng.uniform(size=counts[c])) / counts[c]
+        return np.argsort(rank, kind='stable').astype('int32')
+
+    members = np.argsort(labels, kind='stable')
+    starts = np.r_[0, np.cumsum(np.bincount(labels))[:-1]]
+    counts = np.bincount(labels)
+    drawn = rng.randint(len(classes), size=n)
+    return members[starts[drawn] + (rng.uniform(size=n) * counts[drawn]).astype(int)].astype('int32')
+
+
+class SharedWindows(object):
+    """
+    Shared counterpart of a WindowDataset: one shared copy of the continuous signal and a shared matrix of window
+    starts. Indexing it, e.g. with the batch slice, returns the symbolic gather of only the selected sequences.
+    """
+
+    def __init__(self, dataset):
+        self.signal = theano.shared(np.asarray(dataset.signal, dtype=theano.config.floatX), borrow=True)
+        self.starts = theano.shared(dataset.starts().astype('int32'), borrow=True)
+        self.window = dataset.window
+        self.length = dataset.factor * dataset.window
+        self.shape = (self.starts.shape[0], self.length, self.signal.shape[1])
+
+    def __getitem__(self, index):
+        starts = self.starts[index]
+        idx = (starts.dimshuffle(0, 1, 'x') + T.arange(self.window)).flatten()
+        return self.signal[idx].reshape((starts.shape[0], self.length, self.signal.shape[1]))
+
+
+class SharedLabels(object):
+    """
+    Integer class labels held as one shared int32 array instead of a floatX one-hot matrix. Indexing it, e.g. with
+    the batch slice, returns the one-hot targets of only the selected rows, computed in the graph.
+    """
+
+    def __init__(self, labels, n_classes):
+        self.labels = theano.shared(np.asarray(labels, dtype='int32'), borrow=True)
+        self.n_classes = n_classes
+        self.shape = tuple(np.shape(labels)) + (n_classes,)
+
+    def __getitem__(self, index):
+        labels = self.labels[index]
+        one_hot = T.extra_ops.to_one_hot(labels.flatten(), self.n_classes, dtype=theano.config.floatX)
+        return one_hot.reshape([labels.shape[i] for i in range(labels.ndim)] + [self.n_classes],
+                               ndim=labels.ndim + 1)
+
 
 class Model(object):
     """
@@ -33,6 +113,11 @@ class Model(object):
         self.transf = trans_func
 
         self.model_params = None
+        # Fitted utils.preprocessing.Preprocessing of the input, stored next to the pickled parameters
+        self.preprocessing = None
+        # Order of the training windows, cf. batch_order. Must be set before build_model
+        self.batch_sampling = 'sequential'
+        self.sh_train_order = None
 
         # Model state serialisation and logging variables.
         self.model_name = self.__class__.__name__
@@ -74,29 +159,92 @@ class Model(object):
         self.sym_batchsize = T.iscalar('batchsize')
         self.sym_lr = T.scalar('learningrate')
         self.batch_slice = slice(self.sym_index * self.sym_batchsize, (self.sym_index + 1) * self.sym_batchsize)
+        if self.batch_sampling == 'sequential':
+            self.train_batch = self.batch_slice
+        else:
+            # Training batches are gathered through a shared order of the windows, resampled by sample_batches
+            self.sh_train_order = theano.shared(np.arange(train_set[0].shape[0], dtype='int32'), borrow=True)
+            self.train_batch = self.sh_train_order[self.batch_slice]
 
-        self.sh_train_x = theano.shared(np.asarray(train_set[0], dtype=theano.config.floatX), borrow=True)
+        if isinstance(train_set[0], WindowDataset):
+            self.sh_train_x = SharedWindows(train_set[0])
+        else:
+            self.sh_train_x = theano.shared(np.asarray(train_set[0], dtype=theano.config.floatX), borrow=True)
         if train_set[1] is not None:
-            self.sh_train_t = theano.shared(np.asarray(train_set[1], dtype=theano.config.floatX), borrow=True)
+            self.sh_train_t = self.shared_targets(train_set[1])
         self.sh_test_x = theano.shared(np.asarray(test_set[0], dtype=theano.config.floatX), borrow=True)
         if test_set[1] is not None:
-            self.sh_test_t = theano.shared(np.asarray(test_set[1], dtype=theano.config.floatX), borrow=True)
+            self.sh_test_t = self.shared_targets(test_set[1])
         if validation_set is not None:
             self.sh_valid_x = theano.shared(np.asarray(validation_set[0], dtype=theano.config.floatX), borrow=True)
             if validation_set[1] is not None:
-                self.sh_valid_t = theano.shared(np.asarray(validation_set[1], dtype=theano.config.floatX), borrow=True)
+                self.sh_valid_t = self.shared_targets(validation_set[1])
+
+    def sample_batches(self, strategy='sequential', rng=np.random):
+        """
+        Set the order of the training windows for the next epoch, cf. batch_order. Only the shared int32 order
+        changes, the training data is never copied.
+        """
+        if self.sh_train_order is None:
+            raise ValueError("The model was built with sequential batches, set batch_sampling before build_model")
+        labels = None
+        if strategy in ('stratified', 'balanced'):
+            labels = self.train_labels()
+        self.sh_train_order.set_value(batch_order(self.sh_train_order.get_value(borrow=True).shape[0], strategy,
+                                                  labels, rng), borrow=True)
+
+    def train_labels(self):
+        """
+        Class of every training window, the last label of sequences, for stratified and balanced sampling.
+        """
+        if not hasattr(self, 'sh_train_t'):
+            return None
+        if isinstance(self.sh_train_t, SharedLabels):
+            labels = self.sh_train_t.labels.get_value(borrow=True)
+        else:
+            labels = np.argmax(self.sh_train_t.get_value(borrow=True), axis=-1)
+        return labels.reshape(labels.shape[0], -1)[:, -1]
+
+    def shared_targets(self, targets):
+        """
+        Integer class labels are kept as SharedLabels over n_out classes, any other targets as a floatX shared
+        variable.
+        """
+        targets = np.asarray(targets)
+        if np.issubdtype(targets.dtype, np.integer):
+            return SharedLabels(targets, self.n_out)
+        return theano.shared(np.asarray(targets, dtype=theano.config.floatX), borrow=True)
+
 
+    def snapshot_params(self):
+        """
+        Copy the current parameter values, e.g. on the training thread before they are written in the background.
+        :return: list of numpy arrays in the order of self.model_params.
+        """
+        if self.model_params is None:
+            raise ValueError("Model params are not set and can therefore not be pickled.")
+        return [param.get_value() for param in self.model_params]
 
-    def dump_model(self, epoch=None):
+    def restore_params(self, model_params):
+        """
+        Set the parameter values, e.g. to a copy from snapshot_params.
+        """
+        for param, value in zip(self.model_params, model_params):
+            param.set_value(value)
+
+    def dump_model(self, epoch=None, model_params=None):
         """
         Dump the model into a pickled version in the model path formulated in the initialisation method.
+        :param model_params: parameter values from snapshot_params, the current values if None.
         """
         p = paths.get_model_path(self.get_root_path(), self.model_name, self.n_in, self.n_hidden, self.n_out)
         if not epoch is None: p += "_epoch_%i" % epoch
-        if self.model_params is None:
-            raise "Model params are not set and can therefore not be pickled."
-        model_params = [param.get_value() for param in self.model_params]
-        pkl.dump(model_params, open(p, "wb"), protocol=pkl.HIGHEST_PROTOCOL)
+        if model_params is None:
+            model_params = self.snapshot_params()
+        with open(p, "wb") as f:
+            pkl.dump(model_params, f, protocol=pkl.HIGHEST_PROTOCOL)
+        if self.preprocessing is not None:
+            self.preprocessing.dump(paths.get_preprocessing_path(self.get_root_path()))
 
     def load_model(self, id):
         """
@@ -114,6 +262,9 @@ class Model(object):
             if not loaded_param.shape == tuple(init_param.shape.eval()):
                 print("Model could not be loaded, since parameters are not aligned.")
             self.model_params[i].set_value(np.asarray(model_params[i], dtype=theano.config.floatX), borrow=True)
+        preprocessing_path = paths.get_preprocessing_path(root)
+        if os.path.isfile(preprocessing_path):
+            self.preprocessing = Preprocessing.load(preprocessing_path)
 
     def get_output(self, x):
         """
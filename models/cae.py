@@ -95,7 +95,7 @@ class CAE(Model):
         updates = adam(mgrads, self.trainable_model_params, self.sym_lr, sym_beta1, sym_beta2)
 
         # Training function
-        x_batch = self.sh_train_x[self.batch_slice]
+        x_batch = self.sh_train_x[self.train_batch]
 
         givens = {self.sym_x: x_batch}
         inputs = [self.sym_index, self.sym_batchsize, self.sym_lr, sym_beta1, sym_beta2]
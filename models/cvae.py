@@ -236,7 +236,7 @@ class CVAE(Model):
         # updates = rmsprop(mgrads, self.trainable_model_params, self.sym_lr + (0*sym_beta1*sym_beta2))
 
         # Training function
-        x_batch = self.sh_train_x[self.batch_slice]
+        x_batch = self.sh_train_x[self.train_batch]
         if self.x_dist == 'bernoulli':  # Sample bernoulli input.
             x_batch = self._srng.binomial(size=x_batch.shape, n=1, p=x_batch, dtype=theano.config.floatX)
 
@@ -82,7 +82,7 @@ class FCAE(Model):
             inputs, [loss],
             updates=updates,
             givens={
-                self.sym_x: self.sh_train_x[self.batch_slice],
+                self.sym_x: self.sh_train_x[self.train_batch],
             },
         )
 
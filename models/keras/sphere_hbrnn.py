@@ -3,10 +3,10 @@ from keras.layers import LSTM, Dense, Dropout, Lambda, Layer, Input, Reshape, Ti
 from keras.optimizers import RMSprop
 from keras.activations import relu, softmax
 import keras.backend as K
-import pandas as pd
 import numpy as np
 import json
 from sklearn.preprocessing import normalize, MinMaxScaler
+from utils.csv_cache import cached_read_csv
 
 GRAD_CLIP = 5
 
@@ -14,12 +14,11 @@ GRAD_CLIP = 5
 def load_sequence(file_id, test_train, data_path=""):
     filename = str(file_id).zfill(5)
 
-    df = pd.read_csv(data_path + '/{}/{}/columns_20.csv'.format(test_train, filename))
-    data = df.values
+    data = cached_read_csv(data_path + '/{}/{}/columns_20.csv'.format(test_train, filename))
 
     if test_train == 'train':
-        target = pd.read_csv(data_path + '/{}/{}/targets.csv'.format(test_train, filename)).fillna(0)
-        target = target.values[:, 2:]
+        target = cached_read_csv(data_path + '/{}/{}/targets.csv'.format(test_train, filename))[:, 2:]
+        target = np.where(np.isnan(target), 0, target)
     else:
         target = []
 
@@ -30,7 +30,7 @@ class NADE(Model):
         updates = sgd(loss, get_all_params(self.model), self.sym_lr)
 
         inputs = [self.sym_index, self.sym_batchsize, self.sym_lr]
-        x_batch = self.sh_train_x[self.batch_slice]
+        x_batch = self.sh_train_x[self.train_batch]
         x_batch = self._srng.binomial(size=x_batch.shape, n=1, p=x_batch, dtype=theano.config.floatX)
         givens = {self.sym_x: x_batch}
         f_train = theano.function(inputs, [loss], updates=updates, givens=givens)
@@ -132,8 +132,8 @@ class RCL_RNN(Model):
             inputs, [loss_cc],
             updates=updates,
             givens={
-                self.sym_x: self.sh_train_x[self.batch_slice],
-                self.sym_t: self.sh_train_t[self.batch_slice],
+                self.sym_x: self.sh_train_x[self.train_batch],
+                self.sym_t: self.sh_train_t[self.train_batch],
             },
         )
 
@@ -135,8 +135,8 @@ class RCNN(Model):
             inputs, [loss_cc, loss_train_acc],
             updates=updates,
             givens={
-                self.sym_x: self.sh_train_x[self.batch_slice],
-                self.sym_t: self.sh_train_t[self.batch_slice],
+                self.sym_x: self.sh_train_x[self.train_batch],
+                self.sym_t: self.sh_train_t[self.train_batch],
             },
             on_unused_input='ignore'
         )
@@ -136,8 +136,8 @@ class ResNet(Model):
             inputs, [loss_cc, loss_train_acc],
             updates=updates,
             givens={
-                self.sym_x: self.sh_train_x[self.batch_slice],
-                self.sym_t: self.sh_train_t[self.batch_slice],
+                self.sym_x: self.sh_train_x[self.train_batch],
+                self.sym_t: self.sh_train_t[self.train_batch],
             },
         )
 
@@ -145,7 +145,7 @@ class ResNet(Model):
             [self.sym_batchsize], [loss_eval, loss_acc],
             givens={
                 self.sym_x: self.sh_test_x,
-                self.sym_t: self.sh_test_t,
+                self.sym_t: self.sh_test_t[:],
             },
             on_unused_input='ignore',
         )
@@ -156,7 +156,7 @@ class ResNet(Model):
                 [self.sym_batchsize], [loss_eval, loss_acc],
                 givens={
                     self.sym_x: self.sh_valid_x,
-                    self.sym_t: self.sh_valid_t,
+                    self.sym_t: self.sh_valid_t[:],
                 },
                 on_unused_input='ignore',
             )
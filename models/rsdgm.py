@@ -378,7 +378,7 @@ class RSDGM(Model):
         indices = self._srng.choice(size=[self.sym_bs_l], a=sh_train_x_l.shape[0], replace=False)
         x_batch_l = sh_train_x_l[indices]
         t_batch_l = sh_train_t_l[indices]
-        x_batch_u = self.sh_train_x[self.batch_slice]
+        x_batch_u = self.sh_train_x[self.train_batch]
         if self.x_dist == 'bernoulli':  # Sample bernoulli input.
             x_batch_u = self._srng.binomial(size=x_batch_u.shape, n=1, p=x_batch_u, dtype=theano.config.floatX)
             x_batch_l = self._srng.binomial(size=x_batch_l.shape, n=1, p=x_batch_l, dtype=theano.config.floatX)
@@ -413,7 +413,7 @@ class RSDGM(Model):
         y = get_output(self.l_qy, self.sym_x_l, deterministic=True).mean(axis=(1, 2))
         class_err = (1. - categorical_accuracy(y, self.sym_t_l).mean()) * 100
         givens = {self.sym_x_l: self.sh_test_x,
-                  self.sym_t_l: self.sh_test_t}
+                  self.sym_t_l: self.sh_test_t[:]}
         f_test = theano.function(inputs=[self.sym_samples], outputs=[class_err], givens=givens)
 
         # Test args.  Note that these can be changed during or prior to training.
@@ -423,7 +423,7 @@ class RSDGM(Model):
         f_validate = None
         if validation_set is not None:
             givens = {self.sym_x_l: self.sh_valid_x,
-                      self.sym_t_l: self.sh_valid_t}
+                      self.sym_t_l: self.sh_valid_t[:]}
             f_validate = theano.function(inputs=[self.sym_samples], outputs=[class_err], givens=givens)
             # Default validation args. Note that these can be changed during or prior to training.
             self.validate_args['inputs']['samples'] = 1
@@ -105,8 +105,8 @@ class CNN(Model):
             inputs, [train_cc, train_brier],
             updates=updates,
             givens={
-                self.sym_x: self.sh_train_x[self.batch_slice],
-                self.sym_t: self.sh_train_t[self.batch_slice],
+                self.sym_x: self.sh_train_x[self.train_batch],
+                self.sym_t: self.sh_train_t[self.train_batch],
             },
         )
 
@@ -114,7 +114,7 @@ class CNN(Model):
             [], [test_cc, test_brier],
             givens={
                 self.sym_x: self.sh_test_x,
-                self.sym_t: self.sh_test_t,
+                self.sym_t: self.sh_test_t[:],
             },
         )
 
@@ -129,8 +129,8 @@ class HRNN(Model):
             inputs, [loss_brier_train],
             updates=updates,
             givens={
-                self.sym_x: self.sh_train_x[self.batch_slice],
-                self.sym_t: self.sh_train_t[self.batch_slice],
+                self.sym_x: self.sh_train_x[self.train_batch],
+                self.sym_t: self.sh_train_t[self.train_batch],
             },
         )
 
@@ -138,7 +138,7 @@ class HRNN(Model):
             [], [loss_brier_test],
             givens={
                 self.sym_x: self.sh_test_x,
-                self.sym_t: self.sh_test_t,
+                self.sym_t: self.sh_test_t[:],
             },
             on_unused_input='ignore',
         )
@@ -149,7 +149,7 @@ class HRNN(Model):
                 [self.sym_batchsize], [loss_brier_test],
                 givens={
                     self.sym_x: self.sh_valid_x,
-                    self.sym_t: self.sh_valid_t,
+                    self.sym_t: self.sh_valid_t[:],
                 },
                 on_unused_input='ignore',
             )
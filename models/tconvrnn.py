@@ -147,8 +147,8 @@ class tconvRNN(Model):
             inputs, [loss_cc, loss_train_acc],
             updates=updates,
             givens={
-                self.sym_x: self.sh_train_x[self.batch_slice],
-                self.sym_t: self.sh_train_t[self.batch_slice],
+                self.sym_x: self.sh_train_x[self.train_batch],
+                self.sym_t: self.sh_train_t[self.train_batch],
             },
         )
 
@@ -166,7 +166,7 @@ class tconvRNN(Model):
                 [self.sym_batchsize], [loss_eval, loss_acc],
                 givens={
                     self.sym_x: self.sh_valid_x,
-                    self.sym_t: self.sh_valid_t,
+                    self.sym_t: self.sh_valid_t[:],
                 },
                 on_unused_input='ignore',
             )
@@ -105,7 +105,7 @@ class VAE(Model):
         sym_beta2 = T.scalar('beta2')
         updates = adam(lb, all_params, self.sym_lr, sym_beta1, sym_beta2)
 
-        x_batch = self.sh_train_x[self.batch_slice]
+        x_batch = self.sh_train_x[self.train_batch]
         if self.x_dist == 'bernoulli':
             x_batch = self._srng.binomial(size=x_batch.shape, n=1, p=x_batch, dtype=theano.config.floatX)
         givens = {self.sym_x: x_batch}
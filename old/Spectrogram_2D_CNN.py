@@ -12,6 +12,7 @@ import datetime
 import pandas as pd
 
 import utils
+from utils.spectrogram import spectrogram_2d
 import load_data as ld
 import os
 
@@ -41,11 +42,11 @@ else:
 
 def load_data():
     data = ld.LoadHAR(ROOT_FOLDER).uci_har_v1()
-    x_test = utils.spectrogram_2d(utils.magnitude(data['x_test'])).astype(theano.config.floatX)
+    x_test = spectrogram_2d(utils.magnitude(data['x_test'])).astype(theano.config.floatX)
 
     return dict(
         output_dim=int(data['y_test'].shape[-1]),
-        X_train=theano.shared(utils.spectrogram_2d(utils.magnitude(data['x_train'])).astype(theano.config.floatX)),
+        X_train=theano.shared(spectrogram_2d(utils.magnitude(data['x_train'])).astype(theano.config.floatX)),
         y_train=theano.shared(
             data['y_train'].astype(theano.config.floatX)
         ),
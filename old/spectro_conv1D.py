@@ -6,7 +6,7 @@ import lasagne
 import lasagne.updates
 import scipy.io as sio
 import time
-from matplotlib.mlab import specgram
+from utils.spectrogram import spectrogram_3d
 
 # calculate the magnitude of the accelerometer
 def magnitude(x_in):
@@ -18,23 +18,8 @@ def spectro_conv(X):
     :param X: accelerometer data of dim samples x channels x window length
     :return: spectrogram of dim samples x 24 x 24 where channels are concatenated
     """
-    X = X[:, 5:8]  # Only use 3 acc channels
-    N_BINS = 16
-    N_WIN, N_FEA, N_SAMP = X.shape
-    NFFT = 128
-    noverlap = NFFT - N_SAMP/N_BINS
-    # X = magnitude(np.swapaxes(X[:, 0:3, :], 1, 2).reshape(-1, 3))
-    # X = 10. * np.log10(specgram(np.pad(X, pad_width=NFFT/2-1, mode='constant'), NFFT=NFFT, noverlap=noverlap)[0])
-    # X = X.reshape(NFFT/2+1, 1, N_WIN, N_SAMP/(NFFT-noverlap)).swapaxes(0, 2)[:, :, :NFFT/2]
-
-    ptt = lambda x: 10. * np.log10(specgram(np.pad(x.reshape(-1), pad_width=NFFT/2-1, mode='constant'),
-                                            NFFT=NFFT,
-                                            noverlap=noverlap)[0])
-    X = np.array([ptt(x) for x in np.swapaxes(X, 0, 1)])
-    X = np.reshape(X[:, :3*N_BINS], [N_FEA, N_FEA*N_BINS, N_WIN, N_BINS]).swapaxes(0, 2)\
-        .reshape([N_WIN, N_FEA*N_BINS, N_FEA*N_BINS])
-    X = X - np.mean(X)
-    return X
+    X = np.swapaxes(X[:, 5:8], 1, 2)  # Only use 3 acc channels
+    return spectrogram_3d(X)[:, 0]
 
 tobool = lambda x: np.asarray(x, dtype=np.bool)
 
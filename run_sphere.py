@@ -1,10 +1,10 @@
-import pandas as pd
 import numpy as np
 import json
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from lasagne.nonlinearities import leaky_rectify, softmax, rectify, elu, very_leaky_rectify
 from training.train import TrainModel
 from utils import copy_script
+from utils.preprocessing import Preprocessing
+from utils.csv_cache import cached_read_csv
 from sklearn.cross_validation import train_test_split
 
 from models.sphere_window_convrnn import wconvRNN
@@ -20,12 +20,11 @@ import pickle
 def load_sequence(file_id, test_train, data_path=""):
     filename = str(file_id).zfill(5)
 
-    df = pd.read_csv(data_path + '/{}/{}/columns_20.csv'.format(test_train, filename))
-    data = df.values
+    data = cached_read_csv(data_path + '/{}/{}/columns_20.csv'.format(test_train, filename))
 
     if test_train == 'train':
-        target = pd.read_csv(data_path + '/{}/{}/targets.csv'.format(test_train, filename)).fillna(0)
-        target = target.values[:, 2:]
+        target = cached_read_csv(data_path + '/{}/{}/targets.csv'.format(test_train, filename))[:, 2:]
+        target = np.where(np.isnan(target), 0, target)
     else:
         target = []
 
@@ -57,15 +56,9 @@ n_features = 29
 ## Load data
 data, targets = load_sequences(data_ids, data_path, fs=fs)
 
-# Scale columns
-# scaler = MinMaxScaler(feature_range=(-1, 1))
-scaler = StandardScaler()
-scaler.fit(data)
-data = scaler.transform(data)
-
-# Clip the missing columns to 0 and 1
-for i in [9, 13, 18, 28]:
-    data[:, i] = np.clip(data[:, i], 0, 1)
+# Standardise columns and clip the missing columns to 0 and 1
+preprocessing = Preprocessing(clip=dict((i, (0, 1)) for i in [9, 13, 18, 28]))
+data = preprocessing.fit_transform(data)
 
 
 def _sample_data(data, targets):
@@ -150,6 +143,8 @@ model = BRNN(n_in=(sequence_length, n_features),
              slicers=slicers,
              bn=True)
 
+model.preprocessing = preprocessing
+
 # Copy model to output folder
 copy_script(__file__, model)
 
@@ -190,9 +185,9 @@ finally:
             te_ind = int(te_ind_str)
 
             meta = json.load(open(os.path.join(data_path, 'test', te_ind_str, 'meta.json')))
-            features = pd.read_csv(os.path.join(data_path, 'test', te_ind_str, 'columns_20.csv')).values
+            features = cached_read_csv(os.path.join(data_path, 'test', te_ind_str, 'columns_20.csv'))
             features = features[:meta['end'] * fs]
-            features = scaler.transform(features)
+            features = preprocessing.transform(features)
 
             # We pad so all the sequences are the same length
             n_samples, n_features = features.shape
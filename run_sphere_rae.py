@@ -4,23 +4,22 @@ from lasagne_extensions.nonlinearities import rectify, leaky_rectify
 from models.rae import RAE
 import matplotlib.pyplot as plt
 from sklearn.cross_validation import train_test_split
-import pandas as pd
 import numpy as np
 import json
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from utils import copy_script
+from utils.preprocessing import Preprocessing
+from utils.csv_cache import cached_read_csv
 import os
 
 seed = np.random.randint(1, 2147462579)
 def load_sequence(file_id, test_train, data_path=""):
     filename = str(file_id).zfill(5)
 
-    df = pd.read_csv(data_path + '/{}/{}/columns_20.csv'.format(test_train, filename))
-    data = df.values
+    data = cached_read_csv(data_path + '/{}/{}/columns_20.csv'.format(test_train, filename))
 
     if test_train == 'train':
-        target = pd.read_csv(data_path + '/{}/{}/targets.csv'.format(test_train, filename)).fillna(0)
-        target = target.values[:, 2:]
+        target = cached_read_csv(data_path + '/{}/{}/targets.csv'.format(test_train, filename))[:, 2:]
+        target = np.where(np.isnan(target), 0, target)
     else:
         target = []
 
@@ -56,19 +55,13 @@ for te_ind_str in sorted(os.listdir(os.path.join(data_path, 'test'))):
     te_ind = int(te_ind_str)
 
     meta = json.load(open(os.path.join(data_path, 'test', te_ind_str, 'meta.json')))
-    features = pd.read_csv(os.path.join(data_path, 'test', te_ind_str, 'columns_20.csv')).values
+    features = cached_read_csv(os.path.join(data_path, 'test', te_ind_str, 'columns_20.csv'))
     features = features[:meta['end'] * fs]
     data = np.concatenate((data, features))
 
-# Scale columns
-# scaler = MinMaxScaler(feature_range=(-1, 1))
-scaler = StandardScaler()
-scaler.fit(data)
-data = scaler.transform(data)
-
-# Clip the missing columns to 0 and 1
-for i in [9, 13, 18, 28]:
-    data[:, i] = np.clip(data[:, i], 0, 1)
+# Standardise columns and clip the missing columns to 0 and 1
+preprocessing = Preprocessing(clip=dict((i, (0, 1)) for i in [9, 13, 18, 28]))
+data = preprocessing.fit_transform(data)
 
 # Calc max seconds
 data_lim = (data.shape[0] // fs) * fs
@@ -111,6 +104,8 @@ n_batches = n // batch_size
 model = RAE(n_c=int(n_c), n_l=int(n_l), px_hid=[32], enc_rnn=32, dec_rnn=32,
             nonlinearity=leaky_rectify, batchnorm=False)
 
+model.preprocessing = preprocessing
+
 # Copy model to output folder
 copy_script(__file__, model)
 
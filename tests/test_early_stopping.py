@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from training.base import EarlyStopping
+from training.train import TrainModel
+
+
+class Param(object):
+    def __init__(self, value):
+        self.value = np.asarray(value, dtype=float)
+
+    def get_value(self):
+        return self.value.copy()
+
+    def set_value(self, value):
+        self.value = np.asarray(value)
+
+
+class StubModel(object):
+    preprocessing = None
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.model_params = [Param(np.zeros(2))]
+        self.restored = None
+
+    def get_root_path(self):
+        return self.root_path
+
+    def model_info(self):
+        return "stub"
+
+    def snapshot_params(self):
+        return [param.get_value() for param in self.model_params]
+
+    def restore_params(self, model_params):
+        self.restored = model_params
+        for param, value in zip(self.model_params, model_params):
+            param.set_value(value)
+
+    def after_epoch(self):
+        pass
+
+    def dump_model(self, epoch=None, model_params=None):
+        pass
+
+
+def args(*outputs):
+    return {'inputs': {}, 'outputs': dict((output, '%0.4f') for output in outputs)}
+
+
+def test_validation_split_without_validation_function(tmp_path):
+    train = TrainModel(StubModel(str(tmp_path)))
+    early_stopping = EarlyStopping('loss_acc', split='validation')
+    with pytest.raises(ValueError):
+        train.train_model(lambda *a: [0.], args('loss'), lambda *a: [0., 0.], args('loss_eval', 'loss_acc'),
+                          None, args('loss_eval', 'loss_acc'), n_train_batches=1, n_epochs=1,
+                          early_stopping=early_stopping)
+
+
+def test_keeps_best_epoch_and_stops_after_patience(tmp_path):
+    model = StubModel(str(tmp_path))
+    early_stopping = EarlyStopping('loss_acc', split='test', patience=2, min_delta=0.01, warmup=1)
+    stopped = [early_stopping.update(epoch, value, model)
+               for epoch, value in enumerate([0.9, 0.5, 0.7, 0.705, 0.6], 1)]
+    assert early_stopping.mode == 'max'
+    assert early_stopping.best_epoch == 3
+    assert stopped == [False, False, False, False, True]
+
+
+def test_improvement_resets_patience(tmp_path):
+    model = StubModel(str(tmp_path))
+    early_stopping = EarlyStopping('loss_eval', split='test', patience=2)
+    stopped = [early_stopping.update(epoch, value, model)
+               for epoch, value in enumerate([1., 1.1, 0.8, 0.9, 0.7, 0.75, 0.72], 1)]
+    assert early_stopping.mode == 'min'
+    assert early_stopping.best_epoch == 5
+    assert stopped == [False, False, False, False, False, False, True]
+
+
+def test_train_model_restores_best_params(tmp_path):
+    model = StubModel(str(tmp_path))
+    test_values = iter([0.5, 0.6, 0.55, 0.58, 0.7, 0.65, 0.6, 0.6, 0.9, 0.9])
+
+    def f_train(i, *inputs):
+        # One batch per epoch, so the parameters hold the number of epochs trained
+        model.model_params[0].value += 1
+        return [0.]
+
+    def f_test(*inputs):
+        return [0., next(test_values)]
+
+    train = TrainModel(model)
+    early_stopping = EarlyStopping('loss_acc', split='test', patience=3)
+    train.train_model(f_train, args('loss'), f_test, args('loss_eval', 'loss_acc'), None,
+                      args('loss_eval', 'loss_acc'), n_train_batches=1, n_epochs=10, early_stopping=early_stopping)
+    # The improvement in epoch 5 resets the patience counted from epoch 2
+    assert early_stopping.best_epoch == 5
+    assert early_stopping.stopped_epoch == 8
+    assert len(train.eval_test) == 8
+    np.testing.assert_array_equal(model.restored[0], [5., 5.])
+    np.testing.assert_array_equal(model.model_params[0].get_value(), [5., 5.])
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from scipy.signal import butter, lfilter
+from utils.har_utils import har_features
+
+FEATURES = [dict(add_filter=True),
+            dict(add_filter=True, diff=True),
+            dict(add_roll=True, add_pitch=True, add_filter=True, diff=True),
+            dict(comp_magnitude=True, add_filter=True, diff=True)]
+
+
+def baseline_features(data, normalise=None, add_roll=False, add_pitch=False, add_filter=False, comp_magnitude=False,
+                      diff=False):
+    """
+    The per-window LoadHAR.add_features replaced by har_features, which promotes the features to float64.
+    """
+    n_win, n_samp, n_dim = data.shape
+    if add_pitch:
+        pitches = [np.arctan2(-w[:, 0], np.sqrt(w[:, 1]**2 + w[:, 2]**2))[:, np.newaxis] for w in data]
+    if add_roll:
+        rolls = [np.arctan2(w[:, 1], w[:, 2])[:, np.newaxis] for w in data]
+    if comp_magnitude:
+        data = np.sqrt((data*data).sum(axis=2)).reshape((n_win, n_samp, 1))
+    if add_filter:
+        b, a = butter(2, 0.05 / 25., 'low', analog=False)
+        tmp_lp = lfilter(b, a, data.reshape(n_win*n_samp, -1), axis=0).reshape(n_win, n_samp, -1)
+    if add_roll:
+        data = np.concatenate((data, rolls), axis=2)
+    if add_pitch:
+        data = np.concatenate((data, pitches), axis=2)
+    if add_filter:
+        data = np.concatenate((data, tmp_lp), axis=2)
+    if diff:
+        n_dim = data.shape[2]
+        data = np.concatenate((np.zeros((1, n_dim)), np.diff(data.reshape(-1, n_dim), axis=0)), axis=0)
+        data = data.reshape(n_win, n_samp, n_dim)
+
+    if normalise == 'channels':
+        flat = data.reshape((-1, data.shape[2]))
+        data = ((flat - flat.mean(axis=0)) / flat.std(axis=0)).reshape(data.shape)
+    elif normalise == 'segments':
+        data = data.copy()
+        for idx in range(n_win):
+            data_mean, data_std = data[idx].mean(axis=0), data[idx].std(axis=0)
+            data[idx] = data[idx] - data_mean
+            if data_std.mean() > 0.1:
+                data[idx] = data[idx] / data_std
+    return data
+
+
+def standardise_windows(data):
+    data = np.asarray(data, dtype=np.float64)
+    return (data - data.mean(axis=1, keepdims=True)) / data.std(axis=1, keepdims=True)
+
+
+@pytest.fixture
+def windows():
+    rng = np.random.RandomState(0)
+    t = np.arange(200 * 128) / 50.
+    signal = np.stack([np.sin(2 * np.pi * 1.1 * t), np.cos(2 * np.pi * 0.3 * t), 9.8 + 0.1 * np.sin(t)], axis=1)
+    return (signal + 0.3 * rng.randn(*signal.shape)).astype(np.float32).reshape(200, 128, 3)
+
+
+@pytest.mark.parametrize('features', FEATURES)
+def test_har_features_match_baseline(windows, features):
+    out = har_features(windows, **features)
+    expected = baseline_features(windows, **features)
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, expected, atol=1e-5)
+    if features.get('diff'):
+        # The differenced low-pass channel varies by ~1e-4 within a window, so compare its rounding to that scale
+        np.testing.assert_allclose(standardise_windows(out[1:]), standardise_windows(expected[1:]), atol=1e-4)
+
+
+@pytest.mark.parametrize('normalise', ['channels', 'segments'])
+@pytest.mark.parametrize('features', FEATURES)
+def test_add_features_match_baseline(windows, features, normalise):
+    pytest.importorskip('theano')
+    from data_preparation.load_data import LoadHAR
+
+    features = dict(features)
+    loader = LoadHAR(root_folder='', diff=features.pop('diff', False))
+    out, _ = loader.add_features(windows.copy(), normalise, **features)
+    expected = baseline_features(windows, normalise, diff=loader.differentiate, **features)
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, expected, atol=1e-5)
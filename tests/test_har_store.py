@@ -0,0 +1,192 @@
+import json
+import types
+import numpy as np
+import pytest
+import tables
+from configurations.base import ModelConfiguration
+from data_loaders.har import HARStore
+from utils.har_utils import ChannelNormaliser
+from training.train import TrainModel
+
+N_SAMPLES, N_STATS, N_FEATURES = 4, 2, 3
+LABEL_LIMIT = 5
+# Runs of windows per user, A01 appears twice and B01 only has labels above the label limit
+RUNS = [('A', 1, 6), ('A', 2, 5), ('B', 1, 4), ('A', 1, 3), ('B', 2, 7)]
+
+
+def write_store(path, runs=RUNS, moments=None):
+    """
+    Write a store laid out like data_preparation.build_har_data, one user_index row per run.
+    :return: the windows, labels and user names of all rows.
+    """
+    rng = np.random.RandomState(0)
+    n_windows = sum(n for _, _, n in runs)
+    X = rng.randn(n_windows, N_SAMPLES, N_FEATURES).astype(np.float32)
+    stats = rng.randn(n_windows, N_STATS, N_FEATURES).astype(np.float32)
+    y = rng.randint(0, LABEL_LIMIT, n_windows).astype(np.int32)
+    names = np.repeat(['%s%02d' % (dataset, user) for dataset, user, _ in runs], [n for _, _, n in runs])
+    y[names == 'B01'] = LABEL_LIMIT + 1
+    codes = dict((name, code) for code, name in enumerate(dict.fromkeys(names)))
+
+    with tables.open_file(path, mode='w') as h5:
+        h5.create_array(h5.root, 'X', X)
+        h5.create_array(h5.root, 'y', y)
+        h5.create_array(h5.root, 'users', np.asarray([codes[name] for name in names], dtype=np.int32))
+        h5.create_array(h5.root, 'stats', stats)
+        index = h5.create_table(h5.root, 'user_index', {'user': tables.Int32Col(pos=0),
+                                                        'name': tables.StringCol(32, pos=1),
+                                                        'dataset': tables.StringCol(32, pos=2),
+                                                        'start': tables.Int64Col(pos=3),
+                                                        'stop': tables.Int64Col(pos=4)})
+        start = 0
+        for dataset, user, n in runs:
+            name = '%s%02d' % (dataset, user)
+            index.append([(codes[name], name, dataset, start, start + n)])
+            start += n
+        h5.root._v_attrs.datasets = json.dumps(list(dict.fromkeys(dataset for dataset, _, _ in runs)))
+        if moments is not None:
+            h5.root._v_attrs.moments = json.dumps(moments)
+    return X, y, names, stats
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = str(tmp_path / 'har_data.h5')
+    X, y, names, stats = write_store(path)
+    store = HARStore(path)
+    yield store, X, y, names, stats
+    store.close()
+
+
+class StubModel(object):
+    """
+    Model whose training function only records the windows it was built with.
+    """
+    transf = None
+    preprocessing = None
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.model_params = []
+        self.built = None
+
+    def build_model(self, train_set, test_set, validation_set):
+        self.built = (train_set, test_set)
+        self.n_classes = int(max(np.max(train_set[1]), np.max(test_set[1]))) + 1
+
+        def f_train(i, *inputs):
+            return [0.]
+
+        def f_test(*inputs):
+            return [0., 0.]
+
+        def args(*outputs):
+            return {'inputs': {}, 'outputs': dict((output, '%0.4f') for output in outputs)}
+
+        return f_train, f_test, None, args('loss'), args('loss', 'acc'), args('loss', 'acc')
+
+    def get_output(self, x):
+        return types.SimpleNamespace(eval=lambda: np.ones((len(x), self.n_classes)) / self.n_classes)
+
+    def get_root_path(self):
+        return self.root_path
+
+    def model_info(self):
+        return "stub"
+
+    def snapshot_params(self):
+        return []
+
+    def after_epoch(self):
+        pass
+
+
+def run_fold(conf, train_index, test_index, root_path):
+    load_data = types.SimpleNamespace(normalize=None, preprocessing=lambda name: None, simple_labels=False,
+                                      common_labels=True, step=N_SAMPLES, add_pitch=False, add_roll=False,
+                                      comp_magnitude=False, add_filter=False, differentiate=False)
+    model = StubModel(root_path)
+    conf.run(train_index, test_index, lr=0.01, n_epochs=1, model=model, train=TrainModel(model),
+             load_data=load_data)
+    return model.built
+
+
+def test_user_fold_runs_on_store(store, tmp_path):
+    store, X, y, names, stats = store
+    conf = ModelConfiguration()
+    conf.load_store(store, label_limit=LABEL_LIMIT)
+    assert list(conf.user_names) == ['A01', 'A02', 'B02']
+
+    train_idx, test_idx = conf.user_fold('A01')
+    assert (train_idx, test_idx) == conf.cv[0]
+    (x_train, y_train), (x_test, y_test) = run_fold(conf, train_idx, test_idx, str(tmp_path))
+
+    keep = y < LABEL_LIMIT
+    windows = np.concatenate((X, stats), axis=1)
+    for x_fold, y_fold, rows in ((x_train, y_train, (names != 'A01') & keep), (x_test, y_test, names == 'A01')):
+        np.testing.assert_array_equal(x_fold, windows[rows])
+        np.testing.assert_array_equal(y_fold, conf.y[rows])
+        np.testing.assert_array_equal(y[rows], np.unique(y[keep])[y_fold])
+
+
+@pytest.fixture
+def normalised_store(tmp_path):
+    """
+    Store holding unnormalised windows and the moments of each dataset, as built with channel normalisation.
+    """
+    path = str(tmp_path / 'har_data.h5')
+    X, y, names, stats = write_store(path)
+    normalisers = dict((dataset, ChannelNormaliser().fit(X[np.char.startswith(names, dataset)]))
+                       for dataset in ('A', 'B'))
+    write_store(path, moments=dict((dataset, n.state()) for dataset, n in normalisers.items()))
+    for dataset, normaliser in normalisers.items():
+        rows = np.char.startswith(names, dataset)
+        X[rows] = normaliser.transform(X[rows])
+    store = HARStore(path)
+    yield store, np.concatenate((X, stats), axis=1), y, names
+    store.close()
+
+
+def test_read_accepts_ranges_masks_and_indices(normalised_store):
+    store, windows, y, names = normalised_store
+    keep = y < LABEL_LIMIT
+    mask = np.char.startswith(names, 'A')
+    rows = np.flatnonzero(mask)
+    ranges = store.ranges([code for code, name in store.user_names.items() if name.startswith('A')])
+
+    for index in (ranges, mask, rows, list(rows)):
+        np.testing.assert_array_equal(store.rows(index, keep), rows[keep[rows]])
+        np.testing.assert_allclose(store.read(index, keep), windows[rows[keep[rows]]], atol=1e-6)
+
+    # Row indices are read in their order
+    shuffled = np.random.RandomState(1).permutation(rows)
+    np.testing.assert_array_equal(store.rows(shuffled), shuffled)
+    np.testing.assert_allclose(store.read(shuffled), windows[shuffled], atol=1e-6)
+    assert store.read([], keep).shape == (0, N_SAMPLES + N_STATS, N_FEATURES)
+
+
+@pytest.mark.parametrize('index', [np.ones(3, dtype=bool), np.array([0.5, 1.5]), np.array([0, len(RUNS) * 100]),
+                                   np.zeros((2, 3), dtype=int)])
+def test_read_rejects_invalid_indices(normalised_store, index):
+    store = normalised_store[0]
+    with pytest.raises(ValueError):
+        store.read(index)
+
+
+def test_store_training_end_to_end(normalised_store, tmp_path):
+    store, windows, y, names = normalised_store
+    conf = ModelConfiguration()
+    conf.load_store(store, label_limit=LABEL_LIMIT)
+    keep = y < LABEL_LIMIT
+
+    # The precomputed folds and masks over the user codes, as from a cross-validation iterator over conf.users
+    folds = list(conf.cv) + [(conf.users != code, conf.users == code) for code in range(len(conf.user_names))]
+    for i, (train_index, test_index) in enumerate(folds):
+        user = conf.user_names[i % len(conf.user_names)]
+        (tmp_path / str(i)).mkdir()
+        (x_train, y_train), (x_test, y_test) = run_fold(conf, train_index, test_index, str(tmp_path / str(i)))
+        train_rows, test_rows = (names != user) & keep, (names == user) & keep
+        np.testing.assert_allclose(x_train, windows[train_rows], atol=1e-6)
+        np.testing.assert_allclose(x_test, windows[test_rows], atol=1e-6)
+        np.testing.assert_array_equal(y_train, conf.y[train_rows])
+        np.testing.assert_array_equal(y_test, conf.y[test_rows])
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from scipy.signal import resample
+from utils.har_utils import resample_windows, resample_signal, rolling_window_lastaxis
+
+SR = 50
+N_SAMPLES = 100
+# Samples at both ends of a window where per-window Fourier resampling wraps the window around
+EDGE = 10
+
+
+def sines(t):
+    return np.stack([np.sin(2 * np.pi * f * t + phase) for f, phase in ((0.7, 0.), (1.3, 1.), (2.1, 2.))], axis=1)
+
+
+def windows(signal, window):
+    """
+    Non-overlapping windows of dim n_windows x window x channels.
+    """
+    return np.swapaxes(rolling_window_lastaxis(np.ascontiguousarray(signal.T), window, window), 0, 1).swapaxes(1, 2)
+
+
+def test_resample_windows_matches_per_window_loop():
+    data = np.random.RandomState(0).randn(20, 40, 3).astype(np.float32)
+    expected = np.empty((20, N_SAMPLES, 3), dtype=np.float32)
+    for idx in range(data.shape[0]):
+        for f in range(data.shape[2]):
+            expected[idx, :, f] = resample(data[idx, :, f], N_SAMPLES)
+    np.testing.assert_allclose(resample_windows(data, N_SAMPLES), expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('sr', [20, 30])
+def test_polyphase_signal_matches_per_window_path(sr):
+    signal = sines(np.arange(60 * sr) / float(sr)).astype(np.float32)
+    per_window = resample_windows(windows(signal, int(N_SAMPLES * sr / SR)), N_SAMPLES)
+    resampled = resample_signal(signal, sr, SR, 'polyphase')
+    polyphase = windows(resampled, N_SAMPLES)[:per_window.shape[0]]
+    exact = windows(sines(np.arange(resampled.shape[0]) / float(SR)), N_SAMPLES)[:per_window.shape[0]]
+
+    # The filter only pads the ends of the recording, so inner windows follow the signal to their edges
+    np.testing.assert_allclose(polyphase[1:-1], exact[1:-1], atol=5e-3)
+    # Away from the window edges the per-window path agrees with the continuous one
+    np.testing.assert_allclose(polyphase[1:-1, EDGE:-EDGE], per_window[1:-1, EDGE:-EDGE], atol=0.1)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from utils.har_utils import WindowDataset, ChannelNormaliser
+
+WINDOW, STEP = 50, 20
+
+
+@pytest.fixture
+def recordings():
+    rng = np.random.RandomState(0)
+    # Drifting recordings, so samples near the ends, which fewer windows hold, differ from the others
+    return [(np.cumsum(rng.randn(n, 3), axis=0) + 5 * rng.randn(3)).astype(np.float32) for n in (333, 180, 49, 512)]
+
+
+def test_coverage_counts_windows_per_sample(recordings):
+    dataset = WindowDataset.from_recordings(recordings, WINDOW, STEP)[::3]
+    expected = np.zeros(dataset.signal.shape[0], dtype=int)
+    for start in dataset.starts()[:, 0]:
+        expected[start:start+WINDOW] += 1
+    np.testing.assert_array_equal(dataset.coverage(), expected)
+
+
+@pytest.mark.parametrize('rows', [slice(None), slice(1, None, 2)])
+def test_weighted_signal_moments_match_windows(recordings, rows):
+    dataset = WindowDataset.from_recordings(recordings, WINDOW, STEP)[rows]
+    windowed = ChannelNormaliser().fit(np.asarray(dataset))
+    unweighted = ChannelNormaliser().fit(dataset.signal)
+    weighted = ChannelNormaliser().fit(dataset.signal, chunk_size=100, weights=dataset.coverage())
+    assert weighted.count == windowed.count
+    np.testing.assert_allclose(weighted.mean, windowed.mean, rtol=1e-9)
+    np.testing.assert_allclose(weighted.std, windowed.std, rtol=1e-9)
+    assert np.abs(unweighted.mean - windowed.mean).max() > 1e-3
+
+
+def test_lazy_windows_normalised_like_materialised(recordings):
+    pytest.importorskip('theano')
+    from data_preparation.load_data import LoadHAR
+
+    normalised = []
+    for lazy in (False, True):
+        loader = LoadHAR(root_folder='', n_samples=WINDOW, step=STEP, normalize='channels', lazy=lazy)
+        data, _ = loader.window_features(loader.windows([rec.copy() for rec in recordings]))
+        normalised.append(np.asarray(data))
+    np.testing.assert_allclose(normalised[1], normalised[0], atol=1e-5)
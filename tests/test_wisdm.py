@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('theano')
+import data_preparation.load_data as load_data
+from data_preparation.load_data import LoadHAR, MAP_ACTIVITY
+
+ACTIVITY_MAP = {'Walking': 'WALKING', 'Jogging': 'JOGGING', 'Sitting': 'INACTIVE'}
+N_ROWS = {1: 430, 2: 270, 3: 350}
+
+
+@pytest.fixture
+def wisdm_file(tmp_path):
+    rng = np.random.RandomState(0)
+    rows = []
+    for user, n_rows in N_ROWS.items():
+        for i in range(n_rows):
+            # Upstairs is not in the activity map, so its rows are dropped
+            label = ['Walking', 'Jogging', 'Sitting', 'Upstairs'][(i // 40) % 4]
+            x, y, z = rng.randn(3)
+            rows.append('%d,%s,%d,%.4f,%.4f,%.4f' % (user, label, 50 * i, x, y, z))
+    (tmp_path / 'WISDM').mkdir()
+    path = tmp_path / 'WISDM' / 'raw.txt'
+    path.write_text(';\n'.join(rows) + ';\n')
+    return str(path)
+
+
+@pytest.mark.parametrize('chunk_size', [64, 1000, 100000])
+def test_stream_wisdm_emits_each_user_once(wisdm_file, chunk_size, monkeypatch):
+    monkeypatch.setattr(load_data, 'CHUNK_SIZE', chunk_size)
+    loader = LoadHAR(root_folder='')
+    streamed = list(loader.stream_wisdm(wisdm_file, ACTIVITY_MAP))
+    assert [user for user, _, _ in streamed] == [1, 2, 3]
+    for user, signal, labels in streamed:
+        assert signal.dtype == np.float32 and labels.dtype == np.int32
+        n_known = sum(1 for i in range(N_ROWS[user]) if (i // 40) % 4 < 3)
+        assert signal.shape == (n_known, 3) and labels.shape == (n_known,)
+        assert set(labels) <= set(MAP_ACTIVITY[v] for v in ACTIVITY_MAP.values())
+
+
+def test_wisdm_windows_per_user(wisdm_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(load_data, 'CHUNK_SIZE', 64)
+    loader = LoadHAR(root_folder=str(tmp_path) + '/', n_samples=50, step=25, users=[1, 3], common_labels=False)
+    data, y, _, users, _ = loader.wisdm('WISDM/', 'raw.txt')
+    assert data.dtype == np.float32 and data.shape[1:] == (50, 3)
+    assert len(y) == len(users) == data.shape[0]
+    assert list(np.unique(users)) == [1, 3]
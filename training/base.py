@@ -1,28 +1,167 @@
 import logging
 import sys
+import time
+import atexit
+import threading
+import queue
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 plt.ioff()
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from utils import env_paths as paths
-import seaborn as sns
+from utils.metrics import PhaseTimer
 import numpy as np
 import pickle as pkl
 
 
+class ArtefactWriter(object):
+    """
+    Background worker writing checkpoint artefacts, so plotting, serialisation and file I/O do not stall training.
+    The queue is bounded: submit blocks while max_pending tasks wait, instead of holding ever more parameter
+    snapshots in memory. Pending tasks are flushed on close and at interpreter exit.
+    """
+
+    def __init__(self, max_pending=2):
+        """
+        :param max_pending: number of queued tasks before submit blocks, 0 to run every task on the calling thread.
+        """
+        self.max_pending = max_pending
+        self.error = None
+        self.thread = None
+        if max_pending > 0:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._run, name='ArtefactWriter')
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                func, args = task
+                func(*args)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        # Errors of the worker are raised on the training thread at the next submit, flush or close
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, func, *args):
+        """
+        Run func(*args) on the worker, blocking while the queue is full.
+        """
+        self._raise()
+        if self.thread is None:
+            func(*args)
+        else:
+            self.queue.put((func, args))
+
+    def flush(self):
+        """
+        Wait until all submitted tasks are written.
+        """
+        if self.thread is not None:
+            self.queue.join()
+        self._raise()
+
+    def close(self):
+        """
+        Flush the pending tasks and stop the worker.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            atexit.unregister(self.close)
+        self._raise()
+
+
+class EarlyStopping(object):
+    """
+    Stop training when a test or validation output has not improved for a number of epochs, keeping a snapshot of
+    the parameters of the best epoch in memory.
+    """
+
+    def __init__(self, output, split='validation', patience=50, min_delta=0., warmup=0, mode='auto'):
+        """
+        :param output: The name of the monitored output, e.g. 'loss_acc'.
+        :param split: 'test' or 'validation'.
+        :param patience: The number of epochs without improvement before training stops.
+        :param min_delta: The minimum change of the output counted as an improvement.
+        :param warmup: The number of epochs before the output is monitored.
+        :param mode: 'min', 'max' or 'auto' to maximise outputs named like accuracies and minimise the others.
+        """
+        if split not in ('test', 'validation'):
+            raise ValueError("Early stopping monitors a 'test' or 'validation' output, not %s" % split)
+        if mode == 'auto':
+            mode = 'max' if 'acc' in output else 'min'
+        self.output = output
+        self.split = split
+        self.patience = patience
+        self.min_delta = min_delta
+        self.warmup = warmup
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+        self.best_value = None
+        self.best_epoch = None
+        self.best_params = None
+        self.stopped_epoch = None
+
+    def improved(self, value):
+        if self.best_value is None:
+            return True
+        if self.mode == 'max':
+            return value > self.best_value + self.min_delta
+        return value < self.best_value - self.min_delta
+
+    def update(self, epoch, value, model):
+        """
+        Record the monitored output of an evaluated epoch.
+        :param model: The model, whose parameters are copied when the output improved.
+        :return: True if training should stop.
+        """
+        if epoch <= self.warmup:
+            return False
+        if self.improved(value):
+            self.best_value = value
+            self.best_epoch = epoch
+            self.best_params = model.snapshot_params()
+        elif epoch - self.best_epoch >= self.patience:
+            self.stopped_epoch = epoch
+            return True
+        return False
+
+
 class Train(object):
     """
     The :class:'Train' class general training functions.
     It should be subclassed when implementing new types of training loops.
     """
 
-    def __init__(self, model, pickle_f_custom_freq=None, custom_eval_func=None):
+    def __init__(self, model, pickle_f_custom_freq=None, custom_eval_func=None, max_pending_artefacts=2,
+                 export_eval_dicts=False):
         """
         Initialisation of the basic architecture and programmatic settings of any training procedure.
         This method should be called from any subsequent inheriting training procedure.
         :param model: The model to train on.
         :param pickle_f_custom_freq: The number of epochs between each serialization, plotting etc.
         :param custom_eval_func: The custom evaluation function taking (model, output_path) as arguments.
+        :param max_pending_artefacts: The number of checkpoints queued for the background writer before training
+        waits for it, 0 to write them on the training thread.
+        :param export_eval_dicts: Also pickle the evaluation dictionaries at every checkpoint. The metrics are
+        always appended to the metrics log, cf. utils.metrics.
         """
         self.model = model
         self.logger = None
@@ -33,6 +172,11 @@ class Train(object):
         self.eval_test = {}
         self.eval_validation = {}
         self.pickle_f_custom_freq = pickle_f_custom_freq
+        self.max_pending_artefacts = max_pending_artefacts
+        self.artefacts = None
+        self.export_eval_dicts = export_eval_dicts
+        self.metrics = None
+        self.timer = PhaseTimer()
 
     def train_model(self, *args):
         """
@@ -41,16 +185,42 @@ class Train(object):
         """
         raise NotImplementedError
 
-    def dump_dicts(self):
+    def dump_dicts(self, eval_train=None, eval_test=None, eval_validation=None):
         """
-        Dump the model evaluation dictionaries
+        Dump the model evaluation dictionaries, the current ones if not given.
         """
-        p_train = paths.get_plot_evaluation_path_for_model(self.model.get_root_path(), "train_dict.pkl")
-        pkl.dump(self.eval_train, open(p_train, "wb"))
-        p_test = paths.get_plot_evaluation_path_for_model(self.model.get_root_path(), "test_dict.pkl")
-        pkl.dump(self.eval_test, open(p_test, "wb"))
-        p_val = paths.get_plot_evaluation_path_for_model(self.model.get_root_path(), "validation_dict.pkl")
-        pkl.dump(self.eval_validation, open(p_val, "wb"))
+        eval_dicts = (self.eval_train if eval_train is None else eval_train,
+                      self.eval_test if eval_test is None else eval_test,
+                      self.eval_validation if eval_validation is None else eval_validation)
+        for eval_dict, name in zip(eval_dicts, ("train_dict.pkl", "test_dict.pkl", "validation_dict.pkl")):
+            with open(paths.get_plot_evaluation_path_for_model(self.model.get_root_path(), name), "wb") as f:
+                pkl.dump(eval_dict, f)
+
+    def checkpoint(self, labels, epoch=None, dump_params=True):
+        """
+        Snapshot the evaluation dictionaries and the parameter values on the training thread and hand the
+        plotting and pickling to the background artefact writer.
+        :param labels: The output names of the train, test and validation evaluations.
+        :param epoch: Appended to the parameter file name if given.
+        :param dump_params: Also write the parameters, e.g. not while early stopping keeps the best ones.
+        """
+        eval_dicts = (dict(self.eval_train), dict(self.eval_test), dict(self.eval_validation))
+        model_params = self.model.snapshot_params() if dump_params else None
+        self.artefacts.submit(self.write_checkpoint, eval_dicts, labels, model_params, epoch)
+
+    def write_checkpoint(self, eval_dicts, labels, model_params, epoch=None):
+        """
+        Write the plots, evaluation dictionaries and parameters of a checkpoint, cf. checkpoint. The parameters
+        are skipped if model_params is None.
+        """
+        with self.timer.phase('plot', time.thread_time):
+            for eval_dict, eval_labels, extension in zip(eval_dicts, labels, ("_train", "_test", "_validation")):
+                self.plot_eval(eval_dict, eval_labels, extension)
+        with self.timer.phase('dump', time.thread_time):
+            if self.export_eval_dicts:
+                self.dump_dicts(*eval_dicts)
+            if model_params is not None:
+                self.model.dump_model(epoch, model_params)
 
     def plot_eval(self, eval_dict, labels, path_extension=""):
         """
@@ -58,21 +228,26 @@ class Train(object):
         :param path_extension: If the plot should be saved in an incremental way.
         """
 
-        def plot(x, y, fit, label):
-            sns.regplot(np.array(x), np.array(y), fit_reg=fit, label=label, scatter_kws={"s": 5})
+        import seaborn as sns
+
+        # A figure of its own instead of the pyplot state, so plots can be drawn off the training thread
+        fig = Figure()
+        FigureCanvasAgg(fig)
+
+        def plot(ax, x, y, fit, label):
+            sns.regplot(x=np.array(x), y=np.array(y), fit_reg=fit, label=label, scatter_kws={"s": 5}, ax=ax)
 
-        plt.clf()
-        plt.subplot(211)
+        ax = fig.add_subplot(211)
         idx = np.array(list(eval_dict.values())[0]).shape[0]
         x = np.array(list(eval_dict.values()))
         for i in range(idx):
-            plot(list(eval_dict.keys()), x[:, i], False, labels[i])
-        plt.legend()
-        plt.subplot(212)
+            plot(ax, list(eval_dict.keys()), x[:, i], False, labels[i])
+        ax.legend()
+        ax = fig.add_subplot(212)
         for i in range(idx):
-            plot(list(eval_dict.keys())[-int(len(x) * 0.25):], x[-int(len(x) * 0.25):][:, i], True, labels[i])
-        plt.xlabel('Epochs')
-        plt.savefig(paths.get_plot_evaluation_path_for_model(self.model.get_root_path(), path_extension+".png"))
+            plot(ax, list(eval_dict.keys())[-int(len(x) * 0.25):], x[-int(len(x) * 0.25):][:, i], True, labels[i])
+        ax.set_xlabel('Epochs')
+        fig.savefig(paths.get_plot_evaluation_path_for_model(self.model.get_root_path(), path_extension+".png"))
 
     def init_logging(self):
         """
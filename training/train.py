@@ -1,17 +1,33 @@
 import numpy as np
 from utils import env_paths as paths
-from .base import Train
+from .base import Train, ArtefactWriter
+from utils.metrics import MetricsLog, PhaseTimer, METRICS_FILE, SPLITS
+import os
 import time
 
 
 class TrainModel(Train):
     def __init__(self, model, output_freq=1, pickle_f_custom_freq=None,
-                 f_custom_eval=None):
-        super(TrainModel, self).__init__(model, pickle_f_custom_freq, f_custom_eval)
+                 f_custom_eval=None, max_pending_artefacts=2, export_eval_dicts=False, batch_sampling='sequential'):
+        """
+        :param batch_sampling: The order of the training windows in every epoch, 'sequential', 'shuffle',
+        'stratified' or 'balanced' (cf. models.base.batch_order). Other than sequential batches are gathered through
+        an index, so the model must be built after the TrainModel is created, as in ModelConfiguration.run.
+        """
+        super(TrainModel, self).__init__(model, pickle_f_custom_freq, f_custom_eval, max_pending_artefacts,
+                                         export_eval_dicts)
         self.output_freq = output_freq
+        self.batch_sampling = batch_sampling
+        self.model.batch_sampling = batch_sampling
 
     def train_model(self, f_train, train_args, f_test, test_args, f_validate, validation_args,
-                    n_train_batches=600, n_valid_batches=1, n_test_batches=1, n_epochs=100, anneal=None):
+                    n_train_batches=600, n_valid_batches=1, n_test_batches=1, n_epochs=100, anneal=None,
+                    early_stopping=None):
+        """
+        :param anneal: list of (input key, frequency, rate, minimum value) tuples annealing training inputs.
+        :param early_stopping: EarlyStopping monitoring a test or validation output. Training stops when it has not
+        improved for the patience, and the parameters of the best epoch are restored and written once at the end.
+        """
         self.write_to_logger("### MODEL PARAMS ###")
         self.write_to_logger(self.model.model_info())
         self.write_to_logger("### TRAINING PARAMS ###")
@@ -25,58 +41,94 @@ class TrainModel(Train):
                 if isinstance(rate, int) or isinstance(rate, float):
                     self.write_to_logger(
                         "Anneal %s %0.4f after %i epochs with minimum value %f." % (key, rate, int(freq), min_val))
+        self.write_to_logger("Batch sampling: %s" % self.batch_sampling)
+        if self.batch_sampling != 'sequential' and self.model.sh_train_order is None:
+            raise ValueError("Batch sampling %s requires building the model after creating the TrainModel"
+                             % self.batch_sampling)
+        if early_stopping is not None:
+            split_outputs = (test_args if early_stopping.split == 'test' else validation_args)['outputs']
+            if early_stopping.split == 'validation' and f_validate is None:
+                raise ValueError("Early stopping on validation %s without a validation function, the validation "
+                                 "outputs would only be placeholders" % early_stopping.output)
+            if early_stopping.output not in split_outputs:
+                raise ValueError("No %s output %s to monitor" % (early_stopping.split, early_stopping.output))
+            monitor_idx = list(split_outputs.keys()).index(early_stopping.output)
+            early_stopping.reset()
+            self.write_to_logger(
+                "Early stopping on %s %s (%s) with patience %i, minimum delta %f and warm-up %i epochs." %
+                (early_stopping.split, early_stopping.output, early_stopping.mode, early_stopping.patience,
+                 early_stopping.min_delta, early_stopping.warmup))
 
         self.write_to_logger("### TRAINING MODEL ###")
+        self.artefacts = ArtefactWriter(self.max_pending_artefacts)
+        labels = (list(train_args['outputs'].keys()), list(test_args['outputs'].keys()),
+                  list(validation_args['outputs'].keys()))
+        self.metrics = MetricsLog(os.path.join(paths.get_training_evaluation_path(self.model.get_root_path()),
+                                               METRICS_FILE), dict(zip(SPLITS, labels)))
+        self.timer = PhaseTimer()
+        timer = self.timer
 
         if self.custom_eval_func is not None:
-            self.custom_eval_func(self.model, paths.get_custom_eval_path(0, self.model.root_path))
+            with timer.phase('custom_eval'):
+                self.custom_eval_func(self.model, paths.get_custom_eval_path(0, self.model.root_path))
 
         done_looping = False
         epoch = 0
         while (epoch < n_epochs) and (not done_looping):
             epoch += 1
             start_time = time.time()
+            if self.batch_sampling != 'sequential':
+                with timer.phase('sampling'):
+                    self.model.sample_batches(self.batch_sampling)
             train_outputs = []
-            for i in range(n_train_batches):
-                train_output = f_train(i, *list(train_args['inputs'].values()))
-                train_outputs.append(train_output)
+            batch_size = train_args['inputs'].get('batchsize', 1)
+            with timer.phase('train'):
+                for i in range(n_train_batches):
+                    batch_start = time.perf_counter()
+                    train_output = f_train(i, *list(train_args['inputs'].values()))
+                    timer.batch(time.perf_counter() - batch_start, batch_size)
+                    train_outputs.append(train_output)
             self.eval_train[epoch] = np.mean(np.array(train_outputs), axis=0)
-            self.model.after_epoch()
+            with timer.phase('after_epoch'):
+                self.model.after_epoch()
             end_time = time.time() - start_time
 
-            if anneal is not None:
-                for t in anneal:
-                    key, freq, rate, min_val = t
-                    if isinstance(rate, int) or isinstance(rate, float):
-                        new_val = train_args['inputs'][key] * rate
-                    else:
-                        new_val = rate(train_args['inputs'][key])
-                    if new_val < min_val:
-                        train_args['inputs'][key] = min_val
-                    elif epoch % freq == 0:
-                        train_args['inputs'][key] = new_val
+            with timer.phase('anneal'):
+                if anneal is not None:
+                    for t in anneal:
+                        key, freq, rate, min_val = t
+                        if isinstance(rate, int) or isinstance(rate, float):
+                            new_val = train_args['inputs'][key] * rate
+                        else:
+                            new_val = rate(train_args['inputs'][key])
+                        if new_val < min_val:
+                            train_args['inputs'][key] = min_val
+                        elif epoch % freq == 0:
+                            train_args['inputs'][key] = new_val
 
             if epoch % self.output_freq == 0:
-                if n_test_batches == 1:
-                    self.eval_test[epoch] = f_test(*list(test_args['inputs'].values()))
-                else:
-                    test_outputs = []
-                    for i in range(n_test_batches):
-                        test_output = f_test(i, *list(test_args['inputs'].values()))
-                        test_outputs.append(test_output)
-                    self.eval_test[epoch] = np.mean(np.array(test_outputs), axis=0)
-
-                if f_validate is not None:
-                    if n_valid_batches == 1:
-                        self.eval_validation[epoch] = f_validate(*list(validation_args['inputs'].values()))
+                with timer.phase('test'):
+                    if n_test_batches == 1:
+                        self.eval_test[epoch] = f_test(*list(test_args['inputs'].values()))
+                    else:
+                        test_outputs = []
+                        for i in range(n_test_batches):
+                            test_output = f_test(i, *list(test_args['inputs'].values()))
+                            test_outputs.append(test_output)
+                        self.eval_test[epoch] = np.mean(np.array(test_outputs), axis=0)
+
+                with timer.phase('validation'):
+                    if f_validate is not None:
+                        if n_valid_batches == 1:
+                            self.eval_validation[epoch] = f_validate(*list(validation_args['inputs'].values()))
+                        else:
+                            valid_outputs = []
+                            for i in range(n_valid_batches):
+                                valid_output = f_validate(i, *list(validation_args['inputs'].values()))
+                                valid_outputs.append(valid_output)
+                            self.eval_validation[epoch] = np.mean(np.array(valid_outputs), axis=0)
                     else:
-                        valid_outputs = []
-                        for i in range(n_valid_batches):
-                            valid_output = f_validate(i, *list(validation_args['inputs'].values()))
-                            valid_outputs.append(valid_output)
-                        self.eval_validation[epoch] = np.mean(np.array(valid_outputs), axis=0)
-                else:
-                    self.eval_validation[epoch] = [0.] * len(list(validation_args['outputs'].keys()))
+                        self.eval_validation[epoch] = [0.] * len(list(validation_args['outputs'].keys()))
 
                 # Formatting the output string from the generic and the user-defined values.
                 output_str = "epoch=%0" + str(len(str(n_epochs))) + "i; time=%0.2f;"
@@ -98,13 +150,44 @@ class TrainModel(Train):
                 output_str %= tuple(outputs)
                 self.write_to_logger(output_str)
 
+                if early_stopping is not None:
+                    eval_dict = self.eval_test if early_stopping.split == 'test' else self.eval_validation
+                    with timer.phase('early_stopping'):
+                        done_looping = early_stopping.update(epoch, float(np.ravel(eval_dict[epoch])[monitor_idx]),
+                                                             self.model)
+
             if self.pickle_f_custom_freq is not None and epoch % self.pickle_f_custom_freq == 0:
+                # The custom evaluation runs the model on the live parameters, so it stays on this thread
                 if self.custom_eval_func is not None:
-                    self.custom_eval_func(self.model, paths.get_custom_eval_path(epoch, self.model.root_path))
-                self.plot_eval(self.eval_train, list(train_args['outputs'].keys()), "_train")
-                self.plot_eval(self.eval_test, list(test_args['outputs'].keys()), "_test")
-                self.plot_eval(self.eval_validation, list(validation_args['outputs'].keys()), "_validation")
-                self.dump_dicts()
-                self.model.dump_model()
-        if self.pickle_f_custom_freq is not None:
-            self.model.dump_model()
+                    with timer.phase('custom_eval'):
+                        self.custom_eval_func(self.model, paths.get_custom_eval_path(epoch, self.model.root_path))
+                with timer.phase('checkpoint'):
+                    self.checkpoint(labels, dump_params=early_stopping is None)
+
+            epoch_metrics = {'train': self.eval_train[epoch]}
+            if epoch % self.output_freq == 0:
+                epoch_metrics['test'] = self.eval_test[epoch]
+                epoch_metrics['validation'] = self.eval_validation[epoch]
+            self.metrics.append(epoch, epoch_metrics, timing=timer.end_epoch(), time=end_time)
+
+        if early_stopping is not None and early_stopping.best_params is not None:
+            if early_stopping.stopped_epoch is not None:
+                self.write_to_logger("Early stopping in epoch %i." % early_stopping.stopped_epoch)
+            self.write_to_logger("Best %s %s=%f in epoch %i." % (early_stopping.split, early_stopping.output,
+                                                                 early_stopping.best_value, early_stopping.best_epoch))
+            self.model.restore_params(early_stopping.best_params)
+
+        with timer.phase('checkpoint'):
+            if self.pickle_f_custom_freq is not None or early_stopping is not None:
+                self.artefacts.submit(self.model.dump_model, None, self.model.snapshot_params())
+            self.artefacts.close()
+        summary = timer.summary()
+        if early_stopping is not None:
+            summary['early_stopping'] = {'output': early_stopping.output, 'split': early_stopping.split,
+                                         'best_epoch': early_stopping.best_epoch,
+                                         'best_value': early_stopping.best_value,
+                                         'stopped_epoch': early_stopping.stopped_epoch}
+        self.write_to_logger("### TIMING ###")
+        self.write_to_logger(PhaseTimer.report(summary))
+        self.metrics.summary(summary)
+        self.metrics.close()
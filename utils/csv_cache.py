@@ -0,0 +1,59 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Folder next to each CSV file holding its binary copies
+CACHE_FOLDER = '.csv_cache'
+
+
+def cache_paths(path, kwargs, cache_dir=None):
+    """
+    :return: paths of the binary copy and of its metadata for a CSV file read with the given read_csv arguments
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_FOLDER)
+    key = hashlib.sha1(repr(sorted(kwargs.items())).encode('utf-8')).hexdigest()[:12]
+    base = os.path.join(cache_dir, '%s.%s' % (os.path.basename(path), key))
+    return base + '.npy', base + '.json'
+
+
+def cached_read_csv(path, cache_dir=None, **kwargs):
+    """
+    Read the values of a numeric CSV file with pandas.read_csv. The first read converts the values to a typed
+    binary .npy file, later reads memory-map that file as long as the size and mtime of the CSV file are unchanged.
+    Files with non-numeric columns, or next to a read-only cache folder, are parsed on every read.
+    :param path: CSV file
+    :param cache_dir: folder of the binary files, defaults to CACHE_FOLDER next to the CSV file
+    :param kwargs: keyword arguments of pandas.read_csv, part of the cache key
+    :return: array of the values of dim n_rows x n_columns, read-only if memory-mapped
+    """
+    stat = os.stat(path)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    npy_path, meta_path = cache_paths(path, kwargs, cache_dir)
+    try:
+        with open(meta_path, 'r') as f:
+            if json.load(f) == source:
+                return np.load(npy_path, mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        pass
+
+    values = pd.read_csv(path, **kwargs).values
+    if values.dtype == object:
+        return values
+
+    # Write to temporary files first, so concurrent readers never see a partial copy
+    tmp_suffix = '.tmp%d' % os.getpid()
+    try:
+        if not os.path.isdir(os.path.dirname(npy_path)):
+            os.makedirs(os.path.dirname(npy_path))
+        with open(npy_path + tmp_suffix, 'wb') as f:
+            np.save(f, values)
+        os.replace(npy_path + tmp_suffix, npy_path)
+        with open(meta_path + tmp_suffix, 'w') as f:
+            json.dump(source, f)
+        os.replace(meta_path + tmp_suffix, meta_path)
+    except (IOError, OSError):
+        pass
+    return values
@@ -55,6 +55,10 @@ def get_model_path(root_path, type, n_in, n_hidden, n_out):
     return join(get_pickle_path(root_path), '%s_%s_%s_%s.pkl' % (type, str(n_in), str(n_hidden), str(n_out)))
 
 
+def get_preprocessing_path(root_path):
+    return join(get_pickle_path(root_path), 'preprocessing.json')
+
+
 # Logging
 def get_logging_path(root_path):
     t = time.time()
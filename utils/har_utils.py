@@ -1,75 +1,24 @@
 import numpy as np
-from matplotlib.mlab import specgram
-from scipy.signal import butter, lfilter
+from fractions import Fraction
+from functools import lru_cache
+from scipy.signal import butter, sosfilt, resample, resample_poly
+
+# Number of samples normalised at a time by ChannelNormaliser
+NORMALISE_CHUNK = 1 << 16
 
 
 def roll(data):
-    x, y, z = np.transpose(data)
-    return np.reshape(np.arctan2(y, z), (len(x), 1))
+    x, y, z = data[..., 0], data[..., 1], data[..., 2]
+    return np.arctan2(y, z)[..., np.newaxis]
 
 
 def pitch(data):
-    x, y, z = np.transpose(data)
-    return np.reshape(np.arctan2(-x, np.sqrt(y**2 + z**2)), (len(x), 1))
+    x, y, z = data[..., 0], data[..., 1], data[..., 2]
+    return np.arctan2(-x, np.sqrt(y**2 + z**2))[..., np.newaxis]
 
 
 def magnitude(x_in):
-    return np.sqrt((x_in*x_in).sum(axis=2))
-
-
-def spectrogram_3d(data):
-    """
-    Convert array of epoched accelerometer time series to spectrograms
-    :param data: accelerometer data of dim samples x channels x window length
-    :return: spectrogram of dim samples x 24 x 24 where channels are concatenated
-    """
-    data = data[:, :, :3]
-    print("Spectrogram conversion input shape: ", data.shape)
-    n_bins = 16
-    n_win, n_samples, n_fea = data.shape
-    nfft = 128
-    noverlap = nfft - n_samples/n_bins
-    # X = comp_magnitude(np.swapaxes(X[:, 0:3, :], 1, 2).reshape(-1, 3))
-    # X = 10. * np.log10(specgram(np.pad(X, pad_width=nfft/2-1, mode='constant'), nfft=nfft, noverlap=noverlap)[0])
-    # X = X.reshape(nfft/2+1, 1, n_win, n_samples/(nfft-noverlap)).swapaxes(0, 2)[:, :, :nfft/2]
-
-    ptt = lambda x: 10. * np.log10(specgram(np.pad(x.reshape(-1),
-                                                   pad_width=nfft/2-1,
-                                                   mode='constant'),
-                                            NFFT=nfft,
-                                            noverlap=noverlap)[0])
-    data = np.rollaxis(data, 2, 0)
-    data = np.array([ptt(x) for x in data])
-    print("Spectrogram shape", data.shape)
-    data = np.reshape(data[:, :n_fea*n_bins], [n_fea, n_fea*n_bins, n_win, n_bins]).swapaxes(0, 2).reshape([n_win, 1, n_fea*n_bins, n_fea*n_bins])
-    data = data - np.mean(data)
-    print("Spectrogram conversion output shape", data.shape)
-    return data
-
-
-def spectrogram_2d(data):
-    """
-    Convert array of epoched accelerometer time series to spectrograms
-    :param data: accelerometer data of dim samples x window_length
-    :return: spectrogram
-    """
-    print("Spectrogram conversion input shape: ", data.shape)
-    n_bins = 16
-    n_win, n_samples = data.shape
-    nfft = 128
-    noverlap = nfft - n_samples/n_bins
-
-    ptt = lambda x: 10. * np.log10(specgram(np.pad(x.reshape(-1),
-                                                   pad_width=(noverlap, noverlap),
-                                                   mode='edge'),
-                                            NFFT=nfft,
-                                            noverlap=noverlap)[0])
-    data =ptt(data)[:, n_bins:-(n_bins-1)]
-    print("Spectrogram shape", data.shape)
-    data = np.reshape(data[:nfft/2], [nfft/2, n_win, n_bins]).swapaxes(0, 1).reshape([n_win, 1, nfft/2, n_bins]).swapaxes(2, 3)
-    data = data - np.mean(data)
-    print("Spectrogram conversion output shape", data.shape)
-    return data
+    return np.sqrt((x_in*x_in).sum(axis=-1))
 
 
 # Expand the target to all time steps
@@ -77,12 +26,18 @@ def expand_target(y, length):
     return np.rollaxis(np.tile(y, (length, 1, 1)), 1,)
 
 
+@lru_cache(maxsize=None)
+def butter_lowpass(order, cutoff, fs):
+    """
+    Second-order sections of a Butterworth low-pass filter, designed once per (order, cutoff, fs)
+    """
+    return butter(order, cutoff / (0.5 * fs), 'low', analog=False, output='sos')
+
+
 def split_signal(data, fs, cutoff=0.05, order=2):
     n_win, n_samples, n_dim = data.shape
     tmp = np.reshape(data, (n_win*n_samples, n_dim))
-    normal_cutoff = cutoff / (0.5 * fs)
-    b, a = butter(order, normal_cutoff, 'low', analog=False)
-    lp_sig = lfilter(b, a, tmp, axis=0).reshape(n_win, -1, n_dim)
+    lp_sig = sosfilt(butter_lowpass(order, cutoff, fs), tmp, axis=0).reshape(n_win, -1, n_dim)
 
     return lp_sig
 
@@ -90,25 +45,102 @@ def split_signal(data, fs, cutoff=0.05, order=2):
 def lowpass_filter(data, fs, cutoff=10, order=2):
     n_win, n_samples, n_dim = data.shape
     tmp = np.reshape(data, (n_win*n_samples, n_dim))
-    normal_cutoff = cutoff / (0.5 * fs)
-    b, a = butter(order, normal_cutoff, 'low', analog=False)
-    lp_sig = lfilter(b, a, tmp, axis=0).reshape(n_win, -1, n_dim)
+    lp_sig = sosfilt(butter_lowpass(order, cutoff, fs), tmp, axis=0).reshape(n_win, -1, n_dim)
 
     return lp_sig
 
 
+def resample_windows(data, n_samples):
+    """
+    Fourier resample all windows along the time axis in one call, like scipy.signal.resample on each window.
+    Polyphase filtering is left to resample_signal, as it pads the ends of every short window with zeros.
+    :param data: windows of dim n_windows x window length x channels
+    :param n_samples: window length after resampling
+    :return: windows of dim n_windows x n_samples x channels
+    """
+    return resample(data, n_samples, axis=1).astype(np.float32, copy=False)
+
+
+def resample_signal(data, fs, new_fs, mode='fft'):
+    """
+    Resample a continuous signal of dim samples x channels from fs to new_fs
+    :param mode: 'fft' for Fourier resampling or 'polyphase' for rational polyphase filtering
+    """
+    n_samples = int(round(data.shape[0] * new_fs / float(fs)))
+    if mode == 'fft':
+        data = resample(data, n_samples, axis=0)
+    elif mode == 'polyphase':
+        ratio = Fraction(new_fs) / Fraction(fs)
+        data = resample_poly(data, ratio.numerator, ratio.denominator, axis=0)[:n_samples]
+    else:
+        raise ValueError('Unknown resampling mode: %s' % mode)
+    return data.astype(np.float32, copy=False)
+
+
+def har_features(data, lowpass=None, add_roll=False, add_pitch=False, add_filter=False, comp_magnitude=False,
+                 diff=False, fs=50, dtype=np.float32):
+    """
+    Compute all features over the whole window tensor in one pass, writing them into a single array.
+    The channel order is signal (or magnitude), roll, pitch and the low-pass filtered signal. With diff the features
+    are differenced in float64 and cast once, as the low-pass channel changes by less than float32 resolves.
+    :param data: windows of dim n_windows x n_samples x 3
+    :param lowpass: cutoff of a low-pass filter applied to the signal first, None to disable
+    :param diff: replace the features by their first difference along the flattened windows
+    :param dtype: dtype of the features
+    :return: features of dim n_windows x n_samples x channels
+    """
+    n_win, n_samp, n_dim = data.shape
+
+    if lowpass:
+        data = lowpass_filter(data, fs=fs, cutoff=lowpass)
+
+    n_sig = 1 if comp_magnitude else n_dim
+    n_out = n_sig + int(add_roll) + int(add_pitch) + (n_sig if add_filter else 0)
+    out = np.empty((n_win, n_samp, n_out), dtype=np.float64 if diff else dtype)
+
+    if comp_magnitude:
+        out[:, :, 0] = magnitude(data)
+    else:
+        out[:, :, :n_dim] = data
+    idx = n_sig
+    if add_roll:
+        out[:, :, idx:idx+1] = roll(data)
+        idx += 1
+    if add_pitch:
+        out[:, :, idx:idx+1] = pitch(data)
+        idx += 1
+    if add_filter:
+        out[:, :, idx:] = split_signal(out[:, :, :n_sig], fs)
+
+    flat = out.reshape(-1, n_out)
+    if diff:
+        np.subtract(flat[1:], flat[:-1], out=flat[1:])
+        flat[0] = 0
+    return out.astype(dtype, copy=False)
+
+
 def wavelet_decomp(data, level=3):
     pass
 
 
+def n_windows(length, window, step):
+    """
+    Number of windows rolling_window extracts from a signal of the given length
+    """
+    if window > length:
+        return 0
+    return (length - window + step)//step
+
+
 def rolling_window_lastaxis(a, window, step):
     """Directly taken from Erik Rigtorp's post to numpy-discussion.
     <http://www.mail-archive.com/numpy-discussion@scipy.org/msg29450.html>"""
+    window, step = int(window), int(step)
     if window < 1:
        raise ValueError
     if window > a.shape[-1]:
         raise ValueError
-    shape = a.shape[:-1] + ((a.shape[-1] - window + step)/step, window)
+    shape = a.shape[:-1] + (n_windows(a.shape[-1], window, step), window)
     strides = a.strides[:-1] + (a.strides[-1]*step,) + (a.strides[-1],)
     return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides)
 
@@ -124,6 +156,252 @@ def rolling_window(a, window, step=1):
     return a
 
 
+class WindowDataset(object):
+    """
+    Windows of continuous recordings kept as one contiguous float32 copy of the recordings and the
+    (recording, start) offset of every window. Windows are only gathered on demand, and indexing returns a new
+    dataset sharing the same signal, so overlapping windows and longer sequences cost no extra memory.
+    """
+
+    def __init__(self, signal, offsets, index, window, factor=1):
+        """
+        :param signal: concatenated recordings of dim samples x channels
+        :param offsets: start of each recording in signal
+        :param index: array of dim n_windows x 2 holding the (recording, start) of each window
+        :param window: window length in samples
+        :param factor: number of consecutive windows concatenated into one sequence
+        """
+        self.signal = signal
+        self.offsets = offsets
+        self.index = index
+        self.window = window
+        self.factor = factor
+
+    @classmethod
+    def from_recordings(cls, recordings, window, step):
+        """
+        Index the same windows as rolling_window over each recording
+        :param recordings: list of arrays of dim samples x channels
+        """
+        window, step = int(window), int(step)
+        lengths = np.asarray([rec.shape[0] for rec in recordings], dtype=np.int64)
+        counts = [n_windows(length, window, step) for length in lengths]
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        index = np.empty((sum(counts), 2), dtype=np.int64)
+        index[:, 0] = np.repeat(np.arange(len(recordings)), counts)
+        index[:, 1] = np.concatenate([np.arange(count) * step for count in counts] + [np.empty(0, dtype=np.int64)])
+        signal = np.concatenate(recordings).astype(np.float32, copy=False)
+        return cls(signal, offsets, index, window)
+
+    @classmethod
+    def concatenate(cls, datasets):
+        """
+        Concatenate datasets of the same window length into one dataset with a single signal
+        """
+        signal = np.concatenate([d.signal for d in datasets])
+        sample_offsets = np.cumsum([0] + [d.signal.shape[0] for d in datasets[:-1]])
+        recording_offsets = np.cumsum([0] + [len(d.offsets) for d in datasets[:-1]])
+        offsets = np.concatenate([d.offsets + o for d, o in zip(datasets, sample_offsets)])
+        index = np.concatenate([d.index + [o, 0] for d, o in zip(datasets, recording_offsets)])
+        return cls(signal, offsets, index, datasets[0].window)
+
+    @property
+    def shape(self):
+        return len(self), self.factor * self.window, self.signal.shape[1]
+
+    @property
+    def dtype(self):
+        return self.signal.dtype
+
+    def __len__(self):
+        return max(len(self.index) - self.factor + 1, 0)
+
+    def __getitem__(self, index):
+        if self.factor > 1:
+            raise ValueError('Index the windows before concatenating them into sequences')
+        return WindowDataset(self.signal, self.offsets, self.index[index], self.window)
+
+    def sequences(self, factor):
+        """
+        Concatenate each window with the following factor - 1 windows, as concat_sequence in
+        ModelConfiguration.run does for materialised windows
+        """
+        return WindowDataset(self.signal, self.offsets, self.index, self.window, factor)
+
+    def coverage(self):
+        """
+        :return: number of windows holding each sample of signal
+        """
+        n = self.signal.shape[0]
+        starts = self.offsets[self.index[:, 0]] + self.index[:, 1]
+        delta = np.bincount(starts, minlength=n+1) - np.bincount(starts + self.window, minlength=n+1)
+        return np.cumsum(delta[:n]).astype(np.int32)
+
+    def starts(self):
+        """
+        :return: start of every window of each sequence in signal, of dim n_sequences x factor
+        """
+        starts = self.offsets[self.index[:, 0]] + self.index[:, 1]
+        if self.factor == 1:
+            return starts[:, np.newaxis]
+        return rolling_window_lastaxis(starts, self.factor, 1)
+
+    def gather(self, rows=slice(None)):
+        """
+        Materialise the selected sequences
+        :return: array of dim n_rows x factor * window x channels
+        """
+        starts = self.starts()[rows]
+        idx = starts[:, :, np.newaxis] + np.arange(self.window)
+        return self.signal[idx.reshape(starts.shape[0], -1)]
+
+    def astype(self, dtype):
+        if np.dtype(dtype) == self.signal.dtype:
+            return self
+        return self.gather().astype(dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.gather()
+        return data if dtype is None else data.astype(dtype)
+
+
+class ChannelNormaliser(object):
+    """
+    Per-channel mean and standard deviation accumulated chunk by chunk and merged with the parallel form of
+    Welford's algorithm, so temporaries stay bounded by the chunk size and moments of separate parts of the data
+    can be combined exactly. The fitted normaliser applies the same transform to new data.
+    """
+
+    def __init__(self, count=0, mean=None, m2=None):
+        """
+        :param count: number of samples seen
+        :param mean: float64 mean per channel
+        :param m2: float64 sum of squared deviations from the mean per channel
+        """
+        self.count = count
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = None if m2 is None else np.asarray(m2, dtype=np.float64)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    def update(self, chunk, weights=None):
+        """
+        Add the samples of a chunk of dim ... x channels
+        :param weights: integer number of times each sample is counted, of the dim of chunk without the channels
+        """
+        chunk = chunk.reshape(-1, chunk.shape[-1])
+        if weights is None:
+            if chunk.shape[0] == 0:
+                return self
+            mean = chunk.mean(axis=0, dtype=np.float64)
+            m2 = np.square(chunk - mean).sum(axis=0)
+            return self.merge(ChannelNormaliser(chunk.shape[0], mean, m2))
+
+        weights = weights.reshape(-1, 1).astype(np.float64)
+        count = int(weights.sum())
+        if count == 0:
+            return self
+        mean = (weights * chunk).sum(axis=0) / count
+        m2 = (weights * np.square(chunk - mean)).sum(axis=0)
+        return self.merge(ChannelNormaliser(count, mean, m2))
+
+    def merge(self, other):
+        """
+        Combine the moments of another normaliser into this one
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (float(other.count) / count)
+        self.m2 = self.m2 + other.m2 + np.square(delta) * (float(self.count) * other.count / count)
+        self.count = count
+        return self
+
+    def fit(self, data, chunk_size=NORMALISE_CHUNK, weights=None):
+        """
+        :param data: array of dim n x ... x channels, read chunk_size samples at a time
+        :param weights: integer number of times each sample is counted, of the dim of data without the channels,
+        e.g. the coverage of a WindowDataset, so the moments of its signal equal those of the windows
+        """
+        if weights is None:
+            for chunk in _chunks(data, chunk_size):
+                self.update(chunk)
+            return self
+        # A channel axis makes the weights split into the same chunks as data
+        for chunk, chunk_weights in zip(_chunks(data, chunk_size), _chunks(weights[..., np.newaxis], chunk_size)):
+            self.update(chunk, chunk_weights)
+        return self
+
+    def transform(self, data, chunk_size=NORMALISE_CHUNK):
+        """
+        Normalise data in place in its own dtype
+        :param data: writeable array of dim n x ... x channels
+        :return: data
+        """
+        # Constant channels are only centred, as in sklearn's StandardScaler
+        std = self.std
+        std = np.where(std > 0, std, 1.)
+        mean, std = self.mean.astype(data.dtype), std.astype(data.dtype)
+        for chunk in _chunks(data, chunk_size):
+            chunk -= mean
+            chunk /= std
+        return data
+
+    def state(self):
+        """
+        :return: JSON serialisable moments, cf. from_state
+        """
+        return {'count': int(self.count), 'mean': self.mean.tolist(), 'm2': self.m2.tolist()}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['count'], state['mean'], state['m2'])
+
+
+def _chunks(data, chunk_size):
+    """
+    Views of data split along the first axis into chunks of about chunk_size samples
+    """
+    rows = max(1, chunk_size // max(1, int(np.prod(data.shape[1:-1]))))
+    for start in range(0, data.shape[0], rows):
+        yield data[start:start+rows]
+
+
+def window_labels(windows, policy='majority'):
+    """
+    Label all windows of per-sample integer labels in one pass
+    :param windows: array of dim n_windows x window length, e.g. a strided rolling_window view
+    :param policy: 'majority' for the most frequent label in each window (ties go to the smallest label) or
+    'centre' for the label of the centre sample
+    :return: label of each window and its purity, i.e. the fraction of samples carrying that label
+    """
+    n_win, length = windows.shape
+    if n_win == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+    if policy == 'majority':
+        # Count labels of all windows with a single bincount by offsetting each window into its own bin range
+        offset = windows.min()
+        n_labels = int(windows.max() - offset + 1)
+        bins = (windows - offset) + (np.arange(n_win) * n_labels)[:, None]
+        counts = np.bincount(bins.ravel(), minlength=n_win*n_labels).reshape(n_win, n_labels)
+        labels = np.argmax(counts, axis=1)
+        purity = counts[np.arange(n_win), labels] / float(length)
+        labels = labels + offset
+    elif policy == 'centre':
+        labels = windows[:, length//2]
+        purity = (windows == labels[:, None]).mean(axis=1)
+    else:
+        raise ValueError('Unknown labelling policy: %s' % policy)
+    return labels.astype(np.int32), purity.astype(np.float32)
+
+
 def one_hot(labels, n_classes=None):
     """
     Converts an array of label integers to a one-hot matrix encoding
@@ -144,6 +422,15 @@ def one_hot(labels, n_classes=None):
     return m
 
 
+def compress_labels(labels):
+    """
+    Map labels to consecutive integers in sorted order, i.e. the smallest label becomes 0
+    :param labels: np.ndarray of integer labels
+    :return: compressed labels of the same shape
+    """
+    return np.unique(labels, return_inverse=True)[1].reshape(np.shape(labels))
+
+
 def downsample(data, ratio=2):
     # Downsample data with ratio
     n_samp, n_dim = data.shape
@@ -0,0 +1,220 @@
+"""
+Append-only JSON-lines log of the per-epoch training metrics. A header line names the output columns of every split,
+followed by one record per epoch holding the values of the splits evaluated in that epoch, e.g.
+
+    {"columns": {"train": ["loss", "acc"], "test": ["loss", "acc"]}}
+    {"epoch": 1, "time": 12.3, "train": [0.52, 0.81]}
+    {"epoch": 2, "time": 12.1, "train": [0.41, 0.85], "test": [0.45, 0.84]}
+
+Each record is flushed when written, so the log can be read while training runs, and synced to disk in batches.
+Records may carry the timing of the epoch (cf. PhaseTimer), and the log ends with a summary record of the run.
+"""
+import os
+import json
+import time
+import threading
+import pickle as pkl
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+
+METRICS_FILE = 'evaluation_metrics.jsonl'
+EVALUATION_FOLDER = 'training evaluations'
+SPLITS = ('train', 'test', 'validation')
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+class MetricsLog(object):
+    """
+    Writer of the metrics log, appending one line per epoch at constant cost.
+    """
+
+    def __init__(self, path, columns, fsync_freq=10):
+        """
+        :param path: log file, appended to if it exists.
+        :param columns: dict of split name to the names of its outputs.
+        :param fsync_freq: number of records between syncs to disk.
+        """
+        self.path = path
+        self.fsync_freq = fsync_freq
+        self.n_unsynced = 0
+        self.f = open(path, 'a')
+        self._write({'columns': dict((split, list(names)) for split, names in columns.items())})
+
+    def _write(self, record):
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        self.n_unsynced += 1
+        if self.n_unsynced >= self.fsync_freq:
+            self.sync()
+
+    def append(self, epoch, values, timing=None, **extra):
+        """
+        :param values: dict of split name to the output values of the epoch, for the evaluated splits only.
+        :param timing: timing record of the epoch, cf. PhaseTimer.end_epoch.
+        :param extra: further scalars of the epoch, e.g. time.
+        """
+        record = OrderedDict(epoch=int(epoch))
+        for key, value in extra.items():
+            record[key] = float(value)
+        for split, split_values in values.items():
+            record[split] = [float(v) for v in np.ravel(split_values)]
+        if timing is not None:
+            record['timing'] = timing
+        self._write(record)
+
+    def summary(self, timing):
+        """
+        :param timing: timing record of the whole run, cf. PhaseTimer.summary.
+        """
+        self._write({'summary': timing})
+
+    def sync(self):
+        os.fsync(self.f.fileno())
+        self.n_unsynced = 0
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+
+
+class PhaseTimer(object):
+    """
+    Wall and CPU time of the training phases per epoch and over the run, together with the throughput and the
+    latencies of the training batches. Phases may be timed from other threads, e.g. the artefact writer.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch_phases = OrderedDict()
+        self.total_phases = OrderedDict()
+        self.epoch_latencies = []
+        self.latencies = []
+        self.epoch_samples = 0
+        self.samples = 0
+
+    @contextmanager
+    def phase(self, name, cpu_clock=time.process_time):
+        """
+        Time the body of a with statement as the given phase.
+        :param cpu_clock: time.process_time on the training thread, time.thread_time on background threads, so
+        their CPU time does not include the training running concurrently.
+        """
+        wall, cpu = time.perf_counter(), cpu_clock()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, cpu_clock() - cpu)
+
+    def add(self, name, wall, cpu):
+        with self.lock:
+            for phases in (self.epoch_phases, self.total_phases):
+                phase_wall, phase_cpu = phases.get(name, (0., 0.))
+                phases[name] = (phase_wall + wall, phase_cpu + cpu)
+
+    def batch(self, latency, n_samples):
+        """
+        Record one training batch.
+        :param latency: wall time of the batch in seconds.
+        """
+        self.epoch_latencies.append(latency)
+        self.epoch_samples += n_samples
+
+    def end_epoch(self):
+        """
+        :return: timing record of the epoch, and start timing the next one.
+        """
+        with self.lock:
+            record = self._record(self.epoch_phases, self.epoch_latencies, self.epoch_samples)
+            self.latencies += self.epoch_latencies
+            self.samples += self.epoch_samples
+            self.epoch_phases = OrderedDict()
+            self.epoch_latencies = []
+            self.epoch_samples = 0
+        return record
+
+    def summary(self):
+        """
+        :return: timing record of all epochs ended so far and of the phases timed after them.
+        """
+        with self.lock:
+            return self._record(self.total_phases, self.latencies + self.epoch_latencies,
+                                self.samples + self.epoch_samples)
+
+    @staticmethod
+    def _record(phases, latencies, samples):
+        record = OrderedDict()
+        record['phases'] = OrderedDict((name, {'wall': wall, 'cpu': cpu}) for name, (wall, cpu) in phases.items())
+        train_wall = phases.get('train', (0., 0.))[0]
+        record['samples_per_s'] = samples / train_wall if train_wall > 0 else 0.
+        if len(latencies) > 0:
+            percentiles = np.percentile(latencies, LATENCY_PERCENTILES)
+            record['batch_latency'] = OrderedDict(('p%d' % q, float(v))
+                                                  for q, v in zip(LATENCY_PERCENTILES, percentiles))
+            record['batch_latency']['max'] = float(np.max(latencies))
+        return record
+
+    @staticmethod
+    def report(record):
+        """
+        :return: table of a timing record for the training log.
+        """
+        phases = record['phases']
+        total = sum(t['wall'] for t in phases.values())
+        lines = ["%-14s %10s %10s %7s" % ('phase', 'wall (s)', 'cpu (s)', 'wall %')]
+        for name, t in phases.items():
+            lines.append("%-14s %10.2f %10.2f %6.1f%%" % (name, t['wall'], t['cpu'],
+                                                         100. * t['wall'] / total if total > 0 else 0.))
+        lines.append("samples/s: %.1f" % record['samples_per_s'])
+        if 'batch_latency' in record:
+            lines.append("batch latency (ms): " + ", ".join("%s=%.2f" % (k, 1000. * v)
+                                                           for k, v in record['batch_latency'].items()))
+        return "\n".join(lines)
+
+
+def read_metrics(path):
+    """
+    Read a metrics log, also while it is written: an incomplete last line is ignored.
+    :return: the output names of every split and a dict of split name to an ordered dict of epoch to output values,
+    like the eval dicts of training.base.Train.
+    """
+    columns = {}
+    evals = dict((split, OrderedDict()) for split in SPLITS)
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            record = json.loads(line)
+            if 'columns' in record:
+                columns.update(record['columns'])
+                continue
+            if 'epoch' not in record:
+                continue
+            for split in SPLITS:
+                if split in record:
+                    evals[split][record['epoch']] = np.asarray(record[split])
+    return columns, evals
+
+
+def load_evaluations(root_path):
+    """
+    Evaluation outputs of a model folder, read from its metrics log or from the pickled eval dicts of older runs.
+    :param root_path: output folder of the model.
+    :return: path of the file read and the train, test and validation dicts, or None if the model has neither.
+    """
+    folder = os.path.join(root_path, EVALUATION_FOLDER)
+    path = os.path.join(folder, METRICS_FILE)
+    if os.path.isfile(path):
+        columns, evals = read_metrics(path)
+        return (path,) + tuple(evals[split] for split in SPLITS)
+
+    paths = [os.path.join(folder, 'evaluation%s_dict.pkl' % split) for split in SPLITS]
+    if not os.path.isfile(paths[-1]):
+        return None
+    evals = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            evals.append(pkl.load(f))
+    return (paths[-1],) + tuple(evals)
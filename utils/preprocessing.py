@@ -0,0 +1,69 @@
+import json
+import numpy as np
+from utils.har_utils import ChannelNormaliser, har_features
+
+
+class Preprocessing(object):
+    """
+    Fitted preprocessing chain: low-pass filter and features (cf. har_utils.har_features), channel normalisation
+    and clipping of columns. The state is stored as JSON next to the pickled model parameters, so inference applies
+    exactly the transform used for training without refitting anything.
+    """
+
+    def __init__(self, features=None, normaliser=None, clip=None):
+        """
+        :param features: keyword arguments of har_features, None to keep the input columns
+        :param normaliser: fitted ChannelNormaliser, None to skip normalisation
+        :param clip: dict of column index to (min, max), applied after normalisation
+        """
+        self.features = features
+        self.normaliser = normaliser
+        self.clip = dict((int(col), tuple(bounds)) for col, bounds in (clip or {}).items())
+
+    def transform(self, data):
+        """
+        :param data: windows of dim n_windows x n_samples x channels or a recording of dim n_samples x channels
+        :return: preprocessed copy of the data in float32, or float64 for float64 input without features
+        """
+        return self._normalise(self._features(data))
+
+    def fit_transform(self, data):
+        """
+        Fit a new normaliser to the features of data and transform it
+        """
+        out = self._features(data)
+        self.normaliser = ChannelNormaliser().fit(out)
+        return self._normalise(out)
+
+    def _features(self, data):
+        data = np.asarray(data)
+        if self.features is None:
+            return np.array(data, dtype=np.result_type(data.dtype, np.float32))
+        out = har_features(data if data.ndim == 3 else data[np.newaxis], **self.features)
+        return out.reshape(data.shape[:-1] + (-1,))
+
+    def _normalise(self, out):
+        if self.normaliser is not None:
+            self.normaliser.transform(out)
+        for col, (low, high) in self.clip.items():
+            np.clip(out[..., col], low, high, out=out[..., col])
+        return out
+
+    def state(self):
+        return {'features': self.features,
+                'normaliser': None if self.normaliser is None else self.normaliser.state(),
+                'clip': dict((str(col), list(bounds)) for col, bounds in self.clip.items())}
+
+    @classmethod
+    def from_state(cls, state):
+        normaliser = None if state['normaliser'] is None else ChannelNormaliser.from_state(state['normaliser'])
+        return cls(features=state['features'], normaliser=normaliser, clip=state['clip'])
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.state(), f, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_state(json.load(f))
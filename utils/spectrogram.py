@@ -0,0 +1,131 @@
+"""
+Batched short-time Fourier transforms of HAR windows. All windows and channels are framed at once with stride tricks
+and transformed with one real FFT in float32, so there is no Python loop over windows, channels or frames.
+"""
+import numpy as np
+from functools import lru_cache
+from scipy import fft
+from scipy.signal import get_window
+from utils.har_utils import rolling_window_lastaxis
+
+
+@lru_cache(maxsize=None)
+def fft_window(window, nfft):
+    """
+    Periodic window function of length nfft, computed once per (window, nfft)
+    """
+    w = get_window(window, nfft).astype(np.float32)
+    w.flags.writeable = False
+    return w
+
+
+def frames(data, nfft, hop, center=True, pad_mode='constant'):
+    """
+    Frame every window along time without copying the frames.
+    :param data: array of dim n_windows x n_samples x channels
+    :param hop: number of samples between frames
+    :param center: pad nfft // 2 samples at both ends, so frame t is centred on sample t * hop
+    :param pad_mode: numpy.pad mode of the centring
+    :return: strided view of dim n_windows x channels x n_frames x nfft
+    """
+    data = np.swapaxes(np.asarray(data, dtype=np.float32), 1, 2)
+    if center:
+        pad = nfft // 2
+        data = np.pad(data, ((0, 0), (0, 0), (pad, pad)), mode=pad_mode)
+    return rolling_window_lastaxis(np.ascontiguousarray(data), nfft, hop)
+
+
+def stft(data, nfft=128, hop=None, window='hann', center=True, pad_mode='constant'):
+    """
+    :param data: array of dim n_windows x n_samples x channels
+    :param hop: number of samples between frames, nfft // 4 by default
+    :return: complex64 array of dim n_windows x channels x n_frames x (nfft // 2 + 1)
+    """
+    hop = nfft // 4 if hop is None else int(hop)
+    x = frames(data, nfft, hop, center, pad_mode) * fft_window(window, nfft)
+    return fft.rfft(x, axis=-1)
+
+
+def istft(spectra, n_samples, hop=None, window='hann', center=True):
+    """
+    Invert stft by weighted overlap-add of all windows and channels at once.
+    :param spectra: array of dim n_windows x channels x n_frames x (nfft // 2 + 1)
+    :param n_samples: length of the windows passed to stft
+    :return: float32 array of dim n_windows x n_samples x channels
+    """
+    nfft = 2 * (spectra.shape[-1] - 1)
+    hop = nfft // 4 if hop is None else int(hop)
+    w = fft_window(window, nfft)
+    x = fft.irfft(spectra, n=nfft, axis=-1).astype(np.float32) * w
+
+    n_frames = spectra.shape[2]
+    length = nfft + hop * (n_frames - 1)
+    # Sample index of every frame position, n_frames x nfft
+    index = hop * np.arange(n_frames)[:, np.newaxis] + np.arange(nfft)
+    out = np.zeros(spectra.shape[:2] + (length,), dtype=np.float32)
+    np.add.at(out, (slice(None), slice(None), index), x)
+    norm = np.bincount(index.ravel(), weights=np.tile(w**2, n_frames), minlength=length).astype(np.float32)
+
+    offset = nfft // 2 if center else 0
+    if offset + n_samples > length:
+        raise ValueError('The frames cover %d samples, not %d' % (length - offset, n_samples))
+    out = out[..., offset:offset+n_samples]
+    norm = norm[offset:offset+n_samples]
+    out /= np.where(norm > 1e-8, norm, 1.)
+    return np.swapaxes(out, 1, 2)
+
+
+def spectrogram(data, nfft=128, hop=None, window='hann', center=True, pad_mode='constant', log=True, pool=1, fs=1.,
+                eps=1e-10):
+    """
+    One-sided power spectral density of every window and channel.
+    :param data: array of dim n_windows x n_samples x channels
+    :param log: return the density in dB, 10 * log10(density + eps)
+    :param pool: number of adjacent frequency bins averaged into one, trailing bins that do not fill a pool are
+    dropped
+    :param fs: sampling frequency the density is scaled by
+    :return: float32 array of dim n_windows x channels x n_frames x n_bins
+    """
+    spectra = stft(data, nfft, hop, window, center, pad_mode)
+    power = np.square(spectra.real)
+    power += np.square(spectra.imag)
+    power /= fs * np.sum(fft_window(window, nfft)**2)
+    # Fold the negative frequencies onto the positive ones, except for DC and Nyquist
+    power[..., 1:(nfft+1)//2] *= 2
+
+    if pool > 1:
+        n_bins = power.shape[-1] // pool
+        power = power[..., :n_bins*pool].reshape(power.shape[:-1] + (n_bins, pool)).mean(axis=-1)
+    if log:
+        power += eps
+        np.log10(power, out=power)
+        power *= 10
+    return power
+
+
+def spectrogram_3d(data, n_bins=16, nfft=128):
+    """
+    Convert array of epoched accelerometer time series to spectrograms
+    :param data: accelerometer data of dim samples x window length x channels, only the first 3 channels are used
+    :return: spectrogram of dim samples x 1 x 3*n_bins x 3*n_bins, frequencies along the rows and the time frames
+    of the channels concatenated along the columns
+    """
+    data = data[..., :3]
+    n_win, n_samples, n_fea = data.shape
+    data = spectrogram(data, nfft, hop=max(n_samples // n_bins, 1))[:, :, :n_bins, :n_fea*n_bins]
+    data = data.transpose(0, 3, 1, 2).reshape([n_win, 1, n_fea*n_bins, n_fea*n_bins])
+    data -= np.mean(data)
+    return data
+
+
+def spectrogram_2d(data, n_bins=16, nfft=128):
+    """
+    Convert array of epoched accelerometer time series to spectrograms
+    :param data: accelerometer data of dim samples x window_length, e.g. the magnitude
+    :return: spectrogram of dim samples x 1 x n_bins x nfft/2
+    """
+    n_win, n_samples = data.shape
+    data = spectrogram(data[..., np.newaxis], nfft, hop=max(n_samples // n_bins, 1), pad_mode='edge')
+    data = data[:, :, :n_bins, :nfft//2]
+    data -= np.mean(data)
+    return data